@@ -13,6 +13,7 @@ import numpy as np
 from . import submissions, seizure_modeling
 
 from ..datasets import dataset, fileutils, features_combined, correlation_convertion, wavelet_classification
+from ..datasets import frame_dataset
 
 
 def run_batch_classification(feature_folders,
@@ -32,6 +33,7 @@ def run_batch_classification(feature_folders,
                              do_segment_split=True,
                              do_pca=False,
                              random_state=None,
+                             lazy_frames=False,
                              **kwargs):
     """
     Runs the batch classification on the feature folders.
@@ -58,6 +60,8 @@ def run_batch_classification(feature_folders,
     :param do_segment_split: If True, the cross-validation will be performed by splitting on whole segments
     :param do_pca: If True, the the PCA feature reduction will be performed on the data.
     :param random_state: Seed
+    :param lazy_frames: If True, the frames are built on demand from the feature windows and the model is trained
+                        incrementally, see load_features.
     :param kwargs: Incoming kwargs that will be passed on to the classifiers
     :return: None. Creates the output classification and submission files in ../submissions.
     """
@@ -74,7 +78,8 @@ def run_batch_classification(feature_folders,
                                       do_standardize=do_standardize,
                                       do_segment_split=do_segment_split,
                                       do_pca=do_pca,
-                                      random_state=random_state):
+                                      random_state=random_state,
+                                      lazy_frames=lazy_frames):
         kwargs.update(feature_dict)  # Adds the content of feature dict to the keywords for run_classification
         segment_scores = run_classification(processes=processes,
                                             csv_directory=csv_directory,
@@ -124,7 +129,8 @@ def load_features(feature_folders,
                   do_standardize=False,
                   do_segment_split=True,
                   do_pca=False,
-                  random_state=None):
+                  random_state=None,
+                  lazy_frames=False):
     """
     Loads the features from the list of paths *feature_folder*. Returns an iterator of dictionaries, where each
     dictionary has the keys 'subject_folder', 'interictal_data', ''preictal_data' and 'unlabeled_data'.
@@ -146,6 +152,9 @@ def load_features(feature_folders,
     :param do_segment_split:
     :param do_pca:
     :param random_state:
+    :param lazy_frames: If True, only the feature windows are loaded and the data are frame_dataset.SlidingFrameDatasets
+    which build the frames on demand, so sliding frames take no more memory than the windows. Not supported for the
+    'combined' feature type.
     :return: A generator object which gives a dictionary with features for every call to next. The dictionary contains
     the keys 'subject_folder', 'interictal_data', 'preictal_data' and 'unlabeled_data'.
     """
@@ -158,24 +167,39 @@ def load_features(feature_folders,
         else:
             feature_module = correlation_convertion
         for feature_folder in feature_folders:
-            interictal, preictal, unlabeled = feature_module.load_data_frames(feature_folder,
-                                                                              rebuild_data=rebuild_data,
-                                                                              processes=processes,
-                                                                              frame_length=frame_length,
-                                                                              sliding_frames=sliding_frames)
-            interictal, preictal, unlabeled = preprocess_features(interictal, preictal, unlabeled,
-                                                                  do_downsample=do_downsample,
-                                                                  downsample_ratio=downsample_ratio,
-                                                                  do_standardize=do_standardize,
-                                                                  do_segment_split=do_segment_split,
-                                                                  do_pca=do_pca,
-                                                                  random_state=random_state)
+            if lazy_frames:
+                # The windows are loaded as frames of a single window, the frames are built by the frame datasets
+                windows = feature_module.load_data_frames(feature_folder,
+                                                          rebuild_data=rebuild_data,
+                                                          processes=processes,
+                                                          frame_length=1,
+                                                          sliding_frames=False)
+                interictal, preictal, unlabeled = frame_datasets(*windows,
+                                                                 frame_length=frame_length,
+                                                                 sliding_frames=sliding_frames)
+                preprocess = preprocess_frame_datasets
+            else:
+                interictal, preictal, unlabeled = feature_module.load_data_frames(feature_folder,
+                                                                                  rebuild_data=rebuild_data,
+                                                                                  processes=processes,
+                                                                                  frame_length=frame_length,
+                                                                                  sliding_frames=sliding_frames)
+                preprocess = preprocess_features
+            interictal, preictal, unlabeled = preprocess(interictal, preictal, unlabeled,
+                                                         do_downsample=do_downsample,
+                                                         downsample_ratio=downsample_ratio,
+                                                         do_standardize=do_standardize,
+                                                         do_segment_split=do_segment_split,
+                                                         do_pca=do_pca,
+                                                         random_state=random_state)
             yield dict(interictal_data=interictal,
                        preictal_data=preictal,
                        unlabeled_data=unlabeled,
                        subject_folder=feature_folder)
 
     elif feature_type == 'combined':
+        if lazy_frames:
+            raise NotImplementedError("Lazy frames are not supported for combined features")
         combined_folders = fileutils.group_folders(feature_folders)
         for subject, combo_folders in combined_folders.items():
             # We create an output folder which is based on the subject name
@@ -251,6 +275,66 @@ def preprocess_features(interictal,
     return interictal, preictal, test
 
 
+def frame_datasets(interictal, preictal, unlabeled, frame_length=12, sliding_frames=False):
+    """
+    Creates frame datasets from DataFrames with one feature window per row.
+
+    :param interictal: A DataFrame with the interictal windows.
+    :param preictal: A DataFrame with the preictal windows.
+    :param unlabeled: A DataFrame with the unlabeled test windows.
+    :param frame_length: The length in windows of the frames.
+    :param sliding_frames: If True, the training frames are sliding frames. The test frames never are.
+    :return: A triple of frame_dataset.SlidingFrameDatasets (interictal, preictal, unlabeled)
+    """
+    training_step = 1 if sliding_frames else frame_length
+    return (frame_dataset.SlidingFrameDataset.from_window_frame(interictal, frame_length, step=training_step),
+            frame_dataset.SlidingFrameDataset.from_window_frame(preictal, frame_length, step=training_step),
+            frame_dataset.SlidingFrameDataset.from_window_frame(unlabeled, frame_length, step=frame_length))
+
+
+def preprocess_frame_datasets(interictal,
+                              preictal,
+                              test,
+                              do_downsample=False,
+                              downsample_ratio=2.0,
+                              do_standardize=False,
+                              do_segment_split=False,
+                              do_pca=False,
+                              random_state=None):
+    """
+    Performs the pre-processing of preprocess_features on frame datasets. The features are standardized per window
+    feature, see frame_dataset.standardize. PCA isn't supported, since it would have to materialise all frames.
+    :param interictal: A frame_dataset.SlidingFrameDataset with the interictal training data.
+    :param preictal: A frame_dataset.SlidingFrameDataset with the preictal training data.
+    :param test: A frame_dataset.SlidingFrameDataset with the unlabled test data.
+    :param do_downsample: If True, the majority class (the interictal data) will be downsampled.
+    :param downsample_ratio: The ratio of interictal/preictal class size after downsampling.
+    :param do_standardize: If True, the data will be centered to 0 mean and scaled to std. deviation 1.
+    :param do_segment_split: If True, the downsampling will be on a segment basis.
+    :param do_pca: Must be False.
+    :param random_state: If not None, this constant will be used to seed the random number generator.
+    :return: A triple of frame datasets (interictal, preictal, test)
+    """
+    if do_pca:
+        raise NotImplementedError("PCA is not supported with lazy frames")
+    logging.info("Preprocessing features")
+    if do_downsample:
+        n_samples = int(len(preictal)*downsample_ratio)
+        if do_segment_split:
+            interictal = interictal.sample_segments(n_samples, random_state=random_state)
+        elif n_samples < len(interictal):
+            sample_indices = np.random.RandomState(random_state).choice(len(interictal), n_samples, replace=False)
+            interictal = interictal.subset(np.sort(sample_indices))
+    if do_standardize:
+        logging.info("Standardizing variables.")
+        interictal, preictal, test = frame_dataset.standardize([interictal, preictal, test])
+    logging.info("Frames after preprocessing:")
+    logging.info("Interictal: {}".format(interictal.shape))
+    logging.info("Preictal: {}".format(preictal.shape))
+    logging.info("Unlabeled: {}".format(test.shape))
+    return interictal, preictal, test
+
+
 def run_classification(interictal_data,
                        preictal_data,
                        unlabeled_data,
@@ -268,7 +352,9 @@ def run_classification(interictal_data,
                        cv_verbosity=2,
                        model_params=None,
                        random_state=None,
-                       no_crossvalidation=False):
+                       no_crossvalidation=False,
+                       n_epochs=5,
+                       batch_size=1024):
     """
     Trains a model for a single subject and returns the classification scores for the unlabeled data of that subject.
 
@@ -298,6 +384,8 @@ def run_classification(interictal_data,
     :param random_state: An optional constant to seed the random number generator with.
     :param no_crossvalidation: If True, no cross validation will be performed. If this is the case, *model_params* must
                                be given.
+    :param n_epochs: The number of passes over the frames when the data are frame datasets.
+    :param batch_size: The number of frames in each minibatch when the data are frame datasets.
     :return: A dictionary of scores
     """
     logging.info("Running classification on folder {}".format(subject_folder))
@@ -319,7 +407,9 @@ def run_classification(interictal_data,
                                              cv_verbosity=cv_verbosity,
                                              model_params=model_params,
                                              random_state=random_state,
-                                             no_crossvalidation=no_crossvalidation)
+                                             no_crossvalidation=no_crossvalidation,
+                                             n_epochs=n_epochs,
+                                             batch_size=batch_size)
         if model_file is None:
             # Create a new filename based on the model method and the
             # date
@@ -340,7 +430,10 @@ def run_classification(interictal_data,
         logging.info("Refitting model with held-out data.")
         model = seizure_modeling.refit_model(interictal_data,
                                              preictal_data,
-                                             model)
+                                             model,
+                                             n_epochs=n_epochs,
+                                             batch_size=batch_size,
+                                             random_state=random_state)
 
     if csv_directory is None:
         csv_directory = subject_folder
@@ -524,7 +617,8 @@ def get_cli_args():
                                  'random-forest',
                                  'nearest-centroid',
                                  'knn',
-                                 'bagging'],
+                                 'bagging',
+                                 'naive-bayes'],
                         default='logistic')
     parser.add_argument("--processes",
                         help="How many processes should be used for parellelized work.",
@@ -548,6 +642,25 @@ def get_cli_args():
                         dest='sliding_frames',
                         default=False,
                         action='store_true')
+    parser.add_argument("--lazy-frames",
+                        help=("Only load the feature windows and build the frames on demand, training the model "
+                              "incrementally on minibatches of frames. Makes training on all sliding frames possible "
+                              "within a fixed amount of memory. Requires one of the methods {}, and can't be combined "
+                              "with --pca or the feature type 'combined'.".format(
+                                  ', '.join(seizure_modeling.INCREMENTAL_METHODS))),
+                        dest='lazy_frames',
+                        default=False,
+                        action='store_true')
+    parser.add_argument("--epochs",
+                        help="The number of passes over the frames when training on lazy frames.",
+                        dest='n_epochs',
+                        default=5,
+                        type=int)
+    parser.add_argument("--batch-size",
+                        help="The number of frames in each minibatch when training on lazy frames.",
+                        dest='batch_size',
+                        default=1024,
+                        type=int)
     parser.add_argument("--log-dir",
                         help="Directory for writing classification log files.",
                         default='../../classification_logs',
@@ -579,6 +692,14 @@ def get_cli_args():
                         dest='random_state',
                         default='1729')
     args_dict = vars(parser.parse_args())
+    if args_dict['lazy_frames']:
+        if args_dict['method'] not in seizure_modeling.INCREMENTAL_METHODS:
+            parser.error("--lazy-frames requires a method which can learn incrementally, one of {}, "
+                         "not '{}'".format(', '.join(seizure_modeling.INCREMENTAL_METHODS), args_dict['method']))
+        if args_dict['do_pca']:
+            parser.error("--lazy-frames can't be combined with --pca")
+        if args_dict['feature_type'] == 'combined':
+            parser.error("--lazy-frames isn't supported for the feature type 'combined'")
 
     ## Since we use 'None' to turn of constant seeding, we use eval here instead of just parsing the argument as an int
     args_dict['random_state'] = eval(args_dict['random_state'])
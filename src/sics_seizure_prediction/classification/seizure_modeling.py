@@ -6,16 +6,22 @@ from __future__ import print_function
 import logging
 
 import sklearn
+import sklearn.base
 import sklearn.linear_model
 import sklearn.svm
 import sklearn.ensemble
 import sklearn.metrics
+import sklearn.naive_bayes
 from sklearn import cross_validation
 from sklearn.grid_search import GridSearchCV
 import pandas as pd
 import numpy as np
 
 from ..datasets import dataset
+from ..datasets import frame_dataset
+
+#The methods whose estimators can learn incrementally with partial_fit, see train_incremental_model
+INCREMENTAL_METHODS = ('sgd', 'naive-bayes')
 
 
 def get_model_class(method):
@@ -40,6 +46,8 @@ def get_model_class(method):
         return sklearn.neighbors.KNeighborsClassifier
     elif method == 'bagging':
         return sklearn.ensemble.BaggingClassifier
+    elif method == 'naive-bayes':
+        return sklearn.naive_bayes.GaussianNB
     else:
         raise NotImplementedError("Method {} is not supported".format(method))
 
@@ -113,6 +121,10 @@ def get_model(method, training_data_x, training_data_y, model_params=None, rando
         param_grid = [{'n_estimators': [10, 20],
                        'bootstrap_features': [True, False]}]
 
+    elif method == 'naive-bayes':
+        clf = sklearn.naive_bayes.GaussianNB()
+        param_grid = {}
+
     else:
         raise NotImplementedError("Method {} is not supported".format(method))
 
@@ -148,10 +160,13 @@ def train_model(interictal,
                 cv_verbosity=2,
                 model_params=None,
                 random_state=None,
-                no_crossvalidation=False):
+                no_crossvalidation=False,
+                n_epochs=5,
+                batch_size=1024):
     """
     Trains a model on the provided data. If requested it will perform cross-validation experiments on the data
-    and report performance measurements.
+    and report performance measurements. If the data are frame_dataset.SlidingFrameDatasets, the model is trained
+    incrementally on minibatches of frames instead, see train_incremental_model.
     :param interictal: A dataframe containing the interictal data
     :param preictal: A dataframe containing the interictal data
     :param method: A String describing the method to be used. See function get_model_class for valid values.
@@ -162,11 +177,24 @@ def train_model(interictal,
     :param model_params: A dict containing the parameters to be passed to the model
     :param random_state: Seed
     :param no_crossvalidation: If True, no cross-validation will be performed. In this case, model_params should be set.
+    :param n_epochs: The number of passes over the frames when training incrementally.
+    :param batch_size: The number of frames in each minibatch when training incrementally.
     :return: A trained classfier model.
     """
     if random_state is not None:
         np.random.seed(random_state)
 
+    if isinstance(interictal, frame_dataset.SlidingFrameDataset):
+        return train_incremental_model(interictal,
+                                       preictal,
+                                       method=method,
+                                       training_ratio=training_ratio,
+                                       model_params=model_params,
+                                       random_state=random_state,
+                                       no_crossvalidation=no_crossvalidation,
+                                       n_epochs=n_epochs,
+                                       batch_size=batch_size)
+
     if no_crossvalidation:
         clf_class = get_model_class(method=method)
         clf = clf_class()
@@ -204,35 +232,117 @@ def train_model(interictal,
     return clf
 
 
-def refit_model(interictal, preictal, clf):
+def train_incremental_model(interictal,
+                            preictal,
+                            method='sgd',
+                            training_ratio=0.8,
+                            model_params=None,
+                            random_state=None,
+                            no_crossvalidation=False,
+                            n_epochs=5,
+                            batch_size=1024):
+    """
+    Trains a model incrementally on frame datasets, whose frames are only built a minibatch at a time, so models can
+    be trained on more frames than fit in memory. There is no grid search, the model is created with *model_params*.
+    Unless *no_crossvalidation* is True, the model is trained on *training_ratio* of the segments and a report of how
+    it does on the rest is logged.
+    :param interictal: A frame_dataset.SlidingFrameDataset with the interictal frames.
+    :param preictal: A frame_dataset.SlidingFrameDataset with the preictal frames.
+    :param method: The method to use, one of INCREMENTAL_METHODS.
+    :param training_ratio: The ratio of the segments to train on when reporting.
+    :param model_params: A dict with parameters for the model. The values are used as they are.
+    :param random_state: Seed
+    :param no_crossvalidation: If True, the model is trained on all frames and no report is made.
+    :param n_epochs: The number of passes over the frames.
+    :param batch_size: The number of frames in each minibatch.
+    :return: A trained classifier model.
+    """
+    if method not in INCREMENTAL_METHODS:
+        raise NotImplementedError("Method {} can't be trained incrementally, use one of {}".format(
+            method, ', '.join(INCREMENTAL_METHODS)))
+    clf = get_model_class(method)()
+    if model_params is not None:
+        clf.set_params(**model_params)
+
+    frames = frame_dataset.SlidingFrameDataset.concatenate([interictal, preictal])
+    if no_crossvalidation:
+        logging.info("Fitting {} frames to a {} model".format(len(frames), method))
+        fit_incremental(clf, frames, n_epochs=n_epochs, batch_size=batch_size, random_state=random_state)
+    else:
+        training_frames, test_frames = frames.segment_split(training_ratio=training_ratio, random_state=random_state)
+        logging.info("Shapes after splitting experiment data:")
+        logging.info("training_data: {}".format(training_frames.shape))
+        logging.info("test_data: {}".format(test_frames.shape))
+        fit_incremental(clf, training_frames, n_epochs=n_epochs, batch_size=batch_size, random_state=random_state)
+        logging.info(get_incremental_report(clf, test_frames))
+    return clf
+
+
+def fit_incremental(clf, frames, n_epochs=5, batch_size=1024, random_state=None):
+    """
+    Fits the classifier *clf* with partial_fit on shuffled minibatches of *frames*.
+
+    :param clf: The classifier to fit, which must support partial_fit.
+    :param frames: A frame_dataset.SlidingFrameDataset with labels.
+    :param n_epochs: The number of passes over the frames.
+    :param batch_size: The number of frames in each minibatch.
+    :param random_state: Seed for the order of the frames.
+    :return: None. The classifier is fit inplace.
     """
-    Fits the classifier *clf* to the given preictal and interictal data.
+    random_state = np.random.RandomState(random_state)
+    classes = np.array([0, 1])
+    for epoch in range(n_epochs):
+        for batch_x, batch_y in frames.minibatches(batch_size=batch_size, random_state=random_state):
+            clf.partial_fit(batch_x, batch_y, classes=classes)
+        logging.info("Finished epoch {} of {}".format(epoch + 1, n_epochs))
+
+
+def refit_model(interictal, preictal, clf, n_epochs=5, batch_size=1024, random_state=None):
+    """
+    Fits the classifier *clf* to the given preictal and interictal data. If the data are
+    frame_dataset.SlidingFrameDatasets, a fresh clone of the classifier is trained on all frames, since continuing the
+    training would weight the frames it was trained on twice.
 
     :param interictal: The interictal training data.
     :param preictal: The preictal training data.
     :param clf: The classifier to fit. Can be either a grid search or a classifier.
-    :return: None. The classifier is fit inplace.
+    :param n_epochs: The number of passes over the frames when training incrementally.
+    :param batch_size: The number of frames in each minibatch when training incrementally.
+    :param random_state: Seed for the order of the frames when training incrementally.
+    :return: The classifier, which is fit inplace, or the refitted clone for frame datasets.
     """
+    if isinstance(interictal, frame_dataset.SlidingFrameDataset):
+        frames = frame_dataset.SlidingFrameDataset.concatenate([interictal, preictal])
+        refitted = sklearn.base.clone(clf)
+        fit_incremental(refitted, frames, n_epochs=n_epochs, batch_size=batch_size, random_state=random_state)
+        return refitted
 
     training_data = dataset.merge_interictal_preictal(interictal, preictal)
     if hasattr(clf, 'best_estimator_'):
         clf.best_estimator_.fit(training_data.drop('Preictal', axis=1), training_data['Preictal'])
     else:
         clf.fit(training_data.drop('Preictal', axis=1), training_data['Preictal'])
+    return clf
 
 
-def predict(clf, test_data, probabilities=True):
+def predict(clf, test_data, probabilities=True, chunk_size=4096):
     """
     Returns an array of predictions for the given *test_data* using the classifier *clf*.
     If *probabilities* is True and the classifier supports it, the predictions will be Preictal probabilites.
     Otherwise, the class labels are used.
 
     :param clf: The classifier to use.
-    :param test_data: The data to predict labels for.
+    :param test_data: The data to predict labels for. Can be a frame_dataset.SlidingFrameDataset, whose frames are
+                      then predicted in chunks.
     :param probabilities: If True and the classifier supports it, the array will contain class probabilites. Otherwise
                           it will contain 0-1 class guesses.
+    :param chunk_size: The number of frames to predict at a time for a frame dataset.
     :return: An ndarray with the class predictions for the test data.
     """
+    if isinstance(test_data, frame_dataset.SlidingFrameDataset):
+        return np.concatenate([predict(clf, chunk, probabilities=probabilities)
+                               for _, chunk in test_data.chunks(chunk_size)])
+
     if probabilities and hasattr(clf, 'predict_proba'):
         predictions = clf.predict_proba(test_data)
         # The predictions from predict_proba is a k-dimensional array, with k
@@ -283,6 +393,36 @@ def get_report(clf, test_data_x, test_data_y):
     return report
 
 
+def get_incremental_report(clf, test_frames):
+    """
+    Returns a string with a report of how the incrementally trained classifier *clf* does on the test frames.
+
+    :param clf: The classifier to use for calculating the scores.
+    :param test_frames: A frame_dataset.SlidingFrameDataset with labels.
+    :return: A string containing a report on the performance of the classifier comparing the predicted class labels
+             versus the true.
+    """
+    test_frames_y_pred = predict(clf, test_frames, probabilities=False)
+
+    report_lines = [
+        "Classification report:",
+        "",
+        str(clf),
+        "",
+        "Detailed classification report:",
+        "",
+        "The model is trained incrementally on the training segments.",
+        "The scores are computed on the held-out segments.",
+        "",
+        sklearn.metrics.classification_report(test_frames.labels, test_frames_y_pred),
+        "",
+        cm_report(sklearn.metrics.confusion_matrix(test_frames.labels, test_frames_y_pred),
+                  labels=['Interictal', 'Preictal']),
+        "",
+    ]
+    return '\n'.join(report_lines)
+
+
 def grid_scores(clf):
     """
     Returns a string with the grid scores
@@ -359,14 +499,18 @@ def assign_segment_scores(test_data, clf):
     Returns a data frame with the segments of *test_data* as indices
     and the ratio of preictal guesses as a 'Preictal' column
 
-    :param test_data: A DataFrame with the unlabeled test data.
+    :param test_data: A DataFrame or frame_dataset.SlidingFrameDataset with the unlabeled test data.
     :param clf: The classifier to use for predicting scores.
     :return: A DataFrame with segments to preictal ratio. The probability is given by the columns 'Preictal'
     """
 
     predictions = predict(clf, test_data)
+    if isinstance(test_data, frame_dataset.SlidingFrameDataset):
+        index = pd.Index(test_data.segments, name='segment')
+    else:
+        index = test_data.index
     df_predictions = pd.DataFrame(predictions,
-                                  index=test_data.index,
+                                  index=index,
                                   columns=('Preictal',))
     segment_groups = df_predictions.groupby(level='segment')
     return segment_groups.mean()
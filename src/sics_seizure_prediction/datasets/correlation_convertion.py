@@ -5,10 +5,13 @@ from __future__ import absolute_import
 
 import re
 
+import numpy as np
 import pandas as pd
 
 from . import fileutils
 from . import dataset
+from . import feature_io
+from . import feature_shards
 
 
 channel_pattern = re.compile(r'(?:[a-zA-Z0-9]*_)*(c[0-9]*|[A-Z]*_[0-9]*)$')
@@ -47,17 +50,40 @@ def new_load_and_pivot(dataframe):
     return max_corrs
 
 
+def load_binary(filename):
+    """
+    Loads the maximum correlations from a binary cross-correlation feature file, see
+    cross_correlate.correlation_arrays. The arrays are memory-mapped, so no parsing or grouping is needed.
+    :param filename: The binary feature file to load, or a feature shard record reference.
+    :return: A DataFrame in the same format as new_load_and_pivot, with the window starts as index and the channel
+             pairs as columns.
+    """
+    feature_arrays = feature_shards.read_feature_arrays(filename)
+    correlations = feature_arrays['correlations']
+    if correlations.shape[1] == 1:
+        max_corrs = correlations[:, 0, :]
+    else:
+        # fmax ignores NaN like the groupby max of the csv loader does
+        max_corrs = np.fmax.reduce(correlations, axis=1)
+    index = pd.Index(feature_arrays['window_starts'], name='start_sample')
+    return pd.DataFrame(max_corrs, index=index, columns=feature_arrays.attributes['pairs'])
+
+
 def load_and_pivot(filename, frame_length=1, sliding_frames=True):
     """
     Loads the cross correlation features from the given filename.
-    :param filename: The filename to load features from.
+    :param filename: The filename to load features from. Can be a csv file in the old or new format, a binary
+                     feature file or a feature shard record reference.
     :param frame_length: The desired frame length in windows to use.
     :param sliding_frames: If True, the data will be extended by using sliding frames of the feature windows.
     :return: A DataFrame with the loaded features.
     """
 
-    with open(filename) as fp:
-        dataframe = pd.read_csv(fp, sep="\t")
+    if feature_io.is_feature_file(filename) or feature_shards.is_record_reference(filename):
+        pivoted = load_binary(filename)
+    else:
+        with open(filename) as fp:
+            dataframe = pd.read_csv(fp, sep="\t")
 
         #Figure out if this file contains the old or new format
         if 'channel_i' in dataframe.columns:
@@ -65,13 +91,42 @@ def load_and_pivot(filename, frame_length=1, sliding_frames=True):
         else:
             pivoted = new_load_and_pivot(dataframe)
 
-        if frame_length == 1:
-            return pivoted
+    if frame_length == 1:
+        return pivoted
+    else:
+        if sliding_frames:
+            return dataset.create_sliding_frames(pivoted, frame_length=frame_length)
         else:
-            if sliding_frames:
-                return dataset.create_sliding_frames(pivoted, frame_length=frame_length)
-            else:
-                return dataset.reshape_frames(pivoted, frame_length=frame_length)
+            return dataset.reshape_frames(pivoted, frame_length=frame_length)
+
+
+def correlation_file_rows(filename, frame_length=1, sliding_frames=True):
+    """
+    Returns the number of rows load_and_pivot returns for a binary feature file or shard record, from the number of
+    windows in its header. The rows of a csv file can't be told without grouping it, so None is returned for them.
+    :param filename: The feature file or shard record reference.
+    :param frame_length: The desired frame length in windows to use.
+    :param sliding_frames: If True, the rows are sliding frames of the feature windows.
+    :return: The number of rows, or None.
+    """
+    if not (feature_io.is_feature_file(filename) or feature_shards.is_record_reference(filename)):
+        return None
+    n_windows = feature_shards.read_feature_arrays(filename)['window_starts'].shape[0]
+    if frame_length == 1:
+        return n_windows
+    if sliding_frames:
+        return max(n_windows - (frame_length - 1), 0)
+    return n_windows // frame_length
+# Lets dataset.load_files_bulk preallocate the rows of all files
+load_and_pivot.row_count = correlation_file_rows
+
+
+def find_correlation_files(feature_folder, class_name, file_pattern="*segment*.csv"):
+    """
+    Collects the cross-correlation feature files of *feature_folder*, both csv and binary files. See
+    fileutils.find_binary_or_csv_files.
+    """
+    return fileutils.find_binary_or_csv_files(feature_folder, class_name, file_pattern=file_pattern)
 
 
 def load_data_frames(feature_folder,
@@ -84,5 +139,5 @@ def load_data_frames(feature_folder,
     """
     return dataset.load_data_frames(feature_folder,
                                     load_function=load_and_pivot,
-                                    find_features_function=fileutils.find_feature_files,
+                                    find_features_function=find_correlation_files,
                                     **kwargs)
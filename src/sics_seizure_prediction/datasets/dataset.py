@@ -3,8 +3,15 @@ from __future__ import absolute_import
 import random
 import os
 import os.path
+import hashlib
+import inspect
+import json
 import logging
 import multiprocessing
+import multiprocessing.pool
+import shutil
+import sys
+import threading
 from functools import partial
 
 import pandas as pd
@@ -13,6 +20,17 @@ from sklearn import cross_validation, preprocessing
 from sklearn.decomposition import PCA
 
 from . import fileutils
+from . import feature_shards
+from . import worker_pool
+
+#The version of the cache manifest format, caches with another version are rebuilt
+CACHE_MANIFEST_VERSION = 3
+
+#The extension of the feature cache directories, see write_frame_cache
+CACHE_EXTENSION = '.arrays'
+
+#The name of the label column, which is stored apart from the feature matrix in the feature cache
+LABEL_COLUMN = 'Preictal'
 
 
 def first(iterable):
@@ -372,15 +390,11 @@ def load_preictal_dataframes(feature_folder, sliding_frames=False, **kwargs):
     :param kwargs: keyword arguments to use for loading the features.
     :return: A DataFrame of preictal data with a 'Preictal' column set to 1.
     """
-    preictal = load_feature_files(feature_folder,
-                                  class_name="preictal",
-                                  sliding_frames=sliding_frames,
-                                  **kwargs)
-    preictal['Preictal'] = 1
-    preictal.sortlevel('segment', inplace=True)
-    if isinstance(preictal.columns, pd.MultiIndex):
-        preictal.sortlevel(axis=1, inplace=True)
-    return preictal
+    return load_feature_files(feature_folder,
+                              class_name="preictal",
+                              sliding_frames=sliding_frames,
+                              label=1,
+                              **kwargs)
 
 
 def load_interictal_dataframes(feature_folder, sliding_frames=False, **kwargs):
@@ -391,16 +405,11 @@ def load_interictal_dataframes(feature_folder, sliding_frames=False, **kwargs):
     :param kwargs: keyword arguments to use for loading the features.
     :return: A DataFrame of interictal data with a 'Preictal' column set to 0.
     """
-
-    interictal = load_feature_files(feature_folder,
-                                    class_name="preictal",
-                                    sliding_frames=sliding_frames,
-                                    **kwargs)
-    interictal['Preictal'] = 0
-    interictal.sortlevel('segment', inplace=True)
-    if isinstance(interictal.columns, pd.MultiIndex):
-        interictal.sortlevel(axis=1, inplace=True)
-    return interictal
+    return load_feature_files(feature_folder,
+                              class_name="preictal",
+                              sliding_frames=sliding_frames,
+                              label=0,
+                              **kwargs)
 
 
 def load_test_dataframes(feature_folder, **kwargs):
@@ -411,15 +420,11 @@ def load_test_dataframes(feature_folder, **kwargs):
     :param kwargs: keyword arguments to use for loading the features.
     :return: A DataFrame of unlabeled test data without a 'Preictal' column.
     """
-    test = load_feature_files(feature_folder,
+    return load_feature_files(feature_folder,
                               class_name="test",
                               # Never use sliding frames for the test-data
                               sliding_frames=False,
                               **kwargs)
-    test.sortlevel('segment', inplace=True)
-    if isinstance(test.columns, pd.MultiIndex):
-        test.sortlevel(axis=1, inplace=True)
-    return test
 
 
 def load_feature_files(feature_folder,
@@ -431,7 +436,8 @@ def load_feature_files(feature_folder,
                        sliding_frames=False,
                        processes=1,
                        output_folder=None,
-                       file_pattern="*segment*.csv"):
+                       file_pattern="*segment*.csv",
+                       label=None):
     """
     Loads all the files matching the class name and patter from the given feature folder.
     :param feature_folder: A folder containing files to load.
@@ -448,13 +454,46 @@ def load_feature_files(feature_folder,
     :param processes: The number of processes to use for parallel loading of feature files.
     :param output_folder: The file to save the concatenated feature data frame caches to.
     :param file_pattern: A pattern which will be used to select what files to load as features.
+    :param label: If not None, the frame gets a label column with this value, see LABEL_COLUMN.
     :return: A pandas dataframe where all the features loaded from feature folder with the given class are
              concatenated. The index will have a level called 'segment' with the segment name for the feature frames.
+             The rows are sorted by segment and the columns are sorted if they are a MultiIndex, with the label
+             column last.
+
+    The cache is a directory of arrays which are memory mapped when it's loaded, see write_frame_cache, so the frame
+    is opened without reading it and processes loading the same cache share its pages. The cache has a manifest with
+    the paths, sizes and modification times of the feature files of every segment,
+    the identity of the load function and the loading parameters, see cache_manifest_path. If the load function or the
+    parameters have changed, the cache is rebuilt. Otherwise only the segments whose feature files are new or have
+    changed are loaded, and their rows replace the cached ones. The rows of segments without feature files are
+    removed. If no feature files are found at all, the cache is used as it is.
+
+    With sliding frames only the windows are loaded and cached, as for a frame length of 1, and the frames are built
+    from them when the cache has been loaded, see sliding_frames_from_windows. The frames are *frame_length* times
+    larger than the windows, so they are never written to the cache.
+
+    The label column is part of the cache and the cached frame is sorted, so that the memory mapped features are
+    returned without being copied, see label_frame.
     """
+    if sliding_frames:
+        window_frame = load_feature_files(feature_folder,
+                                          class_name,
+                                          load_function=load_function,
+                                          find_features_function=find_features_function,
+                                          rebuild_data=rebuild_data,
+                                          frame_length=1,
+                                          sliding_frames=False,
+                                          processes=processes,
+                                          output_folder=output_folder,
+                                          file_pattern=file_pattern)
+        return label_frame(sliding_frames_from_windows(window_frame, frame_length=frame_length), label)
+
+    name_components = [class_name, 'frame_length_{}'.format(frame_length)]
+    if label is not None:
+        name_components.append('label_{}'.format(label))
     cache_file_basename = fileutils.generate_filename('cache',
-                                                      '.pickle',
-                                                      [class_name,
-                                                       'frame_length_{}'.format(frame_length)],
+                                                      CACHE_EXTENSION,
+                                                      name_components,
                                                       dict(sliding_frames=sliding_frames))
     if output_folder is None:
         output_folder = feature_folder
@@ -464,24 +503,257 @@ def load_feature_files(feature_folder,
 
     cache_file = os.path.join(output_folder, cache_file_basename)
 
-    if rebuild_data or not os.path.exists(cache_file):
+    feature_files = find_features_function(feature_folder,
+                                           class_name=class_name,
+                                           file_pattern=file_pattern)
+    if not feature_files and not rebuild_data and os.path.exists(cache_file):
+        logging.warning("No {} feature files found in {}, using the cache file {} "
+                        "without checking it".format(class_name, feature_folder, cache_file))
+        return read_frame_cache(cache_file)
+
+    manifest = dict(version=CACHE_MANIFEST_VERSION,
+                    loader=function_identity(load_function),
+                    parameters=dict(class_name=class_name,
+                                    frame_length=frame_length,
+                                    sliding_frames=sliding_frames,
+                                    label=label,
+                                    file_pattern=file_pattern,
+                                    find_features_function=function_identity(find_features_function)),
+                    segments=segment_signatures(feature_files))
+    cached_manifest = read_cache_manifest(cache_file) if not rebuild_data else None
+
+    if (cached_manifest is None or not os.path.exists(cache_file) or
+            any(cached_manifest.get(key) != manifest[key] for key in ('version', 'loader', 'parameters'))):
         logging.info("Rebuilding {} data from {}".format(class_name, feature_folder))
-
-        feature_files = find_features_function(feature_folder,
-                                               class_name=class_name,
-                                               file_pattern=file_pattern)
         complete_frame = rebuild_features(feature_files,
                                           load_function,
                                           processes=processes,
                                           frame_length=frame_length,
                                           sliding_frames=sliding_frames)
-        complete_frame.to_pickle(cache_file)
-    else:
-        logging.info("Loading {} data from "
-                     "cache file {}".format(class_name,
-                                            cache_file))
-        complete_frame = pd.read_pickle(cache_file)
+        complete_frame = label_frame(complete_frame, label)
+        write_cache(complete_frame, cache_file, manifest)
+        return complete_frame
+
+    logging.info("Loading {} data from "
+                 "cache file {}".format(class_name,
+                                        cache_file))
+    complete_frame = read_frame_cache(cache_file)
+
+    cached_segments = cached_manifest['segments']
+    changed = [feature for feature in feature_files
+               if cached_segments.get(feature['segment']) != manifest['segments'][feature['segment']]]
+    removed = [segment for segment in cached_segments if segment not in manifest['segments']]
+    if not changed and not removed:
+        return complete_frame
+
+    logging.info("Updating the {} cache: {} new or changed and {} removed "
+                 "segments".format(class_name, len(changed), len(removed)))
+    stale_segments = [feature['segment'] for feature in changed if feature['segment'] in cached_segments] + removed
+    if stale_segments:
+        complete_frame = complete_frame.drop(stale_segments, level='segment')
+    if changed:
+        changed_frame = rebuild_features(changed,
+                                         load_function,
+                                         processes=processes,
+                                         frame_length=frame_length,
+                                         sliding_frames=sliding_frames)
+        complete_frame = pd.concat([complete_frame, label_frame(changed_frame, label)])
+        complete_frame.sortlevel('segment', inplace=True)
+    write_cache(complete_frame, cache_file, manifest)
+    return complete_frame
 
+
+def label_frame(complete_frame, label):
+    """
+    Sorts the columns of a feature frame if they are a MultiIndex and adds the label column, if *label* isn't None,
+    see load_feature_files.
+
+    :param complete_frame: A DataFrame of features, without a label column.
+    :param label: The value of the label column, or None.
+    :return: The frame, which is modified in place.
+    """
+    if isinstance(complete_frame.columns, pd.MultiIndex):
+        complete_frame.sortlevel(axis=1, inplace=True)
+    if label is not None:
+        complete_frame[LABEL_COLUMN] = label
+    return complete_frame
+
+
+def function_identity(function):
+    """
+    Returns a JSON serializable identity of a function for the cache manifest: its module and name, the keyword
+    arguments if it's a functools.partial, and a checksum of the source of its module. The checksums are cached per
+    module.
+    """
+    if function is None:
+        return None
+    keywords = None
+    if isinstance(function, partial):
+        keywords = dict((key, repr(value)) for key, value in sorted(function.keywords.items()))
+        function = function.func
+    module = sys.modules.get(getattr(function, '__module__', None))
+    if not hasattr(function_identity, 'checksums'):
+        function_identity.checksums = dict()
+    if module is not None and module.__name__ not in function_identity.checksums:
+        try:
+            with open(inspect.getsourcefile(module) or module.__file__, 'rb') as fp:
+                function_identity.checksums[module.__name__] = hashlib.sha1(fp.read()).hexdigest()
+        except (TypeError, IOError, OSError):
+            function_identity.checksums[module.__name__] = None
+    name = getattr(function, '__name__', repr(function))
+    return dict(name="{}.{}".format(getattr(function, '__module__', None), name),
+                keywords=keywords,
+                checksum=function_identity.checksums.get(module.__name__) if module is not None else None)
+
+
+def segment_signatures(feature_file_dicts):
+    """
+    Returns the signatures of the feature files of every segment, for telling which segments changed since the cache
+    was written.
+
+    :param feature_file_dicts: A list of dictionaries with the keys 'segment' and 'files', see rebuild_features.
+    :return: A dictionary of segment names to lists of [path, size, modification time] of their feature files. The
+             signature of a feature shard record is the one of its shard, so every new record in a shard invalidates
+             the other segments of the shard too.
+    """
+    signatures = dict()
+    for feature in feature_file_dicts:
+        files = feature['files']
+        if not isinstance(files, (list, tuple)):
+            files = [files]
+        signature = []
+        for path in files:
+            if feature_shards.is_record_reference(path):
+                path = path.rsplit(feature_shards.RECORD_SEPARATOR, 1)[0]
+            stat = os.stat(path)
+            signature.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+        signatures[feature['segment']] = signature
+    return signatures
+
+
+def cache_manifest_path(cache_file):
+    """Returns the path of the manifest of a cache file."""
+    return cache_file + '.manifest.json'
+
+
+def read_cache_manifest(cache_file):
+    """Returns the manifest of a cache file, or None if it has none."""
+    try:
+        with open(cache_manifest_path(cache_file)) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_cache(complete_frame, cache_file, manifest):
+    """
+    Writes a cache file and its manifest. The old manifest is removed first and the new one written last, so a cache
+    whose writing was interrupted has no manifest and is rebuilt.
+    """
+    manifest_file = cache_manifest_path(cache_file)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    temporary_cache = "{}.{}.tmp".format(cache_file, os.getpid())
+    write_frame_cache(complete_frame, temporary_cache)
+    if os.path.isdir(cache_file):
+        shutil.rmtree(cache_file)
+    os.rename(temporary_cache, cache_file)
+    temporary_manifest = "{}.{}.tmp".format(manifest_file, os.getpid())
+    with open(temporary_manifest, 'w') as fp:
+        json.dump(manifest, fp, sort_keys=True)
+    os.rename(temporary_manifest, manifest_file)
+
+
+def write_frame_cache(complete_frame, cache_dir):
+    """
+    Writes a feature frame as a directory of arrays which can be memory mapped:
+
+        values.npy          The features as a C-contiguous (rows x features) float64 matrix
+        labels.npy          The label column, if the frame has one, see LABEL_COLUMN
+        index_codes_<i>.npy The codes of the values of index level i, as int32 (usually the segment and frame levels)
+        layout.json         The values of the index levels, the index names and the columns
+
+    :param complete_frame: A DataFrame of numeric features.
+    :param cache_dir: The directory to write to. It's created and must not exist.
+    :return: None.
+    """
+    os.makedirs(cache_dir)
+    features = complete_frame
+    has_labels = LABEL_COLUMN in complete_frame.columns
+    if has_labels:
+        # With MultiIndex columns the label column is a frame of a single column
+        np.save(os.path.join(cache_dir, 'labels.npy'), np.ravel(complete_frame[LABEL_COLUMN].values))
+        features = complete_frame.drop(LABEL_COLUMN, axis=1)
+    np.save(os.path.join(cache_dir, 'values.npy'), np.ascontiguousarray(features.values, dtype=np.float64))
+
+    index_levels = []
+    for level in range(complete_frame.index.nlevels):
+        codes, uniques = pd.factorize(complete_frame.index.get_level_values(level))
+        np.save(os.path.join(cache_dir, 'index_codes_{}.npy'.format(level)), codes.astype(np.int32))
+        index_levels.append([json_value(value) for value in uniques])
+    layout = dict(index_levels=index_levels,
+                  index_names=list(complete_frame.index.names),
+                  columns=[json_value(column) for column in features.columns],
+                  column_names=list(features.columns.names),
+                  has_labels=has_labels)
+    with open(os.path.join(cache_dir, 'layout.json'), 'w') as fp:
+        json.dump(layout, fp)
+
+
+def json_value(value):
+    """Converts an index value to a JSON serializable value, tuples of a MultiIndex become lists."""
+    if isinstance(value, tuple):
+        return [json_value(item) for item in value]
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+def read_cache_arrays(cache_dir, mmap_mode='r'):
+    """
+    Opens the arrays of a feature cache written by write_frame_cache, without building a DataFrame.
+
+    :param cache_dir: The cache directory.
+    :param mmap_mode: The mode to memory map the arrays with, see numpy.load. If None, the arrays are read.
+    :return: A dictionary with the keys 'values' (rows x features), 'labels' (None if the frame had no labels),
+             'index_codes' (a list of arrays, one per index level), and the keys of the layout: 'index_levels',
+             'index_names', 'columns', 'column_names' and 'has_labels'.
+    """
+    with open(os.path.join(cache_dir, 'layout.json')) as fp:
+        arrays = json.load(fp)
+    arrays['values'] = np.load(os.path.join(cache_dir, 'values.npy'), mmap_mode=mmap_mode)
+    arrays['labels'] = (np.load(os.path.join(cache_dir, 'labels.npy'), mmap_mode=mmap_mode)
+                        if arrays['has_labels'] else None)
+    arrays['index_codes'] = [np.load(os.path.join(cache_dir, 'index_codes_{}.npy'.format(level)), mmap_mode=mmap_mode)
+                             for level in range(len(arrays['index_levels']))]
+    return arrays
+
+
+def read_frame_cache(cache_dir, mmap_mode='r'):
+    """
+    Loads a feature frame written by write_frame_cache. The features of the frame are backed by the memory mapped
+    matrix, so they aren't read until they are used and are shared with other processes which load the same cache.
+    Operations which modify the frame make a private copy.
+
+    :param cache_dir: The cache directory.
+    :param mmap_mode: The mode to memory map the arrays with, see numpy.load.
+    :return: A DataFrame equal to the one which was written.
+    """
+    arrays = read_cache_arrays(cache_dir, mmap_mode=mmap_mode)
+    level_values = [np.asarray(levels)[codes] for codes, levels in zip(arrays['index_codes'], arrays['index_levels'])]
+    if len(level_values) > 1:
+        index = pd.MultiIndex.from_arrays(level_values, names=arrays['index_names'])
+    else:
+        index = pd.Index(level_values[0], name=arrays['index_names'][0])
+    if len(arrays['column_names']) > 1:
+        columns = pd.MultiIndex.from_tuples([tuple(column) for column in arrays['columns']],
+                                            names=arrays['column_names'])
+    else:
+        columns = pd.Index(arrays['columns'], name=arrays['column_names'][0])
+    complete_frame = pd.DataFrame(arrays['values'], index=index, columns=columns, copy=False)
+    if arrays['labels'] is not None:
+        complete_frame[LABEL_COLUMN] = arrays['labels']
     return complete_frame
 
 
@@ -499,7 +771,8 @@ def rebuild_features(feature_file_dicts,
         'files'. Segment should be the name of the segment which is loaded, while 'files' should be the argument to
         *load_function*, typically a single or multiple filenames.
     :param load_function: Function to use for loading the feature files.
-    :param processes: The number of processes to use for rebuilding the features
+    :param processes: The number of processes to use for rebuilding the features, or the number of threads if the
+        files are loaded by load_files_bulk.
     :param frame_length: The length of the a frame, in number of windows.
     :param sliding_frames: If True, the feature-vectors will be produced by a sliding frame over all the windows of
         each feature file.
@@ -507,24 +780,33 @@ def rebuild_features(feature_file_dicts,
     segment names and the frame number of the feature frames.
     """
 
-    tupled = [(feature['segment'], feature['files']) for feature in feature_file_dicts]
-    segment_names, feature_files = zip(*tupled)
-
-    if processes > 1:
-        segment_frames = load_files_parallel(feature_files,
-                                             load_function=load_function,
-                                             processes=processes,
-                                             frame_length=frame_length,
-                                             sliding_frames=sliding_frames)
-    else:
-        segment_frames = load_files_serial(feature_files,
-                                           load_function=load_function,
-                                           frame_length=frame_length,
-                                           sliding_frames=sliding_frames)
+    complete_frame = None
+    if getattr(load_function, 'row_count', None) is not None:
+        complete_frame = load_files_bulk(feature_file_dicts,
+                                         load_function=load_function,
+                                         threads=processes,
+                                         frame_length=frame_length,
+                                         sliding_frames=sliding_frames)
+
+    if complete_frame is None:
+        tupled = [(feature['segment'], feature['files']) for feature in feature_file_dicts]
+        segment_names, feature_files = zip(*tupled)
+
+        if processes > 1:
+            segment_frames = load_files_parallel(feature_files,
+                                                 load_function=load_function,
+                                                 processes=processes,
+                                                 frame_length=frame_length,
+                                                 sliding_frames=sliding_frames)
+        else:
+            segment_frames = load_files_serial(feature_files,
+                                               load_function=load_function,
+                                               frame_length=frame_length,
+                                               sliding_frames=sliding_frames)
 
-    complete_frame = pd.concat(segment_frames,
-                               names=('segment', 'frame'),
-                               keys=segment_names)
+        complete_frame = pd.concat(segment_frames,
+                                   names=('segment', 'frame'),
+                                   keys=segment_names)
 
     complete_frame.sortlevel('segment', inplace=True)
     if np.count_nonzero(np.isnan(complete_frame)) != 0:
@@ -534,21 +816,86 @@ def rebuild_features(feature_file_dicts,
     return complete_frame
 
 
-def load_files_parallel(feature_files, load_function, processes, **kwargs):
+def load_files_bulk(feature_file_dicts, load_function, threads=1, **kwargs):
+    """
+    Loads feature files into a single preallocated frame, using threads. The load function must have a *row_count*
+    attribute, a function which takes the same arguments and returns the number of rows the load function will return
+    for a file, or None if it can't tell without loading it. The rows of every file are copied into their place in the
+    feature matrix as soon as the file is loaded, so only the matrix and the files being loaded are held in memory.
+    The threads share the memory of the process, so nothing is pickled, and the parsers of pandas and numpy release
+    the GIL while they work.
+
+    :param feature_file_dicts: A list of dictionaries with the keys 'segment' and 'files', see rebuild_features.
+    :param load_function: The function to use for loading a feature file, which returns a DataFrame.
+    :param threads: The number of threads to load the files with.
+    :param kwargs: Keyword arguments for the load function and its row count function.
+    :return: A DataFrame like the one rebuild_features concatenates, with the index levels 'segment' and 'frame', or
+             None if the row count of a file isn't known.
+    """
+    segment_names = [feature['segment'] for feature in feature_file_dicts]
+    feature_files = [feature['files'] for feature in feature_file_dicts]
+    pool = multiprocessing.pool.ThreadPool(max(threads, 1))
+    try:
+        row_counts = pool.map(lambda files: load_function.row_count(files, **kwargs), feature_files)
+        if any(count is None for count in row_counts):
+            return None
+        offsets = np.concatenate(([0], np.cumsum(row_counts))).astype(np.int64)
+
+        # The matrix is allocated when the first file tells the number of columns
+        matrix = dict(values=None, columns=None)
+        allocation_lock = threading.Lock()
+
+        def load_into_matrix(i):
+            frame = load_function(feature_files[i], **kwargs)
+            if len(frame) != row_counts[i]:
+                raise ValueError("{} has {} rows, but {} were counted".format(feature_files[i], len(frame),
+                                                                              row_counts[i]))
+            with allocation_lock:
+                if matrix['values'] is None:
+                    matrix['values'] = np.empty((offsets[-1], frame.shape[1]), dtype=np.float64)
+                    matrix['columns'] = frame.columns
+            if not frame.columns.equals(matrix['columns']):
+                if len(frame.columns) != len(matrix['columns']) or not frame.columns.isin(matrix['columns']).all():
+                    raise ValueError("The columns of {} differ from the columns of the other "
+                                     "feature files".format(feature_files[i]))
+                frame = frame[matrix['columns']]
+            matrix['values'][offsets[i]:offsets[i + 1]] = frame.values
+            return frame.index.values
+
+        logging.info("Reading files in bulk with {} threads".format(threads))
+        frame_indices = pool.map(load_into_matrix, range(len(feature_files)))
+    finally:
+        pool.close()
+        pool.join()
+
+    index = pd.MultiIndex.from_arrays([np.repeat(np.asarray(segment_names, dtype=object), row_counts),
+                                       np.concatenate(frame_indices)],
+                                      names=('segment', 'frame'))
+    return pd.DataFrame(matrix['values'], index=index, columns=matrix['columns'], copy=False)
+
+
+def load_files_parallel(feature_files, load_function, processes, pool=None, **kwargs):
     """
     Function for loading feature files in parallel.
     :param feature_files: The collection of files to load.
     :param load_function: The function used to load the objects.
     :param processes: The number of processes to use for loading the feature files.
+    :param pool: A persistent worker_pool.WorkerPool to load the files in. Defaults to the pool opened by
+                 worker_pool.shared_pool, if any, otherwise a pool of *processes* processes is created for the call.
     :param kwargs: Keyword arguments which will be sent to the load function.
     :return: A list of loaded feature data frames or numpy arrays.
     """
     logging.info("Reading files in parallel")
+    #Create a partial function with the keyword arguments set. This is done since the parallel map from
+    # multiprocessing expects a function which takes a single argument.
+    partial_load_and_pivot = partial(load_function, **kwargs)
+    if pool is None:
+        pool = worker_pool.current_pool()
+    if pool is not None:
+        return pool.map(partial_load_and_pivot, feature_files)
+
     pool = multiprocessing.Pool(processes)
     try:
-        #Create a partial function with the keyword arguments set. This is done since the parallel map from
-        # multiprocessing expects a function which takes a single argument.
-        partial_load_and_pivot = partial(load_function, **kwargs)
         segment_frames = pool.map(partial_load_and_pivot, feature_files)
     finally:
         pool.close()
@@ -604,13 +951,14 @@ def reshape_frames(dataframe, frame_length=12):
 def create_sliding_frames(dataframe, frame_length=12):
     """
     Wrapper for the extend_data_with_sliding_frames function which works with numpy arrays.
-    This version does the data-frame conversion for us.
+    This version does the data-frame conversion for us. The returned frame is backed by a read-only view of the
+    windows, see extend_data_with_sliding_frames.
 
     :param dataframe: The dataframe to extend.
     :param frame_length: The frame length to use in the resulting extended data frame.
     :return: A new data frame where the original dataframe has been extended with sliding frames.
     """
-    extended_array = extend_data_with_sliding_frames(dataframe.values)
+    extended_array = extend_data_with_sliding_frames(dataframe.values, frame_length=frame_length)
     # We should preserve the columns of the dataframe, otherwise
     # concatenating different dataframes along the row-axis will give
     # wrong results
@@ -619,31 +967,84 @@ def create_sliding_frames(dataframe, frame_length=12):
                                                window_columns],
                                               names=['window', 'feature'])
     return pd.DataFrame(data=extended_array,
-                        columns=column_index)
+                        columns=column_index,
+                        copy=False)
+
+
+def sliding_frames_from_windows(window_frame, frame_length=12):
+    """
+    Builds the sliding frames of every segment of a frame of windows, like the ones load_feature_files returns for
+    a frame length of 1. The frames of a segment are copied from a view of its windows, see
+    extend_data_with_sliding_frames, straight into the frame matrix, which is the only allocation.
+
+    :param window_frame: A DataFrame with one window per row and the index levels 'segment' and 'frame', where the
+                         windows of a segment are consecutive rows.
+    :param frame_length: The number of windows in a frame.
+    :return: A DataFrame of frames with the index levels 'segment' and 'frame', where 'frame' numbers the frames of
+             each segment, and the columns of create_sliding_frames.
+    """
+    windows = window_frame.values
+    segment_values = window_frame.index.get_level_values('segment').values
+    boundaries = np.flatnonzero(segment_values[1:] != segment_values[:-1]) + 1
+    segment_starts = np.concatenate(([0], boundaries)).astype(np.int64)[:len(segment_values)]
+    segment_ends = np.concatenate((boundaries, [len(segment_values)])).astype(np.int64)[:len(segment_values)]
+    frame_counts = np.maximum(segment_ends - segment_starts - (frame_length - 1), 0)
+    frame_offsets = np.concatenate(([0], np.cumsum(frame_counts))).astype(np.int64)
+
+    frames = np.empty((frame_offsets[-1], windows.shape[1] * frame_length), dtype=windows.dtype)
+    for start, end, offset, n_frames in zip(segment_starts, segment_ends, frame_offsets, frame_counts):
+        if n_frames:
+            frames[offset:offset + n_frames] = extend_data_with_sliding_frames(windows[start:end],
+                                                                               frame_length=frame_length)
+
+    index = pd.MultiIndex.from_arrays([np.repeat(segment_values[segment_starts], frame_counts),
+                                       np.concatenate([np.arange(n_frames) for n_frames in frame_counts] +
+                                                      [np.zeros(0, dtype=np.int64)])],
+                                      names=('segment', 'frame'))
+    columns = pd.MultiIndex.from_product([range(frame_length), window_frame.columns], names=['window', 'feature'])
+    return pd.DataFrame(frames, index=index, columns=columns, copy=False)
 
 
 def extend_data_with_sliding_frames(source_array, frame_length=12):
     """
-    Creates an array of frames from the given array of windows using a sliding window.
+    Creates an array of frames from the given array of windows using a sliding window. The frames are a read-only
+    view of the windows, where consecutive frames share all but one window, so no memory is used for them. Use
+    iter_sliding_frames to materialise them chunk by chunk, or numpy.array on the view for a writable copy.
     :param source_array: a numpy array with the shape (n_windows, window_length)
     :param frame_length: The desired window length of the frames.
-    :return: A new numpy ndarray extended by taking sliding frames of the source array.
+    :return: A read-only ndarray view with the shape (n_windows - frame_length + 1, window_length*frame_length).
     """
-
+    # The windows of a frame must follow each other in memory for a frame to be a single row of the view
+    source_array = np.ascontiguousarray(source_array)
     n_rows = source_array.shape[0]
     window_size = source_array.shape[1]
 
     # Number of frames that we can generate
-    n_sliding_frames = n_rows-(frame_length-1)
+    n_sliding_frames = max(n_rows-(frame_length-1), 0)
     # The column size of our new frames
     frame_size = window_size*frame_length
 
-    dest_array = np.zeros((n_sliding_frames, frame_size), dtype=np.float64)
+    row_stride, column_stride = source_array.strides
+    view = np.lib.stride_tricks.as_strided(source_array,
+                                           shape=(n_sliding_frames, frame_size),
+                                           strides=(row_stride, column_stride))
+    view.flags.writeable = False
+    return view
 
-    for i in range(0, n_sliding_frames):
-        dest_array[i] = source_array[i:i+frame_length].reshape(1, frame_size)
 
-    return dest_array
+def iter_sliding_frames(source_array, frame_length=12, chunk_size=4096):
+    """
+    Materialises the sliding frames of an array of windows in chunks, for consumers which need the frames as
+    contiguous arrays but shouldn't hold all of them at once.
+    :param source_array: a numpy array with the shape (n_windows, window_length)
+    :param frame_length: The desired window length of the frames.
+    :param chunk_size: The number of frames in each chunk.
+    :return: A generator of (first frame, chunk) tuples, where the chunks are writable
+             (frames x window_length*frame_length) arrays.
+    """
+    frames = extend_data_with_sliding_frames(source_array, frame_length=frame_length)
+    for start in range(0, frames.shape[0], chunk_size):
+        yield start, np.array(frames[start:start + chunk_size])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,300 @@
+"""
+Module for reading and writing features as binary arrays.
+
+A feature file holds a number of named arrays together with a header describing them, so that it can be read without
+knowing anything about the extractor which wrote it. The layout is:
+
+    MAGIC (8 bytes) | header length (8 bytes, little endian) | JSON header | padding | array data | ...
+
+The header is a JSON object with the keys 'version', 'attributes' and 'arrays'. 'attributes' is a dictionary of JSON
+values given by the writer, 'arrays' is a list of dictionaries with the keys 'name', 'dtype', 'shape' and 'offset',
+where offset is the position of the array data from the start of the file. The array data is stored in C order and
+aligned to ARRAY_ALIGNMENT bytes, which makes it possible to memory-map the arrays directly.
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'SICSFEAT'
+VERSION = 1
+ARRAY_ALIGNMENT = 64
+
+#The file extension used for binary feature files
+FEATURE_FILE_EXTENSION = '.fbin'
+
+
+class FeatureArrays(object):
+    """
+    A collection of named arrays with attributes, which can be written as a binary feature file. Extractor functions
+    can return a FeatureArrays object instead of rows, in which case feature_extractor.write_features will write it in
+    the binary format.
+    """
+    def __init__(self, arrays, attributes=None):
+        """
+        :param arrays: A dictionary of array names to ndarrays. The order of an OrderedDict is kept in the file.
+        :param attributes: A dictionary of JSON serializable values describing the arrays.
+        """
+        self.arrays = OrderedDict(arrays)
+        self.attributes = dict(attributes) if attributes is not None else dict()
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    @classmethod
+    def from_frames(cls, frames, attributes=None, dtype=np.float64):
+        """
+        Creates a FeatureArrays object with a single (frames x features) array named 'frames', from a feature
+        dictionary of frame indices to lists of feature values, like the ones returned by the wavelet and Hills
+        extractors. Frames with fewer values than the longest one are padded with NaN, the same as when the csv file
+        of the dictionary is read with pandas.
+
+        :param frames: A dictionary of frame indices to lists of feature values.
+        :param attributes: A dictionary of JSON serializable values describing the features.
+        :param dtype: The dtype of the array.
+        :return: A FeatureArrays object.
+        """
+        rows = [values for index, values in sorted(frames.items())]
+        width = max([len(values) for values in rows]) if rows else 0
+        array = np.full((len(rows), width), np.nan, dtype=dtype)
+        for row, values in zip(array, rows):
+            row[:len(values)] = values
+        return cls(OrderedDict(frames=array), attributes)
+
+    def write(self, path):
+        """
+        Writes the arrays to the feature file *path*.
+
+        :param path: The path to write to.
+        :return: None.
+        """
+        write_arrays(path, self.arrays, self.attributes)
+
+
+class StreamedFeatureArrays(object):
+    """
+    A feature file where some of the arrays are filled in incrementally while the file is written, which keeps the
+    memory use bounded regardless of the size of the arrays. Like FeatureArrays, it is written by
+    feature_extractor.write_features.
+    """
+    def __init__(self, arrays, streamed_arrays, chunks, attributes=None):
+        """
+        :param arrays: A dictionary of array names to ndarrays which are written as is.
+        :param streamed_arrays: A dictionary of array names to (shape, dtype, fill_value) triples for the arrays which
+                                are filled in from *chunks*. Elements which no chunk is given for keep fill_value.
+        :param chunks: An iterable of (array_name, index, values) triples. The values are assigned to
+                       array[index] of the named streamed array. The iterable is consumed when the file is written.
+        :param attributes: A dictionary of JSON serializable values describing the arrays.
+        """
+        self.arrays = OrderedDict(arrays)
+        self.streamed_arrays = OrderedDict(streamed_arrays)
+        self.chunks = chunks
+        self.attributes = dict(attributes) if attributes is not None else dict()
+
+    def write(self, path):
+        """
+        Writes the feature file *path*, consuming the chunks.
+
+        :param path: The path to write to.
+        :return: None.
+        """
+        specs = OrderedDict((name, (array.shape, array.dtype)) for name, array in self.arrays.items())
+        specs.update((name, (shape, dtype)) for name, (shape, dtype, _) in self.streamed_arrays.items())
+        file_arrays = create_arrays(path, specs, self.attributes)
+
+        for name, array in self.arrays.items():
+            file_arrays[name][...] = array
+        for name, (_, _, fill_value) in self.streamed_arrays.items():
+            file_arrays[name][...] = fill_value
+        for name, index, values in self.chunks:
+            file_arrays[name][index] = values
+
+        for file_array in file_arrays.values():
+            if isinstance(file_array, np.memmap):
+                file_array.flush()
+
+
+def align(offset, alignment=ARRAY_ALIGNMENT):
+    """Returns the smallest multiple of *alignment* which is greater or equal to *offset*."""
+    return -(-offset // alignment) * alignment
+
+
+def file_layout(specs, attributes):
+    """
+    Calculates the layout of a feature file.
+
+    :param specs: A dictionary of array names to (shape, dtype) pairs.
+    :param attributes: A dictionary of JSON serializable values which will be stored in the header.
+    :return: A triple (encoded_header, array_specs, file_size), where encoded_header is the bytes of the file up to
+             the end of the header, array_specs is the list of array dictionaries of the header and file_size is the
+             total size of the file.
+    """
+    # The offsets depend on the length of the header, which in turn depends on the offsets. We reserve room for the
+    # header by first encoding it with placeholder offsets of the largest possible width.
+    array_specs = [dict(name=name, dtype=np.dtype(dtype).str, shape=[int(n) for n in shape], offset=2**63 - 1)
+                   for name, (shape, dtype) in specs.items()]
+    header = dict(version=VERSION, attributes=attributes, arrays=array_specs)
+    header_length = len(json.dumps(header).encode('utf-8'))
+
+    offset = align(len(MAGIC) + 8 + header_length)
+    file_size = offset
+    for spec in array_specs:
+        spec['offset'] = offset
+        file_size = offset + int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize
+        offset = align(file_size)
+
+    # The real offsets are never longer than the placeholders, the header is padded with spaces to the reserved length
+    encoded_header = json.dumps(header).encode('utf-8')
+    encoded_header += b' ' * (header_length - len(encoded_header))
+    return MAGIC + struct.pack('<Q', header_length) + encoded_header, array_specs, file_size
+
+
+def write_arrays(path, arrays, attributes=None):
+    """
+    Writes the arrays to a binary feature file.
+
+    :param path: The path of the file to write.
+    :param arrays: A dictionary of array names to ndarrays.
+    :param attributes: A dictionary of JSON serializable values which will be stored in the header.
+    :return: None.
+    """
+    if attributes is None:
+        attributes = dict()
+    arrays = OrderedDict((name, np.ascontiguousarray(array)) for name, array in arrays.items())
+    encoded_header, array_specs, _ = file_layout(OrderedDict((name, (array.shape, array.dtype))
+                                                             for name, array in arrays.items()),
+                                                 attributes)
+
+    with open(path, 'wb') as fp:
+        fp.write(encoded_header)
+        for spec, array in zip(array_specs, arrays.values()):
+            fp.write(b'\0' * (spec['offset'] - fp.tell()))
+            fp.write(array.tobytes())
+
+
+def encode_arrays(arrays, attributes=None):
+    """
+    Encodes the arrays in the binary feature file format without writing them to a file, for storing them inside
+    another file like a feature shard.
+
+    :param arrays: A dictionary of array names to ndarrays.
+    :param attributes: A dictionary of JSON serializable values which will be stored in the header.
+    :return: The bytes of the feature file.
+    """
+    if attributes is None:
+        attributes = dict()
+    arrays = OrderedDict((name, np.ascontiguousarray(array)) for name, array in arrays.items())
+    encoded_header, array_specs, file_size = file_layout(OrderedDict((name, (array.shape, array.dtype))
+                                                                     for name, array in arrays.items()),
+                                                         attributes)
+    encoded = bytearray(file_size)
+    encoded[:len(encoded_header)] = encoded_header
+    for spec, array in zip(array_specs, arrays.values()):
+        data = array.tobytes()
+        encoded[spec['offset']:spec['offset'] + len(data)] = data
+    return bytes(encoded)
+
+
+def decode_arrays(buffer, offset=0):
+    """
+    Decodes a binary feature file held in memory. The arrays are read-only views of *buffer*, nothing is copied.
+
+    :param buffer: A bytes-like object holding the feature file.
+    :param offset: The position of the feature file in *buffer*.
+    :return: A FeatureArrays object with the arrays and attributes of the file.
+    """
+    buffer = memoryview(buffer)
+    if bytes(buffer[offset:offset + len(MAGIC)]) != MAGIC:
+        raise ValueError("The buffer doesn't hold a binary feature file at offset {}.".format(offset))
+    header_start = offset + len(MAGIC) + 8
+    header_length, = struct.unpack('<Q', bytes(buffer[offset + len(MAGIC):header_start]))
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode('utf-8'))
+    if header['version'] > VERSION:
+        raise ValueError("The feature file has version {}, only versions up to {} are supported.".format(
+            header['version'], VERSION))
+    arrays = OrderedDict()
+    for spec in header['arrays']:
+        shape = tuple(spec['shape'])
+        arrays[spec['name']] = np.frombuffer(buffer, dtype=np.dtype(spec['dtype']), count=int(np.prod(shape)),
+                                             offset=offset + spec['offset']).reshape(shape)
+    return FeatureArrays(arrays, header['attributes'])
+
+
+def create_arrays(path, specs, attributes=None):
+    """
+    Creates a binary feature file with uninitialized arrays, which can be filled in through the returned memory-maps.
+
+    :param path: The path of the file to create.
+    :param specs: A dictionary of array names to (shape, dtype) pairs.
+    :param attributes: A dictionary of JSON serializable values which will be stored in the header.
+    :return: A dictionary of array names to writable memory-mapped arrays. Empty arrays are regular ndarrays.
+    """
+    if attributes is None:
+        attributes = dict()
+    encoded_header, array_specs, file_size = file_layout(specs, attributes)
+
+    with open(path, 'wb') as fp:
+        fp.write(encoded_header)
+        fp.truncate(file_size)
+
+    arrays = OrderedDict()
+    for spec in array_specs:
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) > 0:
+            arrays[spec['name']] = np.memmap(path, dtype=dtype, mode='r+', offset=spec['offset'], shape=shape)
+        else:
+            arrays[spec['name']] = np.zeros(shape, dtype=dtype)
+    return arrays
+
+
+def read_header(path):
+    """
+    Reads the header of a binary feature file.
+
+    :param path: The path of the feature file.
+    :return: The header dictionary, see the module documentation.
+    """
+    with open(path, 'rb') as fp:
+        magic = fp.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError("{} is not a binary feature file.".format(path))
+        header_length, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_length).decode('utf-8'))
+    if header['version'] > VERSION:
+        raise ValueError("{} has feature file version {}, only versions up to {} are supported.".format(
+            path, header['version'], VERSION))
+    return header
+
+
+def read_arrays(path, mmap_mode='r'):
+    """
+    Reads a binary feature file.
+
+    :param path: The path of the feature file.
+    :param mmap_mode: The mode used for memory-mapping the arrays, see numpy.memmap. If None, the arrays are read into
+                      memory instead.
+    :return: A FeatureArrays object with the arrays and attributes of the file.
+    """
+    header = read_header(path)
+    arrays = OrderedDict()
+    with open(path, 'rb') as fp:
+        for spec in header['arrays']:
+            dtype = np.dtype(spec['dtype'])
+            shape = tuple(spec['shape'])
+            if mmap_mode is not None and int(np.prod(shape)) > 0:
+                arrays[spec['name']] = np.memmap(path, dtype=dtype, mode=mmap_mode, offset=spec['offset'],
+                                                 shape=shape)
+            else:
+                fp.seek(spec['offset'])
+                count = int(np.prod(shape))
+                arrays[spec['name']] = np.fromfile(fp, dtype=dtype, count=count).reshape(shape)
+    return FeatureArrays(arrays, header['attributes'])
+
+
+def is_feature_file(path):
+    """Returns True if *path* names a binary feature file, judging by its extension."""
+    return path.endswith(FEATURE_FILE_EXTENSION)
@@ -0,0 +1,381 @@
+"""
+Module for feature shards, append-only files holding the binary features of all segments of a subject and class.
+
+Writing one feature file per segment leaves thousands of small files in a feature folder, which is slow to list and
+read on network file systems. A shard replaces the feature files of a subject and class, for example all the
+Dog_1_preictal_segment_NNNN feature files of an extractor are appended to Dog_1_preictal_segments_<extractor>.shard.
+The layout is:
+
+    SHARD_MAGIC (8 bytes) | version (8 bytes, little endian) | record | record | ...
+
+where a record is:
+
+    RECORD_MAGIC (8 bytes) | header length (8 bytes, little endian) | JSON header | padding | feature file
+
+The JSON header has the keys 'segment', the name of the segment file, and 'size', the length of the feature file.
+The feature file is a complete binary feature file as written by feature_io, aligned to feature_io.ARRAY_ALIGNMENT
+bytes from the start of the shard. The shard is the index of itself: reading it is a single sequential read followed
+by a walk over the record headers. If a segment has several records, the last one is used.
+
+Records are appended under an exclusive lock of the shard, so any number of worker processes can write to the same
+shard. An append which was cut short leaves an incomplete record at the end of the shard, which readers ignore and
+the next append replaces.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+from collections import OrderedDict
+import errno
+import json
+import os
+import re
+import struct
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from . import feature_io
+
+SHARD_MAGIC = b'SICSSHRD'
+RECORD_MAGIC = b'SICSRECD'
+VERSION = 1
+
+#The file extension used for feature shards
+SHARD_EXTENSION = '.shard'
+
+#Separates the shard path from the segment name in a record reference, see record_reference
+RECORD_SEPARATOR = '#'
+
+
+def shard_path(feature_file):
+    """
+    Returns the path of the shard which replaces the feature file of a segment, by replacing the segment number of
+    the file name with 'segments' and the extension with SHARD_EXTENSION.
+
+    :param feature_file: The path the feature file of the segment would have.
+    :return: The path of the shard.
+    """
+    dirname, basename = os.path.split(feature_file)
+    shard_name, substitutions = re.subn(r'_segment_[0-9]{4}', '_segments', os.path.splitext(basename)[0], count=1)
+    if substitutions == 0:
+        raise ValueError("Can't tell the segment number of the feature file {}.".format(feature_file))
+    return os.path.join(dirname, shard_name + SHARD_EXTENSION)
+
+
+def encode_features(features):
+    """
+    Encodes features returned by an extractor as a binary feature file.
+
+    :param features: A feature_io.FeatureArrays or feature_io.StreamedFeatureArrays object, or a dict of frames which is
+                     stored as feature_io.FeatureArrays.from_frames does. Rows of features can't be stored in shards.
+    :return: The bytes of the feature file.
+    """
+    if isinstance(features, dict):
+        features = feature_io.FeatureArrays.from_frames(features)
+    if isinstance(features, feature_io.FeatureArrays):
+        return feature_io.encode_arrays(features.arrays, features.attributes)
+    if isinstance(features, feature_io.StreamedFeatureArrays):
+        # The chunks are streamed to a temporary file first, the shard lock isn't held while they are produced
+        descriptor, temporary_path = tempfile.mkstemp(suffix=feature_io.FEATURE_FILE_EXTENSION)
+        os.close(descriptor)
+        try:
+            features.write(temporary_path)
+            with open(temporary_path, 'rb') as fp:
+                return fp.read()
+        finally:
+            os.remove(temporary_path)
+    raise ValueError("Only binary features can be written to feature shards, got {}. Extract the features with "
+                     "output_format='binary'.".format(type(features).__name__))
+
+
+def append_features(path, segment_name, features):
+    """
+    Appends the features of a segment to a shard, which is created if it doesn't exist.
+
+    :param path: The path of the shard.
+    :param segment_name: The name of the segment file, like Dog_1_preictal_segment_0001.mat.
+    :param features: The features, see encode_features.
+    :return: None.
+    """
+    append_record(path, segment_name, encode_features(features))
+
+
+def append_record(path, segment_name, payload):
+    """
+    Appends a record to a shard under an exclusive lock, replacing an incomplete record at the end of the shard.
+
+    :param path: The path of the shard. It's created if it doesn't exist.
+    :param segment_name: The name of the segment file.
+    :param payload: The bytes of the binary feature file of the segment.
+    :return: None.
+    """
+    while True:
+        fp = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), 'r+b')
+        try:
+            lock(fp, exclusive=True)
+            if not same_file(fp, path):
+                # The shard was replaced by compact_shard while we waited for the lock
+                continue
+            end = complete_length(fp)
+            fp.seek(end)
+            fp.truncate()
+            if end == 0:
+                fp.write(shard_header())
+                end = fp.tell()
+            # The record is written with a single call, so a crash leaves at most one incomplete record
+            fp.write(encode_record(segment_name, payload, end))
+            fp.flush()
+            return
+        finally:
+            fp.close()
+
+
+def shard_header():
+    """Returns the bytes a shard starts with."""
+    return SHARD_MAGIC + struct.pack('<Q', VERSION)
+
+
+def encode_record(segment_name, payload, offset):
+    """
+    Encodes a shard record.
+
+    :param segment_name: The name of the segment file.
+    :param payload: The bytes of the binary feature file of the segment.
+    :param offset: The position in the shard the record is written at, which the payload is aligned relative to.
+    :return: The bytes of the record.
+    """
+    encoded_header = json.dumps(dict(segment=segment_name, size=len(payload)), sort_keys=True).encode('utf-8')
+    record_start = offset + len(RECORD_MAGIC) + 8 + len(encoded_header)
+    padding = feature_io.align(record_start) - record_start
+    return RECORD_MAGIC + struct.pack('<Q', len(encoded_header)) + encoded_header + b'\0' * padding + payload
+
+
+def lock(fp, exclusive):
+    """Locks the whole file *fp*, the lock is released when the file is closed. Does nothing without fcntl."""
+    if fcntl is not None:
+        fcntl.lockf(fp, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def same_file(fp, path):
+    """Returns True if the open file *fp* is still the file at *path*."""
+    try:
+        return os.path.samestat(os.fstat(fp.fileno()), os.stat(path))
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return False
+        raise
+
+
+def parse_records(data):
+    """
+    Walks the records of a shard held in memory.
+
+    :param data: The bytes of the shard.
+    :return: A pair (records, end), where records is a list of (segment name, payload offset, payload size) triples
+             of the complete records and end is the position after the last complete record, 0 if the shard header
+             is incomplete.
+    """
+    header_size = len(SHARD_MAGIC) + 8
+    if len(data) < header_size:
+        return [], 0
+    if data[:len(SHARD_MAGIC)] != SHARD_MAGIC:
+        raise ValueError("Not a feature shard.")
+    version, = struct.unpack('<Q', data[len(SHARD_MAGIC):header_size])
+    if version > VERSION:
+        raise ValueError("The shard has version {}, only versions up to {} are supported.".format(version, VERSION))
+
+    records = []
+    end = header_size
+    while True:
+        header_start = end + len(RECORD_MAGIC) + 8
+        if len(data) < header_start or data[end:end + len(RECORD_MAGIC)] != RECORD_MAGIC:
+            break
+        header_length, = struct.unpack('<Q', data[end + len(RECORD_MAGIC):header_start])
+        try:
+            header = json.loads(bytes(data[header_start:header_start + header_length]).decode('utf-8'))
+        except ValueError:
+            break
+        payload_offset = feature_io.align(header_start + header_length)
+        if len(data) < payload_offset + header['size']:
+            break
+        records.append((header['segment'], payload_offset, header['size']))
+        end = payload_offset + header['size']
+    return records, end
+
+
+def complete_length(fp):
+    """
+    Returns the length of the complete records of the open shard *fp*, by reading the record headers and seeking past
+    the feature files.
+    """
+    fp.seek(0)
+    header = fp.read(len(SHARD_MAGIC) + 8)
+    if len(header) < len(SHARD_MAGIC) + 8:
+        return 0
+    if header[:len(SHARD_MAGIC)] != SHARD_MAGIC:
+        raise ValueError("Not a feature shard.")
+    position = len(header)
+    size = os.fstat(fp.fileno()).st_size
+    while True:
+        fp.seek(position)
+        record_header = fp.read(len(RECORD_MAGIC) + 8)
+        if len(record_header) < len(RECORD_MAGIC) + 8 or record_header[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+            return position
+        header_length, = struct.unpack('<Q', record_header[len(RECORD_MAGIC):])
+        header_start = position + len(record_header)
+        try:
+            header = json.loads(fp.read(header_length).decode('utf-8'))
+        except ValueError:
+            return position
+        record_end = feature_io.align(header_start + header_length) + header['size']
+        if record_end > size:
+            return position
+        position = record_end
+
+
+def read_shard(path):
+    """
+    Reads a shard with a single read.
+
+    :param path: The path of the shard.
+    :return: An OrderedDict of segment names to feature_io.FeatureArrays objects, whose arrays are views of the
+             contents of the shard. If a segment has several records, the last one is used.
+    """
+    with open(path, 'rb') as fp:
+        lock(fp, exclusive=False)
+        data = fp.read()
+    records, _ = parse_records(data)
+    features = OrderedDict()
+    for segment_name, payload_offset, size in records:
+        features.pop(segment_name, None)
+        features[segment_name] = feature_io.decode_arrays(data, payload_offset)
+    return features
+
+
+def shard_segments(path):
+    """Returns the sorted names of the segments which have a record in the shard, reading only the record headers."""
+    segments = set()
+    with open(path, 'rb') as fp:
+        lock(fp, exclusive=False)
+        for segment_name, payload_offset, size in scan_headers(fp):
+            segments.add(segment_name)
+    return sorted(segments)
+
+
+def scan_headers(fp):
+    """Yields the (segment name, payload offset, payload size) triples of the complete records of the open shard."""
+    end = complete_length(fp)
+    position = len(SHARD_MAGIC) + 8
+    while position < end:
+        fp.seek(position + len(RECORD_MAGIC))
+        header_length, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(header_length).decode('utf-8'))
+        payload_offset = feature_io.align(position + len(RECORD_MAGIC) + 8 + header_length)
+        yield header['segment'], payload_offset, header['size']
+        position = payload_offset + header['size']
+
+
+def record_reference(path, segment_name):
+    """
+    Returns a string referring to the record of a segment in a shard, which can be used in place of a feature file
+    path by the feature loaders, see load_record.
+    """
+    return path + RECORD_SEPARATOR + segment_name
+
+
+def is_record_reference(name):
+    """Returns True if *name* is a reference to a shard record, see record_reference."""
+    return (SHARD_EXTENSION + RECORD_SEPARATOR) in name
+
+
+def load_record(reference):
+    """
+    Returns the features of a shard record. The whole shard is read on the first access and kept until a record of
+    another shard is loaded, so loading all segments of a shard in order reads it once. Safe to call from several
+    threads.
+
+    :param reference: A record reference, see record_reference.
+    :return: A feature_io.FeatureArrays object.
+    """
+    path, segment_name = reference.rsplit(RECORD_SEPARATOR, 1)
+    stat = os.stat(path)
+    version = (path, stat.st_size, stat.st_mtime)
+    # The version and records are replaced together, so a thread never sees the records of another shard
+    cached = load_record.cached
+    if cached is None or cached[0] != version:
+        cached = (version, read_shard(path))
+        load_record.cached = cached
+    try:
+        return cached[1][segment_name]
+    except KeyError:
+        raise ValueError("The shard {} has no record for {}.".format(path, segment_name))
+load_record.cached = None
+
+
+def read_feature_arrays(name):
+    """Reads binary features from a feature file path or a shard record reference."""
+    if is_record_reference(name):
+        return load_record(name)
+    return feature_io.read_arrays(name)
+
+
+def compact_shard(path):
+    """
+    Rewrites a shard with only the last record of every segment. Appends to the shard wait until the compacted shard
+    is in place.
+
+    :param path: The path of the shard.
+    :return: A pair (records before, records after).
+    """
+    with open(path, 'r+b') as fp:
+        lock(fp, exclusive=True)
+        data = fp.read()
+        records, _ = parse_records(data)
+        latest = OrderedDict()
+        for segment_name, payload_offset, size in records:
+            latest.pop(segment_name, None)
+            latest[segment_name] = (payload_offset, size)
+
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temporary_path, 'wb') as compacted:
+                compacted.write(shard_header())
+                for segment_name, (payload_offset, size) in latest.items():
+                    compacted.write(encode_record(segment_name, data[payload_offset:payload_offset + size],
+                                                  compacted.tell()))
+                # The compacted shard must be on disk before it replaces the shard
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.rename(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+    return len(records), len(latest)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Lists and compacts feature shards.")
+    parser.add_argument("command", help="'list' prints the segments of the shards, 'compact' drops records which "
+                                        "have been replaced by a later record of the same segment.",
+                        choices=['list', 'compact'])
+    parser.add_argument("shards", help="The shard files.", nargs='+', metavar="SHARD_FILE")
+    args = parser.parse_args()
+
+    for path in args.shards:
+        if args.command == 'compact':
+            before, after = compact_shard(path)
+            print("{}: {} records, {} after compacting".format(path, before, after))
+        else:
+            segments = shard_segments(path)
+            print("{}: {} segments".format(path, len(segments)))
+            for segment_name in segments:
+                print("  {}".format(segment_name))
+
+
+if __name__ == '__main__':
+    main()
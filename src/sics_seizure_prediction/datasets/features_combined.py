@@ -17,7 +17,7 @@ def load(segment_files, **kwargs):
     dataframes = []
     for segment_file in segment_files:
         if 'wavelet' in segment_file:
-            dataframes.append(wavelet_classification.load_csv(segment_file))
+            dataframes.append(wavelet_classification.load_feature_file(segment_file))
         elif 'corr' in segment_file:
             dataframes.append(correlation_convertion.load_and_pivot(segment_file))
         else:
@@ -1,12 +1,16 @@
 """Module holding some utilities for doing file related stuff"""
 from __future__ import absolute_import
 
+import hashlib
 import os.path
 import re
 import json
 import glob
 from collections import defaultdict
 
+from . import feature_io
+from . import feature_shards
+
 
 #A file which holds the names of the test segments
 TESTSEGMENT_NAMES_FILE = '../../data/test_segment_names.json'
@@ -83,6 +87,21 @@ def load_testsegment_names(name_file=TESTSEGMENT_NAMES_FILE):
         return generate_testsegment_names(name_file)
 
 
+def file_checksum(path, block_size=2**20):
+    """
+    Calculates a checksum of the contents of a file.
+
+    :param path: The path of the file.
+    :param block_size: The number of bytes read at a time.
+    :return: The SHA-1 digest of the file contents as a hexadecimal string.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def expand_paths(filenames, recursive=True):
     """
     Goes through the list of *filenames* and expands any directory to the files included in that directory.
@@ -194,11 +213,37 @@ def find_feature_files(feature_folder, class_name, file_pattern="*segment*.csv")
             for filename in sorted(files)]
 
 
+def find_binary_or_csv_files(feature_folder, class_name, file_pattern="*segment*.csv"):
+    """
+    Collects the feature files from *feature_folder* like find_feature_files, but also finds binary feature files, see
+    feature_io, and the records of feature shards, see feature_shards. If a segment has several, the shard record is
+    used before the binary file and the binary file before the csv file.
+    :param feature_folder: The folder to search for files in.
+    :param class_name: The class name of files to find, usually one of {'interictal', 'preictal', 'test'}.
+    :param file_pattern: A unix shell style glob pattern for the csv files. The patterns for the binary files and
+                         shards are the same with the extension replaced.
+    :return: A list of dictionaries with the keys 'segment' and 'files', see find_feature_files. The 'files' of a
+             segment in a shard is a record reference, see feature_shards.record_reference.
+    """
+    feature_files = dict()
+    base_pattern = re.sub(r'\.csv$', '', file_pattern)
+    binary_pattern = base_pattern + feature_io.FEATURE_FILE_EXTENSION
+    for pattern in (file_pattern, binary_pattern):
+        for feature_file in find_feature_files(feature_folder, class_name, file_pattern=pattern):
+            feature_files[feature_file['segment']] = feature_file
+    shard_pattern = base_pattern + feature_shards.SHARD_EXTENSION
+    for shard_file in find_feature_files(feature_folder, class_name, file_pattern=shard_pattern):
+        for segment_name in feature_shards.shard_segments(shard_file['files']):
+            feature_files[segment_name] = {'segment': segment_name,
+                                           'files': feature_shards.record_reference(shard_file['files'], segment_name)}
+    return [feature_file for segment, feature_file in sorted(feature_files.items())]
+
+
 def find_grouped_feature_files(feature_folders, class_name, file_pattern="*segment*.csv"):
     """
     Collects multiple feature files from *feature_folders* matching *class_name* and *file_pattern* and groups them
     based on the original segment name. The difference from *find_feature_files* is that this version can find multiple
-    features for every original segment.
+    features for every original segment. Binary feature files are found as well, see *find_binary_or_csv_files*.
 
     :param feature_folders: A list of feature folder to search for files in.
     :param class_name: The class name of files to find, usually one of {'interictal', 'preictal', 'test'}.
@@ -211,7 +256,7 @@ def find_grouped_feature_files(feature_folders, class_name, file_pattern="*segme
     for feature_folder in feature_folders:
         # First we locate the files with the canonical segment they
         # are derived from, using the usual find_feature_files
-        feature_file_dicts = find_feature_files(feature_folder, class_name, file_pattern=file_pattern)
+        feature_file_dicts = find_binary_or_csv_files(feature_folder, class_name, file_pattern=file_pattern)
 
         # feature_file_dicts is a list of dictionaries, containing a
         # segment name key and a files key, we group this into our
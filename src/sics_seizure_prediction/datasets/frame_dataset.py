@@ -0,0 +1,270 @@
+"""
+Module for datasets of sliding frames which are generated on demand from the feature windows.
+
+With sliding frames every window is part of *frame_length* frames, so the frame matrix of a subject is about
+*frame_length* times larger than its windows. A SlidingFrameDataset keeps only the (windows x window features) matrix
+and the row of the first window of every frame, and builds the frames when they are asked for: in shuffled minibatches
+for estimators which learn incrementally with partial_fit, see seizure_modeling.fit_incremental, and in chunks in order
+for scoring. The window matrix can be a memory mapped feature cache, see from_cache.
+
+    frames = SlidingFrameDataset.from_window_frame(window_frame, frame_length=12)
+    for batch_x, batch_y in frames.minibatches(batch_size=1024, random_state=1729):
+        clf.partial_fit(batch_x, batch_y, classes=[0, 1])
+"""
+from __future__ import absolute_import
+
+import numpy as np
+import pandas as pd
+
+from . import dataset
+
+
+class SlidingFrameDataset(object):
+    """
+    A dataset of frames of consecutive windows. Frame *i* is the *frame_length* windows starting at the row
+    *frame_starts[i]* of *windows*, concatenated into a single feature vector in the same way as
+    dataset.extend_data_with_sliding_frames does.
+    """
+    def __init__(self, windows, frame_starts, segments, frame_length, labels=None, window_columns=None):
+        """
+        :param windows: A (n_windows x window features) array. The windows of a segment must be consecutive rows.
+        :param frame_starts: An integer array with the row of the first window of every frame.
+        :param segments: An array with the segment name of every frame.
+        :param frame_length: The number of windows in a frame.
+        :param labels: An optional array with the class label of every frame.
+        :param window_columns: The names of the window features, used for the columns of materialised frames.
+        """
+        self.windows = windows
+        self.frame_starts = np.asarray(frame_starts, dtype=np.int64)
+        self.segments = np.asarray(segments, dtype=object)
+        self.frame_length = frame_length
+        self.labels = None if labels is None else np.asarray(labels)
+        self.window_columns = window_columns
+        # The offsets of the windows of a frame relative to its first window
+        self.window_offsets = np.arange(frame_length, dtype=np.int64)
+
+    @classmethod
+    def from_window_frame(cls, window_frame, frame_length=12, step=1, label_column=dataset.LABEL_COLUMN):
+        """
+        Creates a dataset from a DataFrame with one window per row, like the ones load_feature_files returns for a
+        frame length of 1.
+
+        :param window_frame: A DataFrame with the index levels 'segment' and 'frame', sorted by segment and window.
+        :param frame_length: The number of windows in a frame.
+        :param step: The number of windows between the starts of two frames of a segment. 1 gives sliding frames,
+                     *frame_length* gives the disjoint frames of dataset.reshape_frames.
+        :param label_column: The column with the class labels. If the frame has no such column, the dataset has no
+                             labels.
+        :return: A SlidingFrameDataset.
+        """
+        labels = None
+        if label_column in window_frame.columns:
+            labels = window_frame[label_column].values
+            window_frame = window_frame.drop(label_column, axis=1)
+        windows = np.ascontiguousarray(window_frame.values, dtype=np.float64)
+        segment_values = window_frame.index.get_level_values('segment').values
+        frame_starts = segment_frame_starts(segment_values, frame_length, step=step)
+        return cls(windows,
+                   frame_starts,
+                   segment_values[frame_starts],
+                   frame_length,
+                   labels=None if labels is None else labels[frame_starts],
+                   window_columns=window_frame.columns)
+
+    @classmethod
+    def from_cache(cls, cache_dir, frame_length=12, step=1, label=None, mmap_mode='r'):
+        """
+        Creates a dataset from a feature cache written by load_feature_files with a frame length of 1, without
+        reading it. The windows stay memory mapped, so only the pages of the windows which are used are read.
+
+        :param cache_dir: The cache directory, see dataset.write_frame_cache.
+        :param frame_length: The number of windows in a frame.
+        :param step: The number of windows between the starts of two frames of a segment, see from_window_frame.
+        :param label: The class label of all frames, used if the cache has no labels.
+        :param mmap_mode: The mode to memory map the windows with, see numpy.load.
+        :return: A SlidingFrameDataset.
+        """
+        arrays = dataset.read_cache_arrays(cache_dir, mmap_mode=mmap_mode)
+        segment_level = arrays['index_names'].index('segment')
+        segment_values = np.asarray(arrays['index_levels'][segment_level],
+                                    dtype=object)[arrays['index_codes'][segment_level]]
+        frame_starts = segment_frame_starts(segment_values, frame_length, step=step)
+        if arrays['labels'] is not None:
+            labels = np.asarray(arrays['labels'])[frame_starts]
+        elif label is not None:
+            labels = np.repeat(label, len(frame_starts))
+        else:
+            labels = None
+        if len(arrays['column_names']) > 1:
+            window_columns = pd.MultiIndex.from_tuples([tuple(column) for column in arrays['columns']],
+                                                       names=arrays['column_names'])
+        else:
+            window_columns = pd.Index(arrays['columns'], name=arrays['column_names'][0])
+        return cls(arrays['values'], frame_starts, segment_values[frame_starts], frame_length,
+                   labels=labels, window_columns=window_columns)
+
+    @classmethod
+    def concatenate(cls, datasets):
+        """
+        Returns a dataset with the frames of all *datasets*, which must have the same frame length and window
+        features. The windows are copied into a single matrix.
+        """
+        offsets = np.cumsum([0] + [len(frames.windows) for frames in datasets[:-1]])
+        has_labels = all(frames.labels is not None for frames in datasets)
+        return cls(np.concatenate([frames.windows for frames in datasets]),
+                   np.concatenate([frames.frame_starts + offset for frames, offset in zip(datasets, offsets)]),
+                   np.concatenate([frames.segments for frames in datasets]),
+                   datasets[0].frame_length,
+                   labels=np.concatenate([frames.labels for frames in datasets]) if has_labels else None,
+                   window_columns=datasets[0].window_columns)
+
+    def __len__(self):
+        return len(self.frame_starts)
+
+    @property
+    def shape(self):
+        """The shape of the frame matrix, (frames x frame features)."""
+        return len(self), self.windows.shape[1] * self.frame_length
+
+    def subset(self, frame_indices):
+        """Returns a dataset with the frames *frame_indices* of this one, which shares the windows."""
+        return SlidingFrameDataset(self.windows,
+                                   self.frame_starts[frame_indices],
+                                   self.segments[frame_indices],
+                                   self.frame_length,
+                                   labels=None if self.labels is None else self.labels[frame_indices],
+                                   window_columns=self.window_columns)
+
+    def with_windows(self, windows):
+        """Returns a dataset with the same frames over another window matrix, like a standardized one."""
+        return SlidingFrameDataset(windows, self.frame_starts, self.segments, self.frame_length,
+                                   labels=self.labels, window_columns=self.window_columns)
+
+    def frames(self, frame_indices=None):
+        """
+        Materialises frames.
+
+        :param frame_indices: The frames to materialise, an index array or a slice. All frames if None.
+        :return: A (frames x frame features) array.
+        """
+        starts = self.frame_starts if frame_indices is None else self.frame_starts[frame_indices]
+        window_rows = starts[:, np.newaxis] + self.window_offsets
+        return self.windows[window_rows].reshape(len(starts), -1)
+
+    def to_frame(self, frame_indices=None):
+        """
+        Materialises frames as a DataFrame indexed by segment, with the label column if the dataset has labels, like
+        the frames load_feature_files returns.
+        """
+        if frame_indices is None:
+            frame_indices = slice(None)
+        columns = None
+        if self.window_columns is not None:
+            columns = pd.MultiIndex.from_product([range(self.frame_length), self.window_columns],
+                                                 names=['window', 'feature'])
+        frame = pd.DataFrame(self.frames(frame_indices),
+                             index=pd.Index(self.segments[frame_indices], name='segment'),
+                             columns=columns)
+        if self.labels is not None:
+            frame[dataset.LABEL_COLUMN] = self.labels[frame_indices]
+        return frame
+
+    def minibatches(self, batch_size=1024, shuffle=True, random_state=None):
+        """
+        Generates the frames in minibatches, each frame once.
+
+        :param batch_size: The number of frames in a batch.
+        :param shuffle: If True, the frames are drawn in a random order, otherwise in the order of the dataset.
+        :param random_state: A seed or numpy RandomState for the order of the frames.
+        :return: A generator of (frames, labels) pairs, where frames is a (batch size x frame features) array and
+                 labels is None if the dataset has no labels.
+        """
+        order = np.arange(len(self))
+        if shuffle:
+            if not isinstance(random_state, np.random.RandomState):
+                random_state = np.random.RandomState(random_state)
+            random_state.shuffle(order)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            yield self.frames(batch), None if self.labels is None else self.labels[batch]
+
+    def chunks(self, chunk_size=4096):
+        """
+        Generates the frames in order in chunks, for scoring.
+
+        :param chunk_size: The number of frames in a chunk.
+        :return: A generator of (frame slice, frames) pairs.
+        """
+        for start in range(0, len(self), chunk_size):
+            frame_slice = slice(start, min(start + chunk_size, len(self)))
+            yield frame_slice, self.frames(frame_slice)
+
+    def segment_split(self, training_ratio=0.8, random_state=None):
+        """
+        Splits the dataset into a training and test dataset on whole segments, taking *training_ratio* of the segments
+        of every class for training, like dataset.split_dataset does with do_segment_split.
+
+        :param training_ratio: The ratio of the segments to use for training.
+        :param random_state: A seed for choosing the segments.
+        :return: A pair of datasets (training, test).
+        """
+        random_state = np.random.RandomState(random_state)
+        labels = self.labels if self.labels is not None else np.zeros(len(self))
+        training_segments = []
+        for label in np.unique(labels):
+            class_segments = np.unique(self.segments[labels == label])
+            random_state.shuffle(class_segments)
+            training_segments.extend(class_segments[:int(round(len(class_segments) * training_ratio))])
+        is_training = pd.Series(self.segments).isin(training_segments).values
+        return self.subset(np.flatnonzero(is_training)), self.subset(np.flatnonzero(~is_training))
+
+    def sample_segments(self, n_frames, random_state=None):
+        """
+        Returns a dataset of randomly chosen whole segments with about *n_frames* frames, like dataset.downsample does
+        with do_segment_split. If the dataset has fewer frames, it's returned as it is.
+        """
+        segments = np.unique(self.segments)
+        frames_per_segment = len(self) / len(segments)
+        n_segments = int(n_frames / frames_per_segment)
+        if n_segments >= len(segments):
+            return self
+        random_state = np.random.RandomState(random_state)
+        chosen = random_state.choice(segments, n_segments, replace=False)
+        return self.subset(np.flatnonzero(pd.Series(self.segments).isin(chosen).values))
+
+
+def segment_frame_starts(segment_values, frame_length, step=1):
+    """
+    Returns the rows of the first window of all frames which fit within the segments of a window matrix.
+
+    :param segment_values: An array with the segment of every window. The windows of a segment must be consecutive.
+    :param frame_length: The number of windows in a frame.
+    :param step: The number of windows between the starts of two frames of a segment.
+    :return: An int64 array of window rows.
+    """
+    segment_values = np.asarray(segment_values)
+    if len(segment_values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    boundaries = np.flatnonzero(segment_values[1:] != segment_values[:-1]) + 1
+    segment_starts = np.concatenate(([0], boundaries))
+    segment_ends = np.concatenate((boundaries, [len(segment_values)]))
+    return np.concatenate([np.arange(start, end - frame_length + 1, step, dtype=np.int64)
+                           for start, end in zip(segment_starts, segment_ends)])
+
+
+def standardize(datasets):
+    """
+    Centers the window features of the datasets to mean 0 and scales them to standard deviation 1, using the mean
+    and standard deviation over the windows of all datasets, like dataset.scale does for frames. Every frame feature
+    is a window feature, so this standardizes the frames as well, except for the windows at the ends of segments
+    which are part of fewer frames.
+
+    :param datasets: A list of SlidingFrameDatasets.
+    :return: A list of datasets over standardized copies of the windows.
+    """
+    n_windows = sum(len(frames.windows) for frames in datasets)
+    mean = sum(np.asarray(frames.windows).sum(axis=0) for frames in datasets) / n_windows
+    variance = sum(((np.asarray(frames.windows) - mean)**2).sum(axis=0) for frames in datasets) / n_windows
+    std = np.sqrt(variance)
+    std[std == 0] = 1
+    return [frames.with_windows((frames.windows - mean) / std) for frames in datasets]
@@ -12,6 +12,7 @@ import pandas as pd
 import numpy as np
 
 from . import fileutils
+from . import stage_timing
 
 
 def load_segment(segment_path, old_segment_format=True, normalize_signal=False, resample_frequency=None):
@@ -28,12 +29,14 @@ def load_segment(segment_path, old_segment_format=True, normalize_signal=False,
     if normalize_signal:
         return load_and_standardize(segment_path, old_segment_format=old_segment_format)
     else:
-        if old_segment_format:
-            segment = Segment(segment_path)
-        else:
-            segment = DFSegment.from_mat_file(segment_path)
+        with stage_timing.stage('load'):
+            if old_segment_format:
+                segment = Segment(segment_path)
+            else:
+                segment = DFSegment.from_mat_file(segment_path)
         if resample_frequency is not None:
-            segment.resample_frequency(resample_frequency, inplace=True)
+            with stage_timing.stage('preprocess'):
+                segment.resample_frequency(resample_frequency, inplace=True)
         return segment
 
 
@@ -57,30 +60,48 @@ def load_and_standardize(mat_filename, stats_glob='../../data/segment_statistics
     :return: A segment object scaled, centered and trimmed using the values loaded from a file in *stats_folder* whose
     name contains the same subject as mat_filename
     """
-    from ..features import basic_segment_statistics
-
-    subject = fileutils.get_subject(mat_filename)
-    stats_files = [filename for filename
-                   in glob.glob(stats_glob)
-                   if subject == fileutils.get_subject(filename)]
-    if len(stats_files) != 1:
-        raise ValueError("Can't determine which stats file to use"
-                         "with the glob {} and the subject {}".format(stats_glob, subject))
-    stats = basic_segment_statistics.read_stats(stats_files[0])
-    center = basic_segment_statistics.get_subject_metric(stats, center_name)
-    scale = basic_segment_statistics.get_subject_metric(stats, scale_name)
-
-    if old_segment_format:
-        segment = Segment(mat_filename)
-    else:
-        segment = DFSegment.from_mat_file(mat_filename)
+    with stage_timing.stage('load'):
+        center, scale = subject_normalization(fileutils.get_subject(mat_filename), stats_glob, center_name,
+                                              scale_name)
+        if old_segment_format:
+            segment = Segment(mat_filename)
+        else:
+            segment = DFSegment.from_mat_file(mat_filename)
 
-    segment.center(center)
-    segment.winsorize(scale, k=k)  # We have to winsorize before scaling
-    segment.scale(scale)
+    with stage_timing.stage('preprocess'):
+        segment.center(center)
+        segment.winsorize(scale, k=k)  # We have to winsorize before scaling
+        segment.scale(scale)
     return segment
 
 
+def subject_normalization(subject, stats_glob, center_name, scale_name):
+    """
+    Returns the centering and scaling vectors of a subject from its segment statistics file. The vectors are cached,
+    so a process reads the statistics of a subject only once.
+    :param subject: The subject name.
+    :param stats_glob: A glob matching the statistics files, see load_and_standardize.
+    :param center_name: The name of the metric to use as a centering vector.
+    :param scale_name: The name of the metric to use as a scaling vector.
+    :return: A pair (center, scale).
+    """
+    from ..features import basic_segment_statistics
+
+    key = (subject, stats_glob, center_name, scale_name)
+    if key not in subject_normalization.cache:
+        stats_files = [filename for filename
+                       in glob.glob(stats_glob)
+                       if subject == fileutils.get_subject(filename)]
+        if len(stats_files) != 1:
+            raise ValueError("Can't determine which stats file to use"
+                             "with the glob {} and the subject {}".format(stats_glob, subject))
+        stats = basic_segment_statistics.read_stats(stats_files[0])
+        subject_normalization.cache[key] = (basic_segment_statistics.get_subject_metric(stats, center_name),
+                                            basic_segment_statistics.get_subject_metric(stats, scale_name))
+    return subject_normalization.cache[key]
+subject_normalization.cache = dict()
+
+
 class Segment:
     """Wrapper class for EEG segments backed by a multidimensional numpy array."""
 
@@ -480,9 +501,18 @@ def concat(segments):
     return DFSegment(sampling_frequency, new_df)
 
 
-def test_segment_classes():
-    s_new = DFSegment.from_mat_file('../../data/Dog_1/Dog_1_preictal_segment_0001.mat')
-    s_old = Segment('../../data/Dog_1/Dog_1_preictal_segment_0001.mat')
+def test_segment_classes(mat_filename=None):
+    """
+    Checks that Segment and DFSegment read the same data from a segment file.
+    :param mat_filename: The segment file to read. If None, a short synthetic Dog segment is generated, see
+                         datasets.synthetic.
+    """
+    if mat_filename is None:
+        import tempfile
+        from . import synthetic
+        mat_filename = synthetic.generate_segment(tempfile.mkdtemp(), 'Dog_1', 'preictal', 1, duration=60)
+    s_new = DFSegment.from_mat_file(mat_filename)
+    s_old = Segment(mat_filename)
     print('Matching durations: ', s_old.get_duration() == s_new.get_duration())
     for start in np.arange(0, s_new.get_duration(), 9.3):
         for channel in s_new.get_channels():
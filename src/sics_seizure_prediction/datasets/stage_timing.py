@@ -0,0 +1,328 @@
+"""
+Module for timing the stages of feature extraction jobs, and for reporting on the timings.
+
+Every extraction job runs with a StageTimer, and the code of the job marks its stages with the stage context manager:
+
+    with stage_timing.stage('load'):
+        segment = ...
+
+Stages can be nested, the time of a stage excludes the time of the stages within it. The stages used by the
+extraction pipeline are STAGES. When a job is done, its stages and the number of bytes it read and wrote are appended
+as a JSON line to the trace file of the run, by the worker process which ran it. The 'profile-report' command of this
+module aggregates trace files into per-stage and per-subject throughput tables, and can write a timeline in the Chrome
+trace event format, which can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from . import fileutils
+
+#The stages of the extraction pipeline, in pipeline order
+STAGES = ('cache', 'load', 'preprocess', 'window', 'transform', 'serialize', 'write')
+
+
+class StageTimer(object):
+    """
+    Records the stages of a job and counts the bytes it reads and writes. Stages are only recorded from the thread
+    which created the timer, stages entered from other threads, for example by thread_map, are part of the enclosing
+    stage.
+    """
+    def __init__(self):
+        self.stages = []
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.thread = threading.current_thread()
+        # The time spent in nested stages, for every open stage
+        self.nested_seconds = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager which records the time spent in its block as the stage *name*."""
+        start = time.time()
+        self.nested_seconds.append(0.0)
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            nested = self.nested_seconds.pop()
+            if self.nested_seconds:
+                self.nested_seconds[-1] += seconds
+            self.stages.append(dict(name=name, start=start, seconds=seconds, self_seconds=seconds - nested,
+                                    depth=len(self.nested_seconds)))
+
+
+def current_timer():
+    """Returns the StageTimer of the job running in this process, or None."""
+    return current_timer.timer
+current_timer.timer = None
+
+
+@contextlib.contextmanager
+def timed_job():
+    """Context manager which makes a new StageTimer the timer of the process within its block, and yields it."""
+    timer = StageTimer()
+    previous, current_timer.timer = current_timer.timer, timer
+    try:
+        yield timer
+    finally:
+        current_timer.timer = previous
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager which records its block as the stage *name* of the current job. Does nothing outside of a timed
+    job, or in another thread than the one running the job.
+    """
+    timer = current_timer()
+    if timer is None or threading.current_thread() is not timer.thread:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def count_read(n_bytes):
+    """Adds *n_bytes* to the bytes read by the current job."""
+    if current_timer() is not None:
+        current_timer().bytes_read += n_bytes
+
+
+def count_written(n_bytes):
+    """Adds *n_bytes* to the bytes written by the current job."""
+    if current_timer() is not None:
+        current_timer().bytes_written += n_bytes
+
+
+def job_record(timer, segment_path, start, seconds, **fields):
+    """
+    Creates the trace record of a job.
+
+    :param timer: The StageTimer of the job.
+    :param segment_path: The path of the segment.
+    :param start: The time the job started, in seconds since the epoch.
+    :param seconds: The duration of the job.
+    :param fields: Further JSON serializable fields of the record, like 'run', 'extractor' and 'succeeded'.
+    :return: A dictionary.
+    """
+    return dict(fields,
+                segment=os.path.basename(segment_path),
+                subject=fileutils.get_subject(segment_path) or 'unknown',
+                host=socket.gethostname(),
+                pid=os.getpid(),
+                start=start,
+                seconds=seconds,
+                bytes_read=timer.bytes_read,
+                bytes_written=timer.bytes_written,
+                stages=timer.stages)
+
+
+def append_record(trace_file, record):
+    """
+    Appends a record to a trace file. The record is written with a single append, so all workers of a run can write
+    to the same file.
+    """
+    trace_dir = os.path.dirname(trace_file)
+    if trace_dir and not os.path.exists(trace_dir):
+        try:
+            os.makedirs(trace_dir)
+        except OSError:
+            if not os.path.isdir(trace_dir):
+                raise
+    with open(trace_file, 'a') as fp:
+        fp.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(trace_files, last_run=False):
+    """
+    Reads the job records of trace files.
+
+    :param trace_files: A list of trace file paths.
+    :param last_run: If True, only the records of the latest run in the files are returned.
+    :return: A list of record dictionaries. Lines which can't be parsed are skipped.
+    """
+    records = []
+    for trace_file in trace_files:
+        with open(trace_file) as fp:
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    if last_run and records:
+        latest = max(record.get('run', '') for record in records)
+        records = [record for record in records if record.get('run', '') == latest]
+    return records
+
+
+def stage_table(records):
+    """
+    Aggregates the stages of job records.
+
+    :param records: Job records as returned by read_records.
+    :return: A list of dictionaries with the keys 'stage', 'jobs' (the number of jobs with the stage), 'seconds' (the
+             total time of the stage, excluding nested stages), 'share' (the fraction of the total job time),
+             'mean_seconds' (per job with the stage) and 'mb_per_second' (the megabytes of segment data read by the
+             jobs with the stage per second of the stage), in pipeline order.
+    """
+    total_seconds = sum(record['seconds'] for record in records)
+    stages = OrderedDict((name, dict(jobs=0, seconds=0.0, bytes_read=0)) for name in STAGES)
+    for record in records:
+        seen = set()
+        for job_stage in record['stages']:
+            totals = stages.setdefault(job_stage['name'], dict(jobs=0, seconds=0.0, bytes_read=0))
+            totals['seconds'] += job_stage['self_seconds']
+            if job_stage['name'] not in seen:
+                totals['jobs'] += 1
+                totals['bytes_read'] += record['bytes_read']
+                seen.add(job_stage['name'])
+    other_seconds = total_seconds - sum(totals['seconds'] for totals in stages.values())
+    stages['other'] = dict(jobs=len(records), seconds=max(other_seconds, 0.0), bytes_read=0)
+
+    table = []
+    for name, totals in stages.items():
+        if totals['jobs'] == 0:
+            continue
+        table.append(dict(stage=name,
+                          jobs=totals['jobs'],
+                          seconds=totals['seconds'],
+                          share=totals['seconds'] / total_seconds if total_seconds > 0 else 0.0,
+                          mean_seconds=totals['seconds'] / totals['jobs'],
+                          mb_per_second=(totals['bytes_read'] / 2**20 / totals['seconds']
+                                         if totals['seconds'] > 0 and totals['bytes_read'] else None)))
+    return table
+
+
+def subject_table(records):
+    """
+    Aggregates job records per subject.
+
+    :param records: Job records as returned by read_records.
+    :return: A list of dictionaries with the keys 'subject', 'jobs', 'failed', 'seconds' (the total job time),
+             'mb_read', 'mb_written', 'mb_per_second' (megabytes of segment data per second of job time),
+             'segments_per_hour' (per worker) and 'slowest_stage' (the stage with the most time), sorted by subject.
+    """
+    subjects = dict()
+    for record in records:
+        totals = subjects.setdefault(record['subject'], dict(jobs=0, failed=0, seconds=0.0, bytes_read=0,
+                                                             bytes_written=0, stages=dict()))
+        totals['jobs'] += 1
+        totals['failed'] += 0 if record.get('succeeded', True) else 1
+        totals['seconds'] += record['seconds']
+        totals['bytes_read'] += record['bytes_read']
+        totals['bytes_written'] += record['bytes_written']
+        for job_stage in record['stages']:
+            totals['stages'][job_stage['name']] = totals['stages'].get(job_stage['name'], 0.0) + \
+                job_stage['self_seconds']
+
+    table = []
+    for subject, totals in sorted(subjects.items()):
+        seconds = totals['seconds']
+        table.append(dict(subject=subject,
+                          jobs=totals['jobs'],
+                          failed=totals['failed'],
+                          seconds=seconds,
+                          mb_read=totals['bytes_read'] / 2**20,
+                          mb_written=totals['bytes_written'] / 2**20,
+                          mb_per_second=totals['bytes_read'] / 2**20 / seconds if seconds > 0 else None,
+                          segments_per_hour=3600 * totals['jobs'] / seconds if seconds > 0 else None,
+                          slowest_stage=(max(totals['stages'], key=totals['stages'].get)
+                                         if totals['stages'] else None)))
+    return table
+
+
+def chrome_trace(records):
+    """
+    Creates a timeline of job records in the Chrome trace event format. Every worker process is a row, with the jobs
+    as events and their stages nested within them.
+
+    :param records: Job records as returned by read_records.
+    :return: A JSON serializable dictionary.
+    """
+    events = []
+    if not records:
+        return dict(traceEvents=events, displayTimeUnit='ms')
+    origin = min(record['start'] for record in records)
+    workers = dict()
+    for record in records:
+        worker = (record['host'], record['pid'])
+        if worker not in workers:
+            workers[worker] = len(workers) + 1
+            events.append(dict(ph='M', name='process_name', pid=workers[worker], tid=record['pid'],
+                               args=dict(name="{} pid {}".format(record['host'], record['pid']))))
+        process = workers[worker]
+        events.append(dict(ph='X', name=record['segment'], cat='job', pid=process, tid=record['pid'],
+                           ts=(record['start'] - origin) * 1e6, dur=record['seconds'] * 1e6,
+                           args=dict(subject=record['subject'], run=record.get('run'),
+                                     extractor=record.get('extractor'), succeeded=record.get('succeeded'),
+                                     bytes_read=record['bytes_read'], bytes_written=record['bytes_written'])))
+        for job_stage in record['stages']:
+            events.append(dict(ph='X', name=job_stage['name'], cat='stage', pid=process, tid=record['pid'],
+                               ts=(job_stage['start'] - origin) * 1e6, dur=job_stage['seconds'] * 1e6,
+                               args=dict(segment=record['segment'], self_seconds=job_stage['self_seconds'])))
+    return dict(traceEvents=events, displayTimeUnit='ms')
+
+
+def format_value(value, format_spec):
+    """Formats a table value, None is shown as '-'."""
+    return '-' if value is None else format(value, format_spec)
+
+
+def print_report(records):
+    """Prints the stage and subject tables of the job records."""
+    print("{} jobs, {:.1f} seconds of job time".format(len(records), sum(record['seconds'] for record in records)))
+    print()
+    print("{:<12}{:>8}{:>12}{:>8}{:>12}{:>10}".format('stage', 'jobs', 'seconds', 'share', 'mean (s)', 'MB/s'))
+    for row in stage_table(records):
+        print("{:<12}{:>8}{:>12}{:>8}{:>12}{:>10}".format(row['stage'], row['jobs'],
+                                                          format_value(row['seconds'], '.1f'),
+                                                          format_value(100 * row['share'], '.1f') + '%',
+                                                          format_value(row['mean_seconds'], '.3f'),
+                                                          format_value(row['mb_per_second'], '.1f')))
+    print()
+    print("{:<12}{:>8}{:>8}{:>12}{:>10}{:>12}{:>10}{:>12}  {}".format('subject', 'jobs', 'failed', 'seconds',
+                                                                       'MB read', 'MB written', 'MB/s',
+                                                                       'segments/h', 'slowest stage'))
+    for row in subject_table(records):
+        print("{:<12}{:>8}{:>8}{:>12}{:>10}{:>12}{:>10}{:>12}  {}".format(
+            row['subject'], row['jobs'], row['failed'], format_value(row['seconds'], '.1f'),
+            format_value(row['mb_read'], '.1f'), format_value(row['mb_written'], '.1f'),
+            format_value(row['mb_per_second'], '.1f'), format_value(row['segments_per_hour'], '.0f'),
+            row['slowest_stage'] or '-'))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Reports on the stage timings of feature extraction runs.")
+    parser.add_argument("command", help="'profile-report' prints per-stage and per-subject throughput tables.",
+                        choices=['profile-report'])
+    parser.add_argument("trace_files", help="The trace files written by the extraction runs.", nargs='+',
+                        metavar="TRACE_FILE")
+    parser.add_argument("--last-run", help="Only report on the latest run in the trace files.", action='store_true',
+                        dest='last_run')
+    parser.add_argument("--chrome-trace", help="Write a timeline of the jobs in the Chrome trace event format to "
+                                               "this file.",
+                        dest='chrome_trace')
+    args = parser.parse_args()
+
+    records = read_records(args.trace_files, last_run=args.last_run)
+    print_report(records)
+    if args.chrome_trace is not None:
+        with open(args.chrome_trace, 'w') as fp:
+            json.dump(chrome_trace(records), fp)
+        print()
+        print("Wrote the timeline of {} jobs to {}".format(len(records), args.chrome_trace))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+Module for generating synthetic EEG segments in the layout of the competition data, for testing and benchmarking the
+pipeline without the real data.
+
+The segments are matlab files with a single struct named like the real ones, for example 'preictal_segment_3', with
+the fields 'data' (channels x samples), 'data_length_sec', 'sampling_frequency', 'channels' and, for training
+segments, 'sequence'. The layouts of the subjects are in SUBJECT_LAYOUTS. The signal is band limited 1/f noise with a
+component shared between the channels at small lags, line noise and dropouts where all channels are zero, like the
+recordings. Preictal segments have a stronger shared component than interictal ones, so the features differ between
+the classes, but the data isn't meant for judging the classifiers.
+
+    synthetic.generate_dataset('data/synthetic', subjects=['Dog_1', 'Patient_1'], n_segments=4, duration=60)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import scipy.io
+
+#The sampling frequency and number of channels of the subjects of the competition
+SUBJECT_LAYOUTS = OrderedDict([('Dog_1', (400.0, 16)),
+                               ('Dog_2', (400.0, 16)),
+                               ('Dog_3', (400.0, 16)),
+                               ('Dog_4', (400.0, 16)),
+                               ('Dog_5', (400.0, 15)),
+                               ('Patient_1', (5000.0, 15)),
+                               ('Patient_2', (5000.0, 24))])
+
+SEGMENT_CLASSES = ('preictal', 'interictal', 'test')
+
+#The length of the competition segments in seconds
+SEGMENT_SECONDS = 600
+
+#The number of consecutive segments of a training hour, numbered by the 'sequence' field
+SEQUENCE_LENGTH = 6
+
+#The strength of the component shared between the channels, relative to the independent noise of every channel
+CLASS_COUPLING = dict(preictal=0.6, interictal=0.3)
+
+#The scale of the int16 samples, the signals have a standard deviation of about this many units
+SAMPLE_SCALE = 200.0
+
+
+def channel_names(subject, n_channels):
+    """
+    Returns channel names in the style of the subject, like NVC1202_32_002_Ecog_c001 for the dogs and LD_1 for the
+    patients, so that cross_correlate.convert_channel_name shortens them the same way.
+    """
+    if subject.startswith('Dog'):
+        return ['NVC0905_22_00{}_Ecog_c{:03d}'.format(subject[-1], i + 1) for i in range(n_channels)]
+    prefixes = ('LD', 'RD', 'LT', 'RT')
+    return ['{}_{}'.format(prefixes[(i // 8) % len(prefixes)], i % 8 + 1) for i in range(n_channels)]
+
+
+def segment_file_name(subject, segment_class, number):
+    """Returns the file name of a segment, like Dog_1_preictal_segment_0001.mat."""
+    return "{}_{}_segment_{:04d}.mat".format(subject, segment_class, number)
+
+
+def segment_seed(seed, subject, segment_class, number):
+    """Returns the random seed of a segment, which only depends on *seed* and the name of the segment."""
+    return zlib.crc32("{}:{}".format(seed, segment_file_name(subject, segment_class, number)).encode('utf-8')) \
+        & 0xffffffff
+
+
+def colored_noise(n_samples, sampling_frequency, random_state, low_frequency=0.5, high_frequency=None, exponent=1.0):
+    """
+    Creates band limited noise with a 1/f**exponent power spectrum and unit standard deviation.
+
+    :param n_samples: The number of samples.
+    :param sampling_frequency: The sampling frequency in Hz.
+    :param random_state: A numpy RandomState.
+    :param low_frequency: The frequency in Hz below which the spectrum is zero.
+    :param high_frequency: The frequency in Hz above which the spectrum is zero. Defaults to 180 Hz or 0.45 times the
+                           sampling frequency, whichever is lower, like the recording filters.
+    :param exponent: The exponent of the power spectrum.
+    :return: A 1d ndarray.
+    """
+    if high_frequency is None:
+        high_frequency = min(180.0, 0.45 * sampling_frequency)
+    frequencies = np.fft.rfftfreq(n_samples, 1.0 / sampling_frequency)
+    amplitudes = np.zeros(len(frequencies))
+    in_band = (frequencies >= low_frequency) & (frequencies <= high_frequency)
+    amplitudes[in_band] = frequencies[in_band] ** (-exponent / 2.0)
+    spectrum = amplitudes * (random_state.randn(len(frequencies)) + 1j * random_state.randn(len(frequencies)))
+    signal = np.fft.irfft(spectrum, n_samples)
+    std = signal.std()
+    return signal / std if std > 0 else signal
+
+
+def synthetic_signal(n_channels, sampling_frequency, duration, random_state, coupling=0.3, max_lag_seconds=0.02,
+                     line_frequency=60.0, line_amplitude=0.1, dropouts_per_segment=1.0):
+    """
+    Creates a synthetic multichannel EEG signal.
+
+    :param n_channels: The number of channels.
+    :param sampling_frequency: The sampling frequency in Hz.
+    :param duration: The length of the signal in seconds.
+    :param random_state: A numpy RandomState.
+    :param coupling: The amplitude of the component shared by the channels, relative to their own noise.
+    :param max_lag_seconds: The largest lag of the shared component in a channel.
+    :param line_frequency: The frequency of the line noise in Hz.
+    :param line_amplitude: The amplitude of the line noise, relative to the noise of the channels.
+    :param dropouts_per_segment: The expected number of dropouts per SEGMENT_SECONDS. During a dropout all channels are
+                                 zero, for between 0.1 and 2 seconds.
+    :return: A float64 ndarray of shape (n_channels, n_samples) with a standard deviation of about one.
+    """
+    n_samples = int(round(duration * sampling_frequency))
+    shared = colored_noise(n_samples, sampling_frequency, random_state)
+    time = np.arange(n_samples) / sampling_frequency
+    max_lag = int(max_lag_seconds * sampling_frequency)
+
+    data = np.empty((n_channels, n_samples))
+    for channel in range(n_channels):
+        lag = random_state.randint(-max_lag, max_lag + 1) if max_lag > 0 else 0
+        data[channel] = colored_noise(n_samples, sampling_frequency, random_state)
+        data[channel] += coupling * np.roll(shared, lag)
+        data[channel] += line_amplitude * np.sin(2 * np.pi * line_frequency * time + random_state.uniform(0, 2 * np.pi))
+    data /= np.sqrt(1 + coupling ** 2)
+
+    for _ in range(random_state.poisson(dropouts_per_segment * duration / SEGMENT_SECONDS)):
+        length = int(random_state.uniform(0.1, 2.0) * sampling_frequency)
+        start = random_state.randint(0, max(n_samples - length, 1))
+        data[:, start:start + length] = 0
+    return data
+
+
+def write_segment(path, data, sampling_frequency, channels, struct_name, sequence=None):
+    """
+    Writes a segment as a matlab file in the layout of the competition data.
+
+    :param path: The path of the file.
+    :param data: An int16 ndarray of shape (n_channels, n_samples).
+    :param sampling_frequency: The sampling frequency in Hz.
+    :param channels: The channel names.
+    :param struct_name: The name of the struct in the file, like preictal_segment_1.
+    :param sequence: The position of the segment within its hour, or None for test segments.
+    :return: None.
+    """
+    struct = dict(data=data,
+                  data_length_sec=int(round(data.shape[1] / sampling_frequency)),
+                  sampling_frequency=sampling_frequency,
+                  channels=np.array(channels, dtype=object))
+    if sequence is not None:
+        struct['sequence'] = sequence
+    # The file is written under a temporary name, so an interrupted generation doesn't leave a partial segment
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary_path, 'wb') as fp:
+        scipy.io.savemat(fp, {struct_name: struct}, do_compression=False)
+    os.rename(temporary_path, path)
+
+
+def generate_segment(output_dir, subject, segment_class, number, duration=SEGMENT_SECONDS, seed=0, overwrite=False):
+    """
+    Generates a synthetic segment of a subject.
+
+    :param output_dir: The directory to write the segment to.
+    :param subject: The subject name, one of the keys of SUBJECT_LAYOUTS.
+    :param segment_class: One of SEGMENT_CLASSES.
+    :param number: The number of the segment, starting from 1.
+    :param duration: The length of the segment in seconds.
+    :param seed: The seed of the dataset. The same seed and segment name always give the same segment.
+    :param overwrite: If False, an existing segment file is kept.
+    :return: The path of the segment file.
+    """
+    if segment_class not in SEGMENT_CLASSES:
+        raise ValueError("Segment class {} is unknown.".format(segment_class))
+    path = os.path.join(output_dir, segment_file_name(subject, segment_class, number))
+    if os.path.exists(path) and not overwrite:
+        return path
+
+    sampling_frequency, n_channels = SUBJECT_LAYOUTS[subject]
+    random_state = np.random.RandomState(segment_seed(seed, subject, segment_class, number))
+    if segment_class == 'test':
+        coupling = CLASS_COUPLING[random_state.choice(sorted(CLASS_COUPLING))]
+    else:
+        coupling = CLASS_COUPLING[segment_class]
+    signal = synthetic_signal(n_channels, sampling_frequency, duration, random_state, coupling=coupling)
+    data = np.clip(np.round(signal * SAMPLE_SCALE), np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+
+    sequence = (number - 1) % SEQUENCE_LENGTH + 1 if segment_class != 'test' else None
+    write_segment(path, data, sampling_frequency, channel_names(subject, n_channels),
+                  "{}_segment_{}".format(segment_class, number), sequence=sequence)
+    return path
+
+
+def generate_subject(output_dir, subject, n_segments=SEQUENCE_LENGTH, duration=SEGMENT_SECONDS, seed=0,
+                     overwrite=False):
+    """
+    Generates the segments of a subject in the directory *output_dir*/*subject*.
+
+    :param output_dir: The directory of the dataset.
+    :param subject: The subject name, one of the keys of SUBJECT_LAYOUTS.
+    :param n_segments: The number of segments per class, an int or a dictionary of segment classes to numbers.
+    :param duration: The length of the segments in seconds.
+    :param seed: The seed of the dataset.
+    :param overwrite: If False, existing segment files are kept.
+    :return: A list of the paths of the segments.
+    """
+    if subject not in SUBJECT_LAYOUTS:
+        raise ValueError("Subject {} is unknown, use one of {}.".format(subject, ', '.join(SUBJECT_LAYOUTS)))
+    if not isinstance(n_segments, dict):
+        n_segments = dict((segment_class, n_segments) for segment_class in SEGMENT_CLASSES)
+    subject_dir = os.path.join(output_dir, subject)
+    if not os.path.exists(subject_dir):
+        os.makedirs(subject_dir)
+    return [generate_segment(subject_dir, subject, segment_class, number, duration=duration, seed=seed,
+                             overwrite=overwrite)
+            for segment_class in SEGMENT_CLASSES
+            for number in range(1, n_segments.get(segment_class, 0) + 1)]
+
+
+def generate_dataset(output_dir, subjects=None, n_segments=SEQUENCE_LENGTH, duration=SEGMENT_SECONDS, seed=0,
+                     overwrite=False):
+    """
+    Generates a synthetic dataset with a directory per subject, laid out like the competition data.
+
+    :param output_dir: The directory of the dataset.
+    :param subjects: The subjects to generate, defaults to all subjects of SUBJECT_LAYOUTS.
+    :param n_segments: The number of segments per class and subject, see generate_subject.
+    :param duration: The length of the segments in seconds.
+    :param seed: The seed of the dataset.
+    :param overwrite: If False, existing segment files are kept, so a dataset can be generated once and reused.
+    :return: An OrderedDict of subject names to lists of segment paths.
+    """
+    if subjects is None:
+        subjects = list(SUBJECT_LAYOUTS)
+    return OrderedDict((subject, generate_subject(output_dir, subject, n_segments=n_segments, duration=duration,
+                                                  seed=seed, overwrite=overwrite))
+                       for subject in subjects)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generates synthetic EEG segments laid out like the competition "
+                                                 "data.")
+    parser.add_argument("output_dir", help="The directory to write the subject directories to.")
+    parser.add_argument("--subjects", help="The subjects to generate, defaults to all.", nargs='+',
+                        choices=list(SUBJECT_LAYOUTS))
+    parser.add_argument("--segments", help="The number of segments per class and subject.", type=int,
+                        default=SEQUENCE_LENGTH, dest='n_segments')
+    parser.add_argument("--duration", help="The length of the segments in seconds.", type=float,
+                        default=SEGMENT_SECONDS)
+    parser.add_argument("--seed", help="The seed of the dataset.", type=int, default=0)
+    parser.add_argument("--overwrite", help="Regenerate segments which already exist.", action='store_true')
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.output_dir, subjects=args.subjects, n_segments=args.n_segments,
+                               duration=args.duration, seed=args.seed, overwrite=args.overwrite)
+    for subject, paths in dataset.items():
+        print("{}: {} segments".format(subject, len(paths)))
+
+
+if __name__ == '__main__':
+    main()
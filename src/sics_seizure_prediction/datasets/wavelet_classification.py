@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 from . import fileutils
 from . import dataset
+from . import feature_io
+from . import feature_shards
 
 import pandas as pd
 import numpy as np
@@ -18,13 +20,77 @@ def load_csv(filename, frame_length=12, sliding_frames=False):
 
     # Read the csv file with pandas and extract the values into an numpy array
     from_file_array = pd.read_table(filename, sep=',', dtype=np.float64, header=None).values
+    return frames_to_dataframe(from_file_array, filename, frame_length=frame_length, sliding_frames=sliding_frames)
 
+
+def load_binary(filename, frame_length=12, sliding_frames=False):
+    """
+    Loads the wavelet or hills features from a binary feature file, see feature_io.FeatureArrays.from_frames. The
+    result is the same as for load_csv on the csv file of the same features.
+    :param filename: The binary feature file to load features from, or a feature shard record reference.
+    :param frame_length: The desired frame length in windows to use.
+    :param sliding_frames: If True, the data will be extended by using sliding frames of the feature windows.
+    :return: A DataFrame with the loaded features.
+    """
+    from_file_array = np.asarray(feature_shards.read_feature_arrays(filename)['frames'], dtype=np.float64)
+    return frames_to_dataframe(from_file_array, filename, frame_length=frame_length, sliding_frames=sliding_frames)
+
+
+def load_feature_file(filename, frame_length=12, sliding_frames=False):
+    """
+    Loads the wavelet or hills features from a csv or binary feature file, depending on the file extension, or from
+    a feature shard record.
+    :param filename: The filename to load features from.
+    :param frame_length: The desired frame length in windows to use.
+    :param sliding_frames: If True, the data will be extended by using sliding frames of the feature windows.
+    :return: A DataFrame with the loaded features.
+    """
+    if feature_io.is_feature_file(filename) or feature_shards.is_record_reference(filename):
+        return load_binary(filename, frame_length=frame_length, sliding_frames=sliding_frames)
+    return load_csv(filename, frame_length=frame_length, sliding_frames=sliding_frames)
+
+
+def feature_file_rows(filename, frame_length=12, sliding_frames=False):
+    """
+    Returns the number of rows load_feature_file returns for a file, without parsing it. Csv files are counted by
+    their non-empty lines, binary files and shard records by the shape in their header.
+    :param filename: The feature file or shard record reference.
+    :param frame_length: The desired frame length in windows to use.
+    :param sliding_frames: If True, the rows are sliding frames of the feature windows.
+    :return: The number of rows.
+    """
+    if feature_io.is_feature_file(filename) or feature_shards.is_record_reference(filename):
+        n_file_frames = feature_shards.read_feature_arrays(filename)['frames'].shape[0]
+    else:
+        with open(filename, 'rb') as fp:
+            n_file_frames = sum(1 for line in fp if line.strip())
+    n_windows = n_file_frames * 12
+    if sliding_frames:
+        return max(n_windows - (frame_length - 1), 0)
+    return n_windows // frame_length
+# Lets dataset.load_files_bulk preallocate the rows of all files
+load_csv.row_count = feature_file_rows
+load_binary.row_count = feature_file_rows
+load_feature_file.row_count = feature_file_rows
+
+
+def frames_to_dataframe(from_file_array, filename, frame_length=12, sliding_frames=False):
+    """
+    Splits the rows of a feature file, each holding a frame of 12 windows, into windows and combines them into frames
+    of *frame_length* windows.
+    :param from_file_array: A (frames x features) ndarray with the contents of the feature file.
+    :param filename: The name of the feature file, used in error messages.
+    :param frame_length: The desired frame length in windows to use.
+    :param sliding_frames: If True, the data will be extended by using sliding frames of the feature windows. The
+                           frames are then a read-only view of the windows, see dataset.extend_data_with_sliding_frames.
+    :return: A DataFrame with the features.
+    """
     # Assert that the csvfiles contain frames consisting 12 windows.
     assert_msg = 'file: "{}" does not have a column count divisible by 12 since it is: {}.'
     assert (from_file_array.shape[1] % 12) == 0, assert_msg.format(filename, from_file_array.shape[1])
 
     # Number of windows in the csv frame
-    window_size = from_file_array.shape[1] / 12
+    window_size = from_file_array.shape[1] // 12
     # Number of rows in the csv file
     n_rows = from_file_array.shape[0]*12
 
@@ -33,9 +99,9 @@ def load_csv(filename, frame_length=12, sliding_frames=False):
 
     # Extract this function out into its own file and use it also with the cross correlation frames
     if sliding_frames:
-        return pd.DataFrame(data=dataset.extend_data_with_sliding_frames(reshaped_array, frame_length))
+        return pd.DataFrame(data=dataset.extend_data_with_sliding_frames(reshaped_array, frame_length), copy=False)
     else:
-        n_frames = reshaped_array.shape[0]/frame_length
+        n_frames = reshaped_array.shape[0] // frame_length
         frame_size = window_size*frame_length
         return pd.DataFrame(data=reshaped_array.reshape(n_frames, frame_size))
 
@@ -47,8 +113,8 @@ def load_data_frames(feature_folder,
                      frame_length=12,
                      sliding_frames=False):
     return dataset.load_data_frames(feature_folder,
-                                    load_function=load_csv,
-                                    find_features_function=fileutils.find_feature_files,
+                                    load_function=load_feature_file,
+                                    find_features_function=fileutils.find_binary_or_csv_files,
                                     rebuild_data=rebuild_data,
                                     processes=processes,
                                     file_pattern=file_pattern,
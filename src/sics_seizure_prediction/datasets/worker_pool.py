@@ -0,0 +1,152 @@
+"""
+Module for a persistent pool of worker processes which is shared by the stages of a pipeline, like the feature
+extraction and feature loading of train.py.
+
+Creating a multiprocessing.Pool per call means every worker imports numpy, scipy, pandas and mne again and rebuilds
+the state which is cached per process, like the filter designs and the Morlet kernel bank of the wavelet features or
+the normalization statistics of the subjects. A WorkerPool is created once and reused. By default the workers are
+started by a fork server which has imported PRELOAD_MODULES, so the modules are loaded once and shared copy-on-write
+by all workers. Initializers can build further read-only state in every worker when it starts, and workers are
+replaced after a number of tasks to contain memory leaks.
+
+    with worker_pool.shared_pool(processes=8):
+        feature_extractor.extract(...)          # Both use the shared pool
+        dataset.load_feature_files(...)
+"""
+from __future__ import absolute_import
+
+import contextlib
+import importlib
+import logging
+import multiprocessing
+
+#The modules the fork server imports before starting any workers
+PRELOAD_MODULES = ('numpy', 'scipy.io', 'scipy.signal', 'pandas', 'mne',
+                   'sics_seizure_prediction.datasets.segment',
+                   'sics_seizure_prediction.features.feature_extractor')
+
+
+class WorkerPool(object):
+    """
+    A process pool which lives across several parallel stages. The underlying multiprocessing.Pool is available as
+    *pool*. The pool also holds a shared counter *remaining_tasks*, which a scheduler using the pool can keep up to
+    date so that its tasks know how loaded the pool is, see feature_extractor.ThreadBudget, and a queue *started_jobs*
+    the tasks can announce themselves on, so that the scheduler notices when a worker dies while running one, see
+    feature_extractor.announce_job. A scheduler which gives up on tasks whose worker died adds them to *lost_tasks*.
+    """
+    def __init__(self, processes, initializers=None, preload_modules=PRELOAD_MODULES, maxtasksperchild=None,
+                 start_method=None):
+        """
+        :param processes: The number of worker processes.
+        :param initializers: A list of (function, args) pairs which are called in every worker when it starts, for
+                             building read-only state which the tasks use. The functions must be importable by the
+                             workers.
+        :param preload_modules: The names of the modules the fork server imports, which the workers then share. Modules
+                                which can't be imported are skipped.
+        :param maxtasksperchild: The number of tasks after which a worker is replaced by a fresh one. If None, workers
+                                 live as long as the pool.
+        :param start_method: The multiprocessing start method. Defaults to 'forkserver' where it's available and to
+                             the default start method otherwise.
+        """
+        if start_method is None:
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+        context = multiprocessing.get_context(start_method)
+        if context.get_start_method() == 'forkserver':
+            context.set_forkserver_preload([name for name in preload_modules if importable(name)])
+
+        self.processes = processes
+        self.start_method = context.get_start_method()
+        self.remaining_tasks = context.Value('i', 0)
+        self.started_jobs = context.SimpleQueue()
+        self.lost_tasks = 0
+        self.pool = context.Pool(processes,
+                                 initializer=init_worker,
+                                 initargs=(self.remaining_tasks, processes, list(initializers or []),
+                                           self.started_jobs),
+                                 maxtasksperchild=maxtasksperchild)
+
+    def map(self, function, items):
+        """Applies *function* to the *items* in the pool and returns the results in order."""
+        return self.pool.map(function, items)
+
+    def apply_async(self, function, args=(), callback=None, error_callback=None):
+        """Runs *function* with *args* in the pool, see multiprocessing.Pool.apply_async."""
+        return self.pool.apply_async(function, args, callback=callback, error_callback=error_callback)
+
+    def close(self):
+        """
+        Waits for the submitted tasks and stops the workers. If tasks were lost, the pool would wait for them forever,
+        so the workers are terminated instead.
+        """
+        if self.lost_tasks:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+
+class WorkerState(object):
+    """The state of a worker process of a WorkerPool, see worker_state."""
+    def __init__(self, remaining_tasks, processes, started_jobs=None):
+        self.remaining_tasks = remaining_tasks
+        self.processes = processes
+        self.started_jobs = started_jobs
+
+
+def init_worker(remaining_tasks, processes, initializers, started_jobs=None):
+    """
+    Initializes a worker process of a WorkerPool.
+
+    :param remaining_tasks: The shared counter of the pool.
+    :param processes: The number of worker processes of the pool.
+    :param initializers: A list of (function, args) pairs to call.
+    :param started_jobs: The queue the tasks of the pool announce themselves on.
+    :return: None.
+    """
+    worker_state.state = WorkerState(remaining_tasks, processes, started_jobs)
+    for function, args in initializers:
+        function(*args)
+
+
+def worker_state():
+    """Returns the WorkerState of the process if it's a worker of a WorkerPool, otherwise None."""
+    return worker_state.state
+worker_state.state = None
+
+
+def importable(module_name):
+    """Returns True if the module can be imported."""
+    try:
+        importlib.import_module(module_name)
+        return True
+    except ImportError:
+        logging.warning("Not preloading %s, it can't be imported", module_name)
+        return False
+
+
+def current_pool():
+    """Returns the pool opened by shared_pool, or None if there isn't one."""
+    return current_pool.pool
+current_pool.pool = None
+
+
+@contextlib.contextmanager
+def shared_pool(processes, **pool_kwargs):
+    """
+    Context manager which opens a WorkerPool used by all parallel stages within the context which aren't given a
+    pool explicitly, see current_pool. The pool is closed when the context exits.
+
+    :param processes: The number of worker processes. If 1, no pool is created and the stages run serially.
+    :param pool_kwargs: Keyword arguments for WorkerPool.
+    :return: The WorkerPool, or None if *processes* is 1.
+    """
+    if processes <= 1 or current_pool.pool is not None:
+        yield current_pool.pool
+        return
+    pool = WorkerPool(processes, **pool_kwargs)
+    current_pool.pool = pool
+    try:
+        yield pool
+    finally:
+        current_pool.pool = None
+        pool.close()
@@ -0,0 +1,309 @@
+"""
+Module for benchmarking the feature extractors on synthetic segments, see datasets.synthetic.
+
+Every extractor in BENCHMARKS is timed at the scales of SCALES: a single segment, the segments of one subject and the
+whole generated dataset. The results are appended as JSON lines to a results file, together with the git commit of
+the code, so runs of different commits can be compared:
+
+    python -m sics_seizure_prediction.features.benchmark run /tmp/benchmark --workers 4
+    git checkout other-branch
+    python -m sics_seizure_prediction.features.benchmark run /tmp/benchmark --workers 4
+    python -m sics_seizure_prediction.features.benchmark compare /tmp/benchmark/benchmark_results.jsonl
+
+The synthetic dataset is generated in the benchmark directory once and reused by later runs with the same settings.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+from ..datasets import stage_timing
+from ..datasets import synthetic
+
+SCALES = ('segment', 'subject', 'dataset')
+
+RESULTS_FILE_NAME = 'benchmark_results.jsonl'
+
+#The subjects of the default benchmark dataset, one of each sampling rate
+DEFAULT_SUBJECTS = ('Dog_1', 'Patient_1')
+
+
+def run_hills(segment_paths, output_dir, workers):
+    """Extracts the features of hills_features with the default transformation."""
+    from . import hills_features
+    return hills_features.extract_features(segment_paths, output_dir, workers=workers, only_missing_files=False,
+                                           output_format='binary')
+
+
+def run_wavelets(segment_paths, output_dir, workers):
+    """Extracts the wavelet synchrony features with the default settings."""
+    from . import wavelets
+    return wavelets.extract_features(segment_paths, output_dir, workers=workers, only_missing_files=False,
+                                     output_format='binary')
+
+
+def run_xcorr(segment_paths, output_dir, workers):
+    """Extracts the cross-correlations of 5 second windows, with lags of up to half a second."""
+    from . import cross_correlate
+    return cross_correlate.extract_features(segment_paths, output_dir, workers=workers, only_missing_files=False,
+                                            time_delta_begin=-0.5, time_delta_end=0.5, time_delta_step=0.01,
+                                            output_format='binary')
+
+
+def run_stats(segment_paths, output_dir, workers):
+    """
+    Calculates the segment statistics of basic_segment_statistics, which works on subject directories. The segments
+    are linked into a directory per subject first.
+    """
+    from . import basic_segment_statistics
+    subject_paths = OrderedDict()
+    for segment_path in segment_paths:
+        subject_paths.setdefault(os.path.basename(os.path.dirname(segment_path)), []).append(segment_path)
+    for subject, paths in subject_paths.items():
+        subject_dir = os.path.join(output_dir, 'segments', subject)
+        os.makedirs(subject_dir)
+        for path in paths:
+            os.symlink(os.path.abspath(path), os.path.join(subject_dir, os.path.basename(path)))
+        basic_segment_statistics.calculate_statistics(subject_dir, output_dir)
+    return None
+
+
+#The benchmarked extractors. A benchmark function takes the segment paths, an output directory and the number of
+#workers, and returns the manifest of the extraction run or None
+BENCHMARKS = OrderedDict([('hills', run_hills),
+                          ('wavelets', run_wavelets),
+                          ('xcorr', run_xcorr),
+                          ('stats', run_stats)])
+
+
+def scale_segments(dataset, scale):
+    """
+    Returns the segments of a scale.
+
+    :param dataset: An OrderedDict of subject names to segment paths, as returned by synthetic.generate_dataset.
+    :param scale: One of SCALES.
+    :return: A list of segment paths: the first segment of the first subject, all segments of the first subject, or
+             all segments.
+    """
+    first_subject = list(dataset.values())[0]
+    if scale == 'segment':
+        return first_subject[:1]
+    elif scale == 'subject':
+        return list(first_subject)
+    elif scale == 'dataset':
+        return [path for paths in dataset.values() for path in paths]
+    raise ValueError("Scale {} is unknown.".format(scale))
+
+
+def code_version():
+    """
+    Returns the git commit of the code and whether the working tree has changes, as a pair. The commit is None if it
+    can't be determined.
+    """
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=code_dir,
+                                         stderr=subprocess.STDOUT).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=code_dir,
+                                         stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+    return commit, bool(status)
+
+
+def trace_stage_seconds(trace_file):
+    """Returns a dictionary of stage names to their total seconds in a trace file, see datasets.stage_timing."""
+    if trace_file is None or not os.path.exists(trace_file):
+        return dict()
+    return dict((row['stage'], row['seconds'])
+                for row in stage_timing.stage_table(stage_timing.read_records([trace_file])))
+
+
+def run_benchmark(name, segment_paths, output_dir, workers=1):
+    """
+    Times one benchmark.
+
+    :param name: The name of the benchmark, one of the keys of BENCHMARKS.
+    :param segment_paths: The segments to extract features from.
+    :param output_dir: An empty directory for the features.
+    :param workers: The number of worker processes.
+    :return: A dictionary with the keys 'seconds', 'n_segments', 'megabytes', 'segments_per_second', 'mb_per_second',
+             'failed' and 'stages', the seconds of the extraction stages.
+    """
+    start = time.time()
+    manifest = BENCHMARKS[name](segment_paths, output_dir, workers)
+    seconds = time.time() - start
+    megabytes = sum(os.path.getsize(path) for path in segment_paths) / 2**20
+    return dict(seconds=seconds,
+                n_segments=len(segment_paths),
+                megabytes=megabytes,
+                segments_per_second=len(segment_paths) / seconds,
+                mb_per_second=megabytes / seconds,
+                failed=len(manifest['failed']) if manifest is not None else 0,
+                stages=trace_stage_seconds(manifest.get('trace_file') if manifest is not None else None))
+
+
+def run_benchmarks(benchmark_dir, benchmarks=None, scales=SCALES, subjects=DEFAULT_SUBJECTS, n_segments=2,
+                   duration=synthetic.SEGMENT_SECONDS, workers=1, results_file=None, keep_output=False):
+    """
+    Generates the synthetic dataset if needed and runs the benchmarks at the given scales.
+
+    :param benchmark_dir: The directory of the synthetic dataset, the feature files and the results.
+    :param benchmarks: The names of the benchmarks to run, defaults to all of BENCHMARKS.
+    :param scales: The scales to run the benchmarks at.
+    :param subjects: The subjects of the synthetic dataset.
+    :param n_segments: The number of segments per class and subject.
+    :param duration: The length of the segments in seconds.
+    :param workers: The number of worker processes of the extractions.
+    :param results_file: The JSON lines file the results are appended to. Defaults to RESULTS_FILE_NAME in
+                         *benchmark_dir*.
+    :param keep_output: If True, the feature files are kept, otherwise they are removed after every benchmark.
+    :return: A list of result dictionaries, see run_benchmark. They also have the keys 'benchmark', 'scale',
+             'commit', 'dirty', 'host', 'started', 'workers' and 'dataset'.
+    """
+    if benchmarks is None:
+        benchmarks = list(BENCHMARKS)
+    if results_file is None:
+        results_file = os.path.join(benchmark_dir, RESULTS_FILE_NAME)
+
+    dataset_settings = dict(subjects=list(subjects), n_segments=n_segments, duration=duration)
+    data_dir = os.path.join(benchmark_dir, "data_{}s_{}".format(int(duration), n_segments))
+    dataset = synthetic.generate_dataset(data_dir, subjects=subjects, n_segments=n_segments, duration=duration)
+
+    commit, dirty = code_version()
+    results = []
+    for name in benchmarks:
+        for scale in scales:
+            output_dir = os.path.join(benchmark_dir, 'features', "{}_{}".format(name, scale))
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            os.makedirs(output_dir)
+            started = datetime.datetime.now()
+            result = run_benchmark(name, scale_segments(dataset, scale), output_dir, workers=workers)
+            result.update(benchmark=name, scale=scale, commit=commit, dirty=dirty, host=socket.gethostname(),
+                          started=started.isoformat(), workers=workers, dataset=dataset_settings)
+            results.append(result)
+            with open(results_file, 'a') as fp:
+                fp.write(json.dumps(result, sort_keys=True) + '\n')
+            print("{:<10}{:<10}{:>10.2f} s{:>10.2f} segments/s{:>10.2f} MB/s".format(
+                name, scale, result['seconds'], result['segments_per_second'], result['mb_per_second']))
+            if not keep_output:
+                shutil.rmtree(output_dir)
+    return results
+
+
+def read_results(results_file):
+    """Returns the result dictionaries of a results file, in the order they were written."""
+    with open(results_file) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def compare_results(results, baseline=None, candidate=None):
+    """
+    Compares the results of two commits. Where a commit has several results for a benchmark and scale, the latest
+    one is used. Results are only compared if they were run on the same dataset with the same number of workers.
+
+    :param results: Result dictionaries as returned by read_results.
+    :param baseline: The commit to compare against, or a prefix of it. Defaults to the commit before *candidate* in
+                     the results.
+    :param candidate: The commit to compare, or a prefix of it. Defaults to the commit of the latest result.
+    :return: A triple of the baseline commit, the candidate commit and a list of dictionaries with the keys
+             'benchmark', 'scale', 'baseline_seconds', 'candidate_seconds' and 'speedup', the baseline time divided by
+             the candidate time.
+    """
+    commits = []
+    for result in results:
+        if result['commit'] not in commits:
+            commits.append(result['commit'])
+
+    def find_commit(prefix):
+        matches = [commit for commit in commits if commit is not None and commit.startswith(prefix)]
+        if len(matches) != 1:
+            raise ValueError("Commit {} matches {} commits of the results.".format(prefix, len(matches)))
+        return matches[0]
+
+    candidate = find_commit(candidate) if candidate is not None else results[-1]['commit']
+    if baseline is not None:
+        baseline = find_commit(baseline)
+    else:
+        earlier = commits[:commits.index(candidate)]
+        if not earlier:
+            raise ValueError("The results have no commit before {}.".format(candidate))
+        baseline = earlier[-1]
+
+    def latest(commit):
+        by_key = OrderedDict()
+        for result in results:
+            if result['commit'] == commit:
+                by_key[result['benchmark'], result['scale'], json.dumps(result['dataset'], sort_keys=True),
+                       result['workers']] = result
+        return by_key
+
+    baseline_results = latest(baseline)
+    comparison = []
+    for key, result in latest(candidate).items():
+        if key not in baseline_results:
+            continue
+        baseline_seconds = baseline_results[key]['seconds']
+        comparison.append(dict(benchmark=result['benchmark'],
+                               scale=result['scale'],
+                               baseline_seconds=baseline_seconds,
+                               candidate_seconds=result['seconds'],
+                               speedup=baseline_seconds / result['seconds'] if result['seconds'] > 0 else None))
+    return baseline, candidate, comparison
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks the feature extractors on synthetic segments.")
+    parser.add_argument("command", help="'run' runs the benchmarks, 'compare' compares the results of two commits.",
+                        choices=['run', 'compare'])
+    parser.add_argument("path", help="For 'run', the benchmark directory. For 'compare', the results file.")
+    parser.add_argument("--benchmarks", help="The benchmarks to run, defaults to all.", nargs='+',
+                        choices=list(BENCHMARKS))
+    parser.add_argument("--scales", help="The scales to run the benchmarks at.", nargs='+', choices=SCALES,
+                        default=list(SCALES))
+    parser.add_argument("--subjects", help="The subjects of the synthetic dataset.", nargs='+',
+                        choices=list(synthetic.SUBJECT_LAYOUTS), default=list(DEFAULT_SUBJECTS))
+    parser.add_argument("--segments", help="The number of segments per class and subject.", type=int, default=2,
+                        dest='n_segments')
+    parser.add_argument("--duration", help="The length of the segments in seconds.", type=float,
+                        default=synthetic.SEGMENT_SECONDS)
+    parser.add_argument("--workers", help="The number of worker processes of the extractions.", type=int, default=1)
+    parser.add_argument("--results-file", help="The file to append the results to. Defaults to {} in the benchmark "
+                                               "directory.".format(RESULTS_FILE_NAME),
+                        dest='results_file')
+    parser.add_argument("--keep-output", help="Keep the feature files of the benchmarks.", action='store_true',
+                        dest='keep_output')
+    parser.add_argument("--baseline", help="The commit to compare against, defaults to the one before the candidate.")
+    parser.add_argument("--candidate", help="The commit to compare, defaults to the latest one.")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        results = run_benchmarks(args.path, benchmarks=args.benchmarks, scales=args.scales, subjects=args.subjects,
+                                 n_segments=args.n_segments, duration=args.duration, workers=args.workers,
+                                 results_file=args.results_file, keep_output=args.keep_output)
+        sys.exit(1 if any(result['failed'] for result in results) else 0)
+
+    baseline, candidate, comparison = compare_results(read_results(args.path), baseline=args.baseline,
+                                                      candidate=args.candidate)
+    print("Baseline {}, candidate {}".format(baseline, candidate))
+    print("{:<10}{:<10}{:>12}{:>12}{:>10}".format('benchmark', 'scale', 'baseline s', 'candidate s', 'speedup'))
+    for row in comparison:
+        print("{:<10}{:<10}{:>12.2f}{:>12.2f}{:>10}".format(
+            row['benchmark'], row['scale'], row['baseline_seconds'], row['candidate_seconds'],
+            '-' if row['speedup'] is None else "{:.2f}x".format(row['speedup'])))
+
+
+if __name__ == '__main__':
+    main()
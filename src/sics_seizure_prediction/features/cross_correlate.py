@@ -5,15 +5,19 @@ Module for calculating the cross correlation between channels.
 from __future__ import division
 from __future__ import absolute_import
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import os.path
 import csv
 import re
+import sys
 
 import numpy as np
 
+from . import feature_cache
 from . import feature_extractor
 from ..datasets import fileutils
+from ..datasets import feature_io
+from ..datasets import stage_timing
 
 csv_fieldnames = ['channel_i', 'channel_j', 'start_sample', 'end_sample', 't_offset', 'correlation']
 
@@ -31,7 +35,8 @@ def convert_channel_name(name):
 
 def calculate_cross_correlations(s, time_delta_config, channels=None, window_length=None,
                                  segment_start=None, segment_end=None, all_time_deltas=False,
-                                 old_csv_format=False):
+                                 old_csv_format=False, method='batched', lag_search='exhaustive', coarse_factor=4,
+                                 n_candidates=3, output_format='csv', threads=1):
     """
     Calculates the maximum cross-correlation of all pairs of channels in the segment *s*.
 
@@ -52,60 +57,65 @@ def calculate_cross_correlations(s, time_delta_config, channels=None, window_len
                             kept.
     :param old_csv_format: If True, the old inefficient CSV file format is used. If False, the new much more space
                            efficient format is used. Both formats encode the same information.
-    :return: A list of dictionaries, where each dictionary correspond to a row of correlation data at a specific time
-             lag. The contents of the dictionaries depend on the csv format used. The old format has every dictionary
-             as a single channel pair at a single window and time lag, the new format has the dictionaries as all the
-             channel pairs for a specific window and time lag.
+    :param method: The method used for calculating the correlations. 'batched' calculates all channel pairs of a
+                   window at once, see window_crosscorrelations. 'fft' and 'direct' calculate one channel pair and
+                   window at a time, see maximum_crosscorrelation.
+    :param lag_search: How the maximum correlation is searched for, either 'exhaustive' or 'coarse-to-fine', see
+                       maximum_crosscorrelation. Only used if all_time_deltas is False.
+    :param coarse_factor: The coarse lag grid step as a multiple of the time delta step, for the coarse-to-fine search.
+    :param n_candidates: The number of coarse lags which are refined, for the coarse-to-fine search.
+    :param output_format: Either 'csv' or 'binary'. See the return value.
+    :param threads: The number of threads the windows of the segment are divided between, an int or a
+                    feature_extractor.ThreadBudget.
+    :return: If output_format is 'csv', a list of dictionaries, where each dictionary correspond to a row of
+             correlation data at a specific time lag. The contents of the dictionaries depend on the csv format used.
+             The old format has every dictionary as a single channel pair at a single window and time lag, the new
+             format has the dictionaries as all the channel pairs for a specific window and time lag.
+             If output_format is 'binary', a FeatureArrays object as described by correlation_arrays.
+             If all_time_deltas is True, the correlations are instead calculated while they are written by
+             feature_extractor.write_features, using constant memory. The new csv format is then returned as a
+             feature_extractor.RowStream, see stream_correlation_rows, and the binary format as a
+             feature_io.StreamedFeatureArrays, see stream_correlation_arrays. The old csv format is never streamed.
     """
+    if output_format not in ('csv', 'binary'):
+        raise ValueError("Output format {} is unknown.".format(output_format))
+
     if channels is None:
         channels = s.get_channels()
 
     frequency = s.get_sampling_frequency()
+    with stage_timing.stage('window'):
+        windows = segment_windows(s, window_length, segment_start, segment_end)
+        pair_ranges = channel_pair_ranges(channels, time_delta_config, frequency)
 
-    if segment_start is None:
-        segment_start = 0
-    if segment_end is None:
-        segment_end = s.get_duration()
+    window_results = crosscorrelation_windows(s, channels, pair_ranges, windows, all_time_deltas,
+                                              method=method,
+                                              lag_search=lag_search,
+                                              coarse_factor=coarse_factor,
+                                              n_candidates=n_candidates,
+                                              threads=threads)
 
-    results = defaultdict(list)
+    # All time lags can be far too much to hold in memory, so they are written window by window as they are calculated
+    if all_time_deltas and output_format == 'binary':
+        return stream_correlation_arrays(window_results, window_sample_bounds(s, channels, windows), pair_ranges,
+                                         frequency)
+    if all_time_deltas and not old_csv_format:
+        return stream_correlation_rows(window_results, pair_ranges, frequency)
 
-    for i, channel_i in enumerate(channels[:-1]):
-        for channel_j in channels[i + 1:]:
-            if (channel_i, channel_j) in time_delta_config:
-                time_delta_begin, time_delta_end, time_delta_step = time_delta_config[channel_i, channel_j]
-            elif (channel_j, channel_i) in time_delta_config:
-                time_delta_begin, time_delta_end, time_delta_step = time_delta_config[channel_j, channel_i]
-            else:
-                time_delta_begin, time_delta_end, time_delta_step = time_delta_config['default', 'default']
-
-            # Convert the time shifts range from seconds to discrete sample steps, the step range must be at least 1
-            time_delta_range = (int(time_delta_begin * frequency),
-                                int(time_delta_end * frequency),
-                                max(int(time_delta_step * frequency), 1))
-
-            if window_length is not None:
-                windows = [(window_start, window_start + window_length)
-                           for window_start
-                           in np.arange(segment_start, segment_end, window_length)]
-            else:
-                windows = [(segment_start, segment_end)]
-
-            for window_start, window_end in windows:
-                window_i = s.get_channel_data(channel_i, window_start, window_end)
-                window_j = s.get_channel_data(channel_j, window_start, window_end)
-
-                # We skip strange boundary cases where the slice is too small to be useful
-                if len(window_i) > 2:
-                    time_deltas = maximum_crosscorrelation(window_i, window_j, time_delta_range, all_time_deltas)
-                    # Time_deltas is a list of (delta_t, correlation) values, if all_time_deltas is False,
-                    # it will be the maximum correlation
-                    for delta_t, correlation in time_deltas:
-                        t_offset = delta_t / float(frequency)
+    results = defaultdict(list)
+    for window_start, window_end, pair_time_deltas in window_results:
+        for (channel_i, channel_j), time_deltas in pair_time_deltas.items():
+            # Time_deltas is a list of (delta_t, correlation) values, if all_time_deltas is False,
+            # it will be the maximum correlation
+            for delta_t, correlation in time_deltas:
+                t_offset = delta_t / float(frequency)
+                results[(channel_i, channel_j)].append((window_start,
+                                                        window_end,
+                                                        t_offset,
+                                                        correlation))
 
-                        results[(channel_i, channel_j)].append((window_start,
-                                                                window_end,
-                                                                t_offset,
-                                                                correlation))
+    if output_format == 'binary':
+        return correlation_arrays(results, [pair for pair, _ in pair_ranges], frequency)
 
     # We should return a list of dictionaries, where the keys of each dictionary are the same and will be the columns
     # of the csv file
@@ -142,7 +152,456 @@ def calculate_cross_correlations(s, time_delta_config, channels=None, window_len
         return table
 
 
-def maximum_crosscorrelation(x, y, time_delta_range, all_time_deltas=False):
+def correlation_arrays(results, pairs, frequency):
+    """
+    Packs the maximum correlation results as dense arrays. The arrays of the binary cross-correlation files are:
+
+    'correlations': A (n_windows x n_lags x n_pairs) array. In all time deltas mode, the lag axis holds the union of
+                    the time lags of all pairs, with NaN for lags a pair wasn't calculated for. Otherwise the lag axis
+                    has length 1 and holds the maximum correlation.
+    'window_starts', 'window_ends': The window bounds in seconds.
+    'lags': In all time deltas mode, the time lags in seconds of the lag axis.
+    'best_lags': Otherwise, a (n_windows x n_pairs) array with the time lag in seconds of the maximum correlation.
+
+    The pair names, in the same format as the columns of the csv files, are given in the attribute 'pairs'.
+
+    This function writes the maximum correlation format, the all time deltas format is written by
+    stream_correlation_arrays.
+
+    :param results: A dictionary of channel pairs to lists of (window_start, window_end, t_offset, correlation) tuples,
+                    with one tuple per window.
+    :param pairs: The channel pairs in the order they should be stored.
+    :param frequency: The sampling frequency of the segment, stored as an attribute.
+    :return: A FeatureArrays object.
+    """
+    windows = sorted(set((window_start, window_end)
+                         for result_tuples in results.values()
+                         for window_start, window_end, _, _ in result_tuples))
+    window_indices = dict((window, i) for i, window in enumerate(windows))
+    pair_indices = dict((pair, i) for i, pair in enumerate(pairs))
+
+    correlations = np.full((len(windows), 1, len(pairs)), np.nan)
+    best_lags = np.full((len(windows), len(pairs)), np.nan)
+    for pair, result_tuples in results.items():
+        for window_start, window_end, t_offset, correlation in result_tuples:
+            window_index = window_indices[window_start, window_end]
+            correlations[window_index, 0, pair_indices[pair]] = correlation
+            # The lag is None if no correlation could be calculated
+            if t_offset is not None:
+                best_lags[window_index, pair_indices[pair]] = t_offset
+
+    arrays = OrderedDict()
+    arrays['correlations'] = correlations
+    arrays['window_starts'] = np.array([window_start for window_start, _ in windows], dtype=np.float64)
+    arrays['window_ends'] = np.array([window_end for _, window_end in windows], dtype=np.float64)
+    arrays['best_lags'] = best_lags
+    return feature_io.FeatureArrays(arrays, correlation_attributes(pairs, frequency, all_time_deltas=False))
+
+
+def correlation_attributes(pairs, frequency, all_time_deltas):
+    """Returns the header attributes of a binary cross-correlation file, see correlation_arrays."""
+    return dict(feature='cross_correlation',
+                pairs=[pair_name(channel_i, channel_j) for channel_i, channel_j in pairs],
+                sampling_frequency=float(frequency),
+                all_time_deltas=all_time_deltas)
+
+
+def pair_name(channel_i, channel_j):
+    """Returns the name used for the channel pair in the feature files."""
+    return convert_channel_name(channel_i) + ':' + convert_channel_name(channel_j)
+
+
+def pair_time_offsets(pair_ranges, frequency):
+    """
+    Returns the time lags in seconds of every channel pair, in the same way as they are given in the feature files.
+
+    :param pair_ranges: A list of ((channel_i, channel_j), time_delta_range) pairs as given by channel_pair_ranges.
+    :param frequency: The sampling frequency the time delta ranges are given in.
+    :return: A dictionary of channel pairs to lists of time lags in seconds, in the order given by time_lags.
+    """
+    range_offsets = dict()
+    for _, time_delta_range in pair_ranges:
+        if time_delta_range not in range_offsets:
+            range_offsets[time_delta_range] = [delta_t / float(frequency) for delta_t in time_lags(time_delta_range)]
+    return dict((pair, range_offsets[time_delta_range]) for pair, time_delta_range in pair_ranges)
+
+
+def stream_correlation_rows(window_results, pair_ranges, frequency):
+    """
+    Writes the correlations at all time lags in the new csv format one window at a time.
+
+    :param window_results: An iterator of (window_start, window_end, pair_time_deltas) triples as given by
+                           crosscorrelation_windows, with the correlations at all time lags.
+    :param pair_ranges: A list of ((channel_i, channel_j), time_delta_range) pairs as given by channel_pair_ranges.
+    :param frequency: The sampling frequency the time delta ranges are given in.
+    :return: A feature_extractor.RowStream with the same rows as the new csv format of calculate_cross_correlations.
+    """
+    pair_names = [(pair, pair_name(*pair)) for pair, _ in pair_ranges]
+
+    def rows():
+        for window_start, window_end, pair_time_deltas in window_results:
+            # Only one window is grouped by time lag at a time
+            t_offset_grouped = defaultdict(dict)
+            for pair, name in pair_names:
+                for delta_t, correlation in pair_time_deltas.get(pair, []):
+                    t_offset_grouped[delta_t / float(frequency)][name] = correlation
+            for t_offset, channel_correlations in sorted(t_offset_grouped.items()):
+                row = dict(start_sample=window_start,
+                           end_sample=window_end,
+                           t_offset=t_offset)
+                row.update(channel_correlations)
+                yield row
+
+    fieldnames = ['start_sample', 'end_sample', 't_offset'] + [name for _, name in pair_names]
+    return feature_extractor.RowStream(fieldnames, rows())
+
+
+def stream_correlation_arrays(window_results, sample_bounds, pair_ranges, frequency):
+    """
+    Writes the correlations at all time lags in the binary format one window at a time. The layout is described in
+    correlation_arrays, with the time lags of the lag axis in the array 'lags'.
+
+    :param window_results: An iterator of (window_start, window_end, pair_time_deltas) triples as given by
+                           crosscorrelation_windows, with the correlations at all time lags.
+    :param sample_bounds: The windows which *window_results* will give, as returned by window_sample_bounds.
+    :param pair_ranges: A list of ((channel_i, channel_j), time_delta_range) pairs as given by channel_pair_ranges.
+    :param frequency: The sampling frequency the time delta ranges are given in.
+    :return: A feature_io.StreamedFeatureArrays object.
+    """
+    pairs = [pair for pair, _ in pair_ranges]
+    offsets = pair_time_offsets(pair_ranges, frequency)
+    lags = sorted(set(t_offset for pair_offsets in offsets.values() for t_offset in pair_offsets))
+    lag_indices = dict((t_offset, i) for i, t_offset in enumerate(lags))
+    window_indices = dict(((window_start, window_end), i)
+                          for i, (window_start, window_end, _, _) in enumerate(sample_bounds))
+
+    # The lag axis positions of every pair, the correlations of a pair are given in the order of time_lags
+    pair_lag_indices = [np.array([lag_indices[t_offset] for t_offset in offsets[pair]], dtype=int) for pair in pairs]
+
+    def chunks():
+        for window_start, window_end, pair_time_deltas in window_results:
+            window_correlations = np.full((len(lags), len(pairs)), np.nan)
+            for pair_index, pair in enumerate(pairs):
+                time_deltas = pair_time_deltas.get(pair)
+                if time_deltas:
+                    window_correlations[pair_lag_indices[pair_index], pair_index] = [correlation for _, correlation
+                                                                                     in time_deltas]
+            yield 'correlations', window_indices[window_start, window_end], window_correlations
+
+    arrays = OrderedDict()
+    arrays['window_starts'] = np.array([window_start for window_start, _, _, _ in sample_bounds], dtype=np.float64)
+    arrays['window_ends'] = np.array([window_end for _, window_end, _, _ in sample_bounds], dtype=np.float64)
+    arrays['lags'] = np.array(lags, dtype=np.float64)
+    streamed_arrays = OrderedDict()
+    streamed_arrays['correlations'] = ((len(sample_bounds), len(lags), len(pairs)), np.float64, np.nan)
+    return feature_io.StreamedFeatureArrays(arrays, streamed_arrays, chunks(),
+                                            correlation_attributes(pairs, frequency, all_time_deltas=True))
+
+
+def segment_windows(s, window_length=None, segment_start=None, segment_end=None):
+    """
+    Returns the windows of the segment *s* which the correlations are calculated over.
+
+    :param s: The segment object.
+    :param window_length: The window length in seconds. If None, the whole of the segment is a single window.
+    :param segment_start: The time in seconds to start the windows from, defaults to the start of the segment.
+    :param segment_end: The time in seconds to end the windows at, defaults to the end of the segment.
+    :return: A list of (window_start, window_end) pairs in seconds.
+    """
+    if segment_start is None:
+        segment_start = 0
+    if segment_end is None:
+        segment_end = s.get_duration()
+
+    if window_length is not None:
+        return [(window_start, window_start + window_length)
+                for window_start
+                in np.arange(segment_start, segment_end, window_length)]
+    else:
+        return [(segment_start, segment_end)]
+
+
+def channel_pair_ranges(channels, time_delta_config, frequency):
+    """
+    Returns the time lag range in samples for every pair of channels.
+
+    :param channels: The channels to pair up.
+    :param time_delta_config: A dictionary of channel pairs to time delta range triplets in seconds, see
+                              calculate_cross_correlations.
+    :param frequency: The sampling frequency used for converting the time deltas to samples.
+    :return: A list of ((channel_i, channel_j), (begin, end, step)) pairs, with the time lag ranges in samples.
+    """
+    pair_ranges = []
+    for i, channel_i in enumerate(channels[:-1]):
+        for channel_j in channels[i + 1:]:
+            if (channel_i, channel_j) in time_delta_config:
+                time_delta_begin, time_delta_end, time_delta_step = time_delta_config[channel_i, channel_j]
+            elif (channel_j, channel_i) in time_delta_config:
+                time_delta_begin, time_delta_end, time_delta_step = time_delta_config[channel_j, channel_i]
+            else:
+                time_delta_begin, time_delta_end, time_delta_step = time_delta_config['default', 'default']
+
+            # Convert the time shifts range from seconds to discrete sample steps, the step range must be at least 1
+            time_delta_range = (int(time_delta_begin * frequency),
+                                int(time_delta_end * frequency),
+                                max(int(time_delta_step * frequency), 1))
+            pair_ranges.append(((channel_i, channel_j), time_delta_range))
+    return pair_ranges
+
+
+def window_sample_bounds(s, channels, windows):
+    """
+    Returns the sample bounds of the windows which the correlations are calculated over.
+
+    :param s: The segment object.
+    :param channels: The channels the correlations are calculated for.
+    :param windows: A list of (window_start, window_end) pairs in seconds.
+    :return: A list of (window_start, window_end, start_index, end_index) tuples. Windows with too few samples to be
+             useful are left out.
+    """
+    frequency = s.get_sampling_frequency()
+    n_samples = s.get_n_samples()
+
+    # The window lengths are taken from get_channel_data since the segment classes don't agree on whether the end
+    # sample is included
+    sample_bounds = []
+    for window_start, window_end in windows:
+        start_index = int(np.floor(window_start * frequency))
+        end_index = min(start_index + len(s.get_channel_data(channels[0], window_start, window_end)), n_samples)
+        # We skip strange boundary cases where the slice is too small to be useful
+        if end_index - start_index > 2:
+            sample_bounds.append((window_start, window_end, start_index, end_index))
+    return sample_bounds
+
+
+def crosscorrelation_windows(s, channels, pair_ranges, windows, all_time_deltas=False, method='batched',
+                             lag_search='exhaustive', coarse_factor=4, n_candidates=3, threads=1):
+    """
+    Calculates the cross-correlations of the channel pairs one window at a time.
+
+    :param s: The segment object to calculate the correlations from.
+    :param channels: The channels to calculate correlations for.
+    :param pair_ranges: A list of ((channel_i, channel_j), time_delta_range) pairs as given by channel_pair_ranges.
+    :param windows: A list of (window_start, window_end) pairs in seconds.
+    :param all_time_deltas: If True, the correlations at all time lags are kept, otherwise only the maximum.
+    :param method: The method used for calculating the correlations, see calculate_cross_correlations.
+    :param lag_search: Either 'exhaustive' or 'coarse-to-fine', see maximum_crosscorrelation.
+    :param coarse_factor: The coarse lag grid step as a multiple of the time delta step, for the coarse-to-fine search.
+    :param n_candidates: The number of coarse lags which are refined, for the coarse-to-fine search.
+    :param threads: The number of threads the windows are divided between, an int or a feature_extractor.ThreadBudget
+                    which is checked for every group of windows. The windows (or window chunks) are calculated a
+                    group of one per thread at a time, so the results are still produced in order.
+    :return: A generator of (window_start, window_end, pair_time_deltas) triples in the same format as the one
+             returned by window_crosscorrelations.
+    """
+    if method == 'batched':
+        for window_result in window_crosscorrelations(s, channels, pair_ranges, windows, all_time_deltas,
+                                                      lag_search=lag_search,
+                                                      coarse_factor=coarse_factor,
+                                                      n_candidates=n_candidates,
+                                                      threads=threads):
+            yield window_result
+        return
+
+    def window_pair_correlations(bounds):
+        window_start, window_end, _, _ = bounds
+        pair_time_deltas = dict()
+        for (channel_i, channel_j), time_delta_range in pair_ranges:
+            window_i = s.get_channel_data(channel_i, window_start, window_end)
+            window_j = s.get_channel_data(channel_j, window_start, window_end)
+            pair_time_deltas[channel_i, channel_j] = maximum_crosscorrelation(window_i, window_j, time_delta_range,
+                                                                              all_time_deltas,
+                                                                              method=method,
+                                                                              lag_search=lag_search,
+                                                                              coarse_factor=coarse_factor,
+                                                                              n_candidates=n_candidates)
+        return window_start, window_end, pair_time_deltas
+
+    sample_bounds = window_sample_bounds(s, channels, windows)
+    group_start = 0
+    while group_start < len(sample_bounds):
+        n_threads = feature_extractor.current_threads(threads)
+        group = sample_bounds[group_start:group_start + n_threads]
+        group_start += len(group)
+        for window_result in feature_extractor.thread_map(window_pair_correlations, group, n_threads):
+            yield window_result
+
+
+def window_crosscorrelations(s, channels, pair_ranges, windows, all_time_deltas=False, window_chunk=16,
+                             lag_search='exhaustive', coarse_factor=4, n_candidates=3, threads=1):
+    """
+    Calculates the cross-correlations of all the channel pairs in *pair_ranges* for every window of the segment *s*.
+    The windows are cut from the segment into a (windows x channels x samples) tensor and the channel energies are
+    calculated once per window, after which all the pairs sharing a time lag range are calculated together. Ranges
+    with few lags are calculated with batched matrix products over the channels, one product per lag, while ranges
+    with many lags are calculated from the FFTs of the channels. The results are the same as for
+    maximum_crosscorrelation.
+
+    :param s: The segment object to calculate the correlations from.
+    :param channels: The channels to calculate correlations for.
+    :param pair_ranges: A list of ((channel_i, channel_j), time_delta_range) pairs as given by channel_pair_ranges.
+    :param windows: A list of (window_start, window_end) pairs in seconds.
+    :param all_time_deltas: If True, the correlations at all time lags are kept, otherwise only the maximum.
+    :param window_chunk: The number of windows which are calculated together. Bounds the memory used.
+    :param lag_search: Either 'exhaustive' or 'coarse-to-fine', see maximum_crosscorrelation. Only used if
+                       all_time_deltas is False.
+    :param coarse_factor: The coarse lag grid step as a multiple of the time delta step, for the coarse-to-fine search.
+    :param n_candidates: The number of coarse lags which are refined, for the coarse-to-fine search.
+    :param threads: The number of threads the window chunks are divided between, an int or a
+                    feature_extractor.ThreadBudget which is checked for every group of chunks. If there are fewer
+                    windows than the maximum number of threads times *window_chunk*, the chunks are made smaller so
+                    that all threads can get work.
+    :return: A generator which for every window, in order, yields a triplet (window_start, window_end,
+             pair_time_deltas), where pair_time_deltas is a dictionary of channel pairs to lists of (time_lag,
+             correlation) pairs like the ones returned by maximum_crosscorrelation. Windows with too few samples to
+             be useful are skipped.
+    """
+    coarse_to_fine = check_lag_search(lag_search) and not all_time_deltas
+
+    data = np.asarray(s.get_data(), dtype=np.float64)
+
+    segment_channels = [str(channel) for channel in s.get_channels()]
+    channel_indices = dict((channel, channel if isinstance(channel, int) else segment_channels.index(str(channel)))
+                           for channel in channels)
+
+    # The pairs are calculated together per time lag range
+    range_pairs = defaultdict(list)
+    for pair, time_delta_range in pair_ranges:
+        range_pairs[time_delta_range].append(pair)
+
+    sample_bounds = window_sample_bounds(s, channels, windows)
+    max_threads = feature_extractor.maximum_threads(threads)
+    if max_threads > 1:
+        window_chunk = max(1, min(window_chunk, -(-len(sample_bounds) // max_threads)))
+    chunks = [sample_bounds[chunk_start:chunk_start + window_chunk]
+              for chunk_start in range(0, len(sample_bounds), window_chunk)]
+
+    def chunk_correlations(chunk):
+        return chunk_crosscorrelations(data, chunk, range_pairs, channel_indices, all_time_deltas, coarse_to_fine,
+                                       coarse_factor, n_candidates)
+
+    # The chunks are calculated a group of threads at a time, so that streamed results still use bounded memory
+    group_start = 0
+    while group_start < len(chunks):
+        n_threads = feature_extractor.current_threads(threads)
+        group = chunks[group_start:group_start + n_threads]
+        group_start += len(group)
+        for chunk, chunk_results in zip(group, feature_extractor.thread_map(chunk_correlations, group, n_threads)):
+            for (window_start, window_end, _, _), pair_time_deltas in zip(chunk, chunk_results):
+                yield window_start, window_end, pair_time_deltas
+
+
+def chunk_crosscorrelations(data, chunk, range_pairs, channel_indices, all_time_deltas, coarse_to_fine,
+                            coarse_factor, n_candidates):
+    """
+    Calculates the cross-correlations of a chunk of windows for window_crosscorrelations.
+
+    :param data: The (channels x samples) data of the segment.
+    :param chunk: A list of (window_start, window_end, start_index, end_index) tuples as given by window_sample_bounds.
+    :param range_pairs: A dictionary of time lag ranges to the channel pairs which use them.
+    :param channel_indices: A dictionary of channels to their row in *data*.
+    :param all_time_deltas: If True, the correlations at all time lags are kept, otherwise only the maximum.
+    :param coarse_to_fine: If True, the maximum is searched for with the coarse-to-fine search.
+    :param coarse_factor: The coarse lag grid step as a multiple of the time delta step, for the coarse-to-fine search.
+    :param n_candidates: The number of coarse lags which are refined, for the coarse-to-fine search.
+    :return: A list with a pair_time_deltas dictionary for every window of the chunk.
+    """
+    chunk_results = [dict() for _ in chunk]
+
+    # The windows in a chunk can differ by a sample in length when the window length isn't a whole number of
+    # samples, so they are stacked into one tensor per window length
+    length_groups = defaultdict(list)
+    for position, (_, _, start_index, end_index) in enumerate(chunk):
+        length_groups[end_index - start_index].append(position)
+
+    for window_samples, positions in length_groups.items():
+        starts = np.array([chunk[position][2] for position in positions])
+        tensor = data[:, starts[:, np.newaxis] + np.arange(window_samples)].transpose(1, 0, 2)
+        energies = np.einsum('wcl,wcl->wc', tensor, tensor) / window_samples
+        lag_products = dict()
+
+        for time_delta_range, pairs in range_pairs.items():
+            rows = np.array([channel_indices[channel_i] for channel_i, channel_j in pairs])
+            cols = np.array([channel_indices[channel_j] for channel_i, channel_j in pairs])
+            if coarse_to_fine:
+                search_range = coarse_lag_range(time_delta_range, coarse_factor)
+            else:
+                search_range = time_delta_range
+            lags, correlations = batched_lag_correlations(tensor, energies, rows, cols, search_range,
+                                                          lag_products)
+            for tensor_index, (position, window_correlations) in enumerate(zip(positions, correlations)):
+                pair_time_deltas = chunk_results[position]
+                for pair_index, (pair, pair_correlations) in enumerate(zip(pairs, window_correlations)):
+                    if coarse_to_fine:
+                        row, col = rows[pair_index], cols[pair_index]
+                        norm_const = np.sqrt(energies[tensor_index, row] * energies[tensor_index, col])
+                        pair_time_deltas[pair] = refine_maximum(tensor[tensor_index, row],
+                                                                tensor[tensor_index, col],
+                                                                time_delta_range, lags, pair_correlations,
+                                                                coarse_factor, n_candidates, norm_const)
+                    else:
+                        pair_time_deltas[pair] = summarize_time_deltas(lags, pair_correlations, all_time_deltas)
+    return chunk_results
+
+
+def batched_lag_correlations(tensor, energies, rows, cols, time_delta_range, lag_products=None, pair_block=None):
+    """
+    Calculates the normalized cross-correlations of many channel pairs in many windows at once.
+
+    :param tensor: A (n_windows x n_channels x n_samples) ndarray with the windows.
+    :param energies: A (n_windows x n_channels) ndarray with the mean squared values of the channels in every window.
+    :param rows: The channel indices of the first channel of each pair.
+    :param cols: The channel indices of the second channel of each pair.
+    :param time_delta_range: A (begin, end, step) triple in samples, see maximum_crosscorrelation.
+    :param lag_products: An optional dictionary used for caching the lag products between calls with the same
+                         tensor.
+    :param pair_block: The number of pairs which are transformed together when using the FFT. Bounds the memory used.
+    :return: A pair (lags, correlations), where lags is an ndarray with the time lags in the order given by time_lags
+             and correlations is a (n_windows x n_pairs x n_lags) ndarray with the absolute normalized correlations.
+    """
+    n_windows, n_channels, n_samples = tensor.shape
+    lags = np.array(time_lags(time_delta_range), dtype=int)
+    abs_lags = np.unique(np.abs(lags))
+    max_lag = min(int(abs_lags[-1]), n_samples - 1)
+    fft_length = 2 ** int(np.ceil(np.log2(n_samples + max_lag)))
+
+    sig_corr = np.zeros((n_windows, len(rows), len(lags)))
+    if len(abs_lags) <= np.log2(fft_length):
+        # A lag product holds the lagged dot products of all channels in all windows, product[w, a, b] is
+        # sum_i x_a[i+t]x_b[i]. The negative lags of a pair are found by swapping the channels.
+        if lag_products is None:
+            lag_products = dict()
+        for lag_index, lag in enumerate(lags):
+            t = abs(lag)
+            if t >= n_samples:
+                continue
+            if t not in lag_products:
+                lag_products[t] = np.matmul(tensor[:, :, t:], tensor[:, :, :n_samples - t].transpose(0, 2, 1))
+            if lag >= 0:
+                sig_corr[:, :, lag_index] = lag_products[t][:, rows, cols]
+            else:
+                sig_corr[:, :, lag_index] = lag_products[t][:, cols, rows]
+    else:
+        if pair_block is None:
+            pair_block = max(1, 2 ** 22 // fft_length)
+        spectra = np.fft.rfft(tensor, fft_length, axis=2)
+        for block_start in range(0, len(rows), pair_block):
+            block_rows = rows[block_start:block_start + pair_block]
+            block_cols = cols[block_start:block_start + pair_block]
+            cross_spectra = spectra[:, block_rows, :] * np.conjugate(spectra[:, block_cols, :])
+            block_corr = np.fft.irfft(cross_spectra, fft_length, axis=2)
+            sig_corr[:, block_start:block_start + pair_block, :] = block_corr[:, :, lags % fft_length]
+
+    norm_const = np.sqrt(energies[:, rows] * energies[:, cols])
+    overlap = n_samples - np.abs(lags)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = np.abs(sig_corr / overlap / norm_const[:, :, np.newaxis])
+    correlations[:, :, overlap <= 0] = np.nan
+    return lags, correlations
+
+
+def maximum_crosscorrelation(x, y, time_delta_range, all_time_deltas=False, method='fft', lag_search='exhaustive',
+                             coarse_factor=4, n_candidates=3):
     """
     Returns the normalized cross-correlation for the two sequences x and y at time lags specified by *time_delta_range*.
 
@@ -153,9 +612,31 @@ def maximum_crosscorrelation(x, y, time_delta_range, all_time_deltas=False):
                              For example (-20, 20, 5) will calculate the time lags at [-20, -15, -10, -5, 0, 5, 10, 15].
     :param all_time_deltas: If True, all correlation values will be kept and returned during calculations. If False
                             only the time lag with the maximal correlation is kept.
+    :param method: Either 'fft', which calculates the correlation for all lags at once using crosscorrelation_curve,
+                   or 'direct', which calculates the correlation one lag at a time with corr. The results are the same
+                   up to floating point precision, but the FFT method is much faster for wide lag ranges.
+    :param lag_search: Either 'exhaustive', which searches all the lags in *time_delta_range* for the maximum, or
+                       'coarse-to-fine', which first calculates the correlation on a lag grid *coarse_factor* times
+                       coarser and then searches the full resolution lags around the *n_candidates* best coarse lags.
+                       The coarse-to-fine search can miss maxima which are narrower than the coarse grid, see
+                       lag_search_agreement. Only used if all_time_deltas is False.
+    :param coarse_factor: The coarse lag grid step as a multiple of the time lag step.
+    :param n_candidates: The number of coarse lags which are refined.
     :return: A list of (time_lag, correlation) pairs. If all_time_deltas is False, only the maximal correlation pair is
              kept.
     """
+    if check_lag_search(lag_search) and not all_time_deltas:
+        coarse_time_deltas = maximum_crosscorrelation(x, y, coarse_lag_range(time_delta_range, coarse_factor),
+                                                      all_time_deltas=True, method=method)
+        coarse_lags = np.array([t for t, c in coarse_time_deltas], dtype=int)
+        coarse_correlations = np.array([c for t, c in coarse_time_deltas], dtype=np.float64)
+        return refine_maximum(x, y, time_delta_range, coarse_lags, coarse_correlations, coarse_factor, n_candidates)
+
+    if method == 'fft':
+        lags, correlations = crosscorrelation_curve(x, y, time_delta_range)
+        return summarize_time_deltas(lags, correlations, all_time_deltas)
+    elif method != 'direct':
+        raise ValueError("Cross-correlation method {} is unknown.".format(method))
 
     current_max = -1
     best_t = None
@@ -194,6 +675,246 @@ def maximum_crosscorrelation(x, y, time_delta_range, all_time_deltas=False):
         return [(best_t, current_max)]
 
 
+def check_lag_search(lag_search):
+    """
+    Checks the lag search argument of maximum_crosscorrelation.
+
+    :param lag_search: The lag search argument.
+    :return: True if the lag search is coarse-to-fine, False if it is exhaustive.
+    """
+    if lag_search not in ('exhaustive', 'coarse-to-fine'):
+        raise ValueError("Lag search {} is unknown.".format(lag_search))
+    return lag_search == 'coarse-to-fine'
+
+
+def coarse_lag_range(time_delta_range, coarse_factor):
+    """
+    Returns a lag range with a step *coarse_factor* times longer than the one of *time_delta_range*. The lags of the
+    coarse range are a subset of the lags of *time_delta_range*.
+
+    :param time_delta_range: A (begin, end, step) triple in samples, see maximum_crosscorrelation.
+    :param coarse_factor: The number of fine lag steps per coarse lag step.
+    :return: A (begin, end, step) triple in samples.
+    """
+    time_delta_begin, time_delta_end, time_delta_step = time_delta_range
+    return time_delta_begin, time_delta_end, time_delta_step * max(int(coarse_factor), 1)
+
+
+def refine_maximum(x, y, time_delta_range, coarse_lags, coarse_correlations, coarse_factor, n_candidates,
+                   norm_const=None):
+    """
+    Finds the maximum correlation of x and y by searching the lags of *time_delta_range* around the best lags of a
+    coarse lag grid.
+
+    :param x: The first vector to use in the cross correlation.
+    :param y: The second vector to use in the cross correlation.
+    :param time_delta_range: The full resolution (begin, end, step) triple in samples.
+    :param coarse_lags: The lags of the coarse grid, as given by coarse_lag_range.
+    :param coarse_correlations: The correlations at *coarse_lags*.
+    :param coarse_factor: The coarse lag grid step as a multiple of the step in *time_delta_range*.
+    :param n_candidates: The number of coarse lags to search around.
+    :param norm_const: The normalization constant of x and y, see lag_correlations.
+    :return: A list with a single (time_lag, correlation) pair, in the same format as maximum_crosscorrelation.
+    """
+    # NaN correlations are never candidates
+    valid = coarse_correlations > -1
+    order = np.argsort(-np.where(valid, coarse_correlations, -np.inf), kind='mergesort')[:n_candidates]
+    candidates = coarse_lags[order[valid[order]]]
+
+    # All fine lags up to the neighbouring coarse lags are searched. The fine lags are in ascending order, so ties are
+    # broken in the same way as in the exhaustive search.
+    fine_lags = np.array(time_lags(time_delta_range), dtype=int)
+    if len(candidates) > 0:
+        coarse_step = time_delta_range[2] * max(int(coarse_factor), 1)
+        distances = np.min(np.abs(fine_lags[:, np.newaxis] - candidates[np.newaxis, :]), axis=1)
+        fine_lags = fine_lags[distances < coarse_step]
+    else:
+        fine_lags = fine_lags[:0]
+    return summarize_time_deltas(fine_lags, lag_correlations(x, y, fine_lags, norm_const))
+
+
+def lag_correlations(x, y, lags, norm_const=None):
+    """
+    Calculates the normalized correlations of x and y at the given lags, one lag at a time. A lag t >= 0 gives
+    corr(x, y, t) and a lag t < 0 gives corr(y, x, -t), normalized in the same way as in maximum_crosscorrelation.
+
+    :param x: The first vector to use in the cross correlation.
+    :param y: The second vector to use in the cross correlation, of the same length as x.
+    :param lags: The time lags in samples.
+    :param norm_const: sqrt(corr(x, x, 0) * corr(y, y, 0)), calculated from x and y if not given.
+    :return: An ndarray with the absolute normalized correlations, NaN for lags without overlapping samples.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = x.size
+    if norm_const is None:
+        norm_const = np.sqrt(np.dot(x, x) / n * np.dot(y, y) / n)
+
+    correlations = np.empty(len(lags))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, t in enumerate(lags):
+            if abs(t) >= n:
+                correlations[i] = np.nan
+            elif t >= 0:
+                correlations[i] = abs(corr(x, y, t) / norm_const)
+            else:
+                correlations[i] = abs(corr(y, x, -t) / norm_const)
+    return correlations
+
+
+def lag_search_agreement(s, time_delta_config, channels=None, window_length=None, segment_start=None,
+                         segment_end=None, coarse_factor=4, n_candidates=3):
+    """
+    Compares the coarse-to-fine lag search with the exhaustive search on the segment *s*.
+
+    :param s: The segment object to calculate the correlations from.
+    :param time_delta_config: The time delta configuration, see calculate_cross_correlations.
+    :param channels: The channels to calculate correlations for, defaults to all channels.
+    :param window_length: The window length in seconds, see calculate_cross_correlations.
+    :param segment_start: The time in seconds to start the windows from.
+    :param segment_end: The time in seconds to end the windows at.
+    :param coarse_factor: The coarse lag grid step as a multiple of the time delta step.
+    :param n_candidates: The number of coarse lags which are refined.
+    :return: A dictionary with the number of compared maxima, the number of those where both searches found the same
+             lag, and the largest difference in maximum correlation between the searches.
+    """
+    if channels is None:
+        channels = s.get_channels()
+    windows = segment_windows(s, window_length, segment_start, segment_end)
+    pair_ranges = channel_pair_ranges(channels, time_delta_config, s.get_sampling_frequency())
+
+    exhaustive = window_crosscorrelations(s, channels, pair_ranges, windows)
+    coarse_to_fine = window_crosscorrelations(s, channels, pair_ranges, windows, lag_search='coarse-to-fine',
+                                              coarse_factor=coarse_factor, n_candidates=n_candidates)
+    n_maxima = 0
+    n_agreeing = 0
+    max_correlation_loss = 0.0
+    for (_, _, exhaustive_deltas), (_, _, coarse_deltas) in zip(exhaustive, coarse_to_fine):
+        for pair, [(exhaustive_t, exhaustive_c)] in exhaustive_deltas.items():
+            [(coarse_t, coarse_c)] = coarse_deltas[pair]
+            n_maxima += 1
+            if coarse_t == exhaustive_t:
+                n_agreeing += 1
+            else:
+                max_correlation_loss = max(max_correlation_loss, exhaustive_c - coarse_c)
+    return dict(n_maxima=n_maxima, n_agreeing=n_agreeing, max_correlation_loss=max_correlation_loss)
+
+
+def report_lag_search_agreement(segment_paths, time_delta_config, window_size=None, segment_start=None,
+                                segment_end=None, coarse_factor=4, n_candidates=3, normalize_signal=False,
+                                resample_frequency=None, sample_size=None):
+    """
+    Prints how often the coarse-to-fine lag search agrees with the exhaustive search for the given segments.
+
+    :param segment_paths: The segment files or directories of segment files.
+    :param time_delta_config: The time delta configuration, see calculate_cross_correlations.
+    :param window_size: The window length in seconds.
+    :param segment_start: The time in seconds to start the windows from.
+    :param segment_end: The time in seconds to end the windows at.
+    :param coarse_factor: The coarse lag grid step as a multiple of the time delta step.
+    :param n_candidates: The number of coarse lags which are refined.
+    :param normalize_signal: Whether to normalize the segments, see segment.load_segment.
+    :param resample_frequency: The frequency to resample the segments to, see segment.load_segment.
+    :param sample_size: If given, only this many randomly sampled segments are compared.
+    :return: A dictionary with the totals, in the same format as lag_search_agreement.
+    """
+    import random
+    from ..datasets import segment as sg
+
+    segments = [segment_path for segment_path in sorted(fileutils.expand_paths(segment_paths))
+                if 'mat' in segment_path]
+    if sample_size is not None and sample_size < len(segments):
+        segments = random.sample(segments, sample_size)
+
+    total = dict(n_maxima=0, n_agreeing=0, max_correlation_loss=0.0)
+    for segment_path in segments:
+        segment = sg.load_segment(segment_path, normalize_signal=normalize_signal,
+                                  resample_frequency=resample_frequency)
+        agreement = lag_search_agreement(segment, time_delta_config, window_length=window_size,
+                                         segment_start=segment_start, segment_end=segment_end,
+                                         coarse_factor=coarse_factor, n_candidates=n_candidates)
+        print("{}: {}/{} maxima agree, largest correlation loss {:.4f}".format(segment_path,
+                                                                              agreement['n_agreeing'],
+                                                                              agreement['n_maxima'],
+                                                                              agreement['max_correlation_loss']))
+        total['n_maxima'] += agreement['n_maxima']
+        total['n_agreeing'] += agreement['n_agreeing']
+        total['max_correlation_loss'] = max(total['max_correlation_loss'], agreement['max_correlation_loss'])
+
+    if total['n_maxima'] > 0:
+        print("Total: {}/{} ({:.2%}) maxima agree, largest correlation loss {:.4f}".format(
+            total['n_agreeing'], total['n_maxima'], total['n_agreeing'] / total['n_maxima'],
+            total['max_correlation_loss']))
+    return total
+
+
+def time_lags(time_delta_range):
+    """
+    Returns the time lags given by *time_delta_range*, in the order they are evaluated by maximum_crosscorrelation.
+
+    :param time_delta_range: A (begin, end, step) triple in samples, see maximum_crosscorrelation.
+    :return: A list of integer time lags.
+    """
+    time_delta_begin, time_delta_end, time_delta_step = time_delta_range
+    return list(range(time_delta_begin, 0, time_delta_step)) + list(range(0, time_delta_end + 1, time_delta_step))
+
+
+def crosscorrelation_curve(x, y, time_delta_range):
+    """
+    Calculates the normalized cross-correlation of x and y for all lags in *time_delta_range* at once, using the FFT.
+    The correlation at every lag is the same as the one calculated by corr, that is, a lag t >= 0 gives
+    corr(x, y, t) and a lag t < 0 gives corr(y, x, -t), and is normalized in the same way as in
+    maximum_crosscorrelation. This takes O(n log n) time regardless of the number of lags.
+
+    :param x: The first vector to use in the cross correlation.
+    :param y: The second vector to use in the cross correlation, of the same length as x.
+    :param time_delta_range: A (begin, end, step) triple in samples, see maximum_crosscorrelation.
+    :return: A pair (lags, correlations) of ndarrays, with the lags in the order given by time_lags and the absolute
+             normalized correlations at those lags.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = x.size
+    lags = np.array(time_lags(time_delta_range), dtype=int)
+
+    # The FFT has to be long enough that the circular correlation doesn't wrap around for any of the lags
+    max_lag = min(int(np.max(np.abs(lags))), n - 1)
+    fft_length = 2 ** int(np.ceil(np.log2(n + max_lag)))
+
+    # sig_corr[t] = sum_i x[i+t]y[i], negative lags end up at the end of the array
+    sig_corr = np.fft.irfft(np.fft.rfft(x, fft_length) * np.conjugate(np.fft.rfft(y, fft_length)), fft_length)
+
+    norm_const = np.sqrt(np.dot(x, x) / n * np.dot(y, y) / n)
+    overlap = n - np.abs(lags)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = np.abs(sig_corr[lags % fft_length] / overlap / norm_const)
+    # Lags without any overlapping samples have no correlation
+    correlations[overlap <= 0] = np.nan
+    return lags, correlations
+
+
+def summarize_time_deltas(lags, correlations, all_time_deltas=False):
+    """
+    Summarizes a lag curve in the same way as maximum_crosscorrelation.
+
+    :param lags: A sequence of time lags, in the order given by time_lags.
+    :param correlations: The correlations at *lags*.
+    :param all_time_deltas: If True, the correlations at all lags are returned, otherwise only the maximum.
+    :return: A list of (time_lag, correlation) pairs. If all_time_deltas is False, it only holds the first lag with
+             the maximal correlation. As with the direct calculation in maximum_crosscorrelation, the lag of the
+             maximum is given as an absolute value.
+    """
+    if all_time_deltas:
+        return list(zip(np.asarray(lags).tolist(), correlations))
+
+    # Comparisons with NaN are False, so NaN correlations are never the maximum
+    valid = correlations > -1
+    if not np.any(valid):
+        return [(None, -1)]
+    best = int(np.argmax(np.where(valid, correlations, -np.inf)))
+    return [(abs(int(lags[best])), correlations[best])]
+
+
 def corr(x, y, t):
     """
     Calculate the correlation between the equal length arrays x and y at time lag t. t should be greater or equal
@@ -218,7 +939,7 @@ def corr(x, y, t):
     return sig_corr.take(0) / (n - t)
 
 
-def get_csv_name(f, csv_directory, window_length=None):
+def get_csv_name(f, csv_directory, window_length=None, extension='.csv'):
     name, ext = os.path.splitext(f)
     if csv_directory is not None:
         basename = os.path.basename(name)
@@ -227,15 +948,17 @@ def get_csv_name(f, csv_directory, window_length=None):
     if window_length is not None:
         csv_name += "_{}s".format(window_length)
 
-    return csv_name + '.csv'
+    return csv_name + extension
 
 
-def csv_naming_function(segment_path, output_dir, window_length=None, **kwargs):
+def csv_naming_function(segment_path, output_dir, window_length=None, output_format='csv', **kwargs):
     """Wrapper for get_csv_name for use as a feature_extrator naming function."""
     if fileutils.get_subject(output_dir) is None:
         subject = fileutils.get_subject(segment_path)
         output_dir = os.path.join(output_dir, subject)
 
+    if output_format == 'binary':
+        return get_csv_name(segment_path, output_dir, window_length, extension=feature_io.FEATURE_FILE_EXTENSION)
     return get_csv_name(segment_path, output_dir, window_length)
 
 
@@ -273,25 +996,45 @@ def extract_features(segment_paths,
                      segment_start=None,
                      segment_end=None,
                      all_time_deltas=False,
-                     old_csv_format=False):
+                     old_csv_format=False,
+                     method='batched',
+                     lag_search='exhaustive',
+                     coarse_factor=4,
+                     n_candidates=3,
+                     output_format='csv',
+                     cache_dir=None,
+                     cache_max_bytes=None,
+                     shard_output=False,
+                     queue_dir=None,
+                     memory_budget=None):
     time_delta_config = setup_time_delta(time_delta_begin, time_delta_end, time_delta_step, time_delta_config)
-    feature_extractor.extract(feature_folder=segment_paths,
-                              extractor_function=calculate_cross_correlations,
-                              # Arguments for feature_extractor.extract
-                              output_dir=output_dir,
-                              workers=workers,
-                              naming_function=csv_naming_function,
-                              normalize_signal=normalize_signal,
-                              only_missing_files=only_missing_files,
-                              resample_frequency=resample_frequency,
-                              # Arguments for calculate_cross_correlations
-                              time_delta_config=time_delta_config,
-                              window_length=window_size,
-                              channels=channels,
-                              segment_start=segment_start,
-                              segment_end=segment_end,
-                              all_time_deltas=all_time_deltas,
-                              old_csv_format=old_csv_format, )
+    return feature_extractor.extract(feature_folder=segment_paths,
+                                     extractor_function=calculate_cross_correlations,
+                                     # Arguments for feature_extractor.extract
+                                     output_dir=output_dir,
+                                     workers=workers,
+                                     naming_function=csv_naming_function,
+                                     normalize_signal=normalize_signal,
+                                     only_missing_files=only_missing_files,
+                                     resample_frequency=resample_frequency,
+                                     cache_dir=cache_dir,
+                                     cache_max_bytes=cache_max_bytes,
+                                     shard_output=shard_output,
+                                     queue_dir=queue_dir,
+                                     memory_budget=memory_budget,
+                                     # Arguments for calculate_cross_correlations
+                                     time_delta_config=time_delta_config,
+                                     window_length=window_size,
+                                     channels=channels,
+                                     segment_start=segment_start,
+                                     segment_end=segment_end,
+                                     all_time_deltas=all_time_deltas,
+                                     old_csv_format=old_csv_format,
+                                     method=method,
+                                     lag_search=lag_search,
+                                     coarse_factor=coarse_factor,
+                                     n_candidates=n_candidates,
+                                     output_format=output_format)
 
 
 def main():
@@ -320,9 +1063,10 @@ def main():
     parser.add_argument("--time-delta-config", help="A file holding time delta values for the different channels.")
     parser.add_argument("--all-time-deltas",
                         help=("Includes the time delta vs. correlation for all time deltas, and not just the maimal, "
-                              "that is, all the correlations for all time steps in the time delta range. Warning: this "
-                              "might use a lot of memory. A factor of (time_delta_begin - time_delta_end)/time_step "
-                              "more memory."),
+                              "that is, all the correlations for all time steps in the time delta range. The "
+                              "correlations are written one window at a time, so the memory use doesn't depend on the "
+                              "time delta range, except with --old-csv-format. Warning: the feature files will be a "
+                              "factor of (time_delta_end - time_delta_begin)/time_step larger."),
                         action='store_true')
     parser.add_argument("--window-length",
                         help=("If this argument is supplied, the cross correlation will be done on windows of this "
@@ -338,6 +1082,12 @@ def main():
     parser.add_argument("--old-csv-format", help="Use the old CSV format where the channel pairs are rows",
                         action='store_true',
                         dest='old_csv_format')
+    parser.add_argument("--output-format",
+                        help=("The format of the feature files. 'binary' writes the correlations as dense "
+                              "(windows x lags x pairs) arrays which are memory-mapped when loaded, see "
+                              "datasets.feature_io."),
+                        choices=['csv', 'binary'],
+                        default='csv')
     parser.add_argument("--new-segment-format",
                         help="Use the old Segment format where the data is accesses through a numpy array",
                         action='store_false',
@@ -356,28 +1106,103 @@ def main():
                         default=False,
                         action='store_true',
                         dest='normalize_signal')
+    parser.add_argument("--feature-cache",
+                        help=("A feature cache directory shared between runs. Segments extracted before with the same "
+                              "parameters are taken from the cache, see feature_cache."),
+                        dest='cache_dir')
+    parser.add_argument("--cache-max-size",
+                        help="The disk budget of the feature cache, for example 20G. Unbounded if omitted.",
+                        type=feature_cache.parse_size,
+                        dest='cache_max_bytes')
+    parser.add_argument("--shard-output",
+                        help=("Append the features of every subject and class to a single feature shard instead of "
+                              "writing a file per segment, see datasets.feature_shards. Requires binary output."),
+                        action='store_true',
+                        dest='shard_output')
+    parser.add_argument("--work-queue",
+                        help=("A work queue directory on a file system shared between hosts. Runs on several hosts "
+                              "with the same queue share the segments between them, see work_queue."),
+                        dest='queue_dir')
+    parser.add_argument("--memory-budget",
+                        help=("The memory the extraction jobs may use together, for example 100G. Jobs are only "
+                              "started while their estimated peak memory fits, see feature_extractor.MemoryModel."),
+                        type=feature_cache.parse_size,
+                        dest='memory_budget')
+    parser.add_argument("--xcorr-method",
+                        help=("How the correlations are calculated. 'batched' calculates all channel pairs of a "
+                              "window at once. 'fft' calculates all time lags of a single pair at once, 'direct' "
+                              "calculates them one lag at a time. All give the same results."),
+                        choices=['batched', 'fft', 'direct'],
+                        default='batched',
+                        dest='method')
+    parser.add_argument("--lag-search",
+                        help=("How the maximal correlation is searched for. 'coarse-to-fine' searches a coarser lag "
+                              "grid first and then refines the best lags at full resolution. This makes wide lag "
+                              "ranges much cheaper with the 'direct' method, but can miss maxima narrower than the "
+                              "coarse grid, see --lag-search-report. Not used with --all-time-deltas."),
+                        choices=['exhaustive', 'coarse-to-fine'],
+                        default='exhaustive')
+    parser.add_argument("--coarse-factor",
+                        help="The coarse lag grid step as a multiple of the time delta step.",
+                        type=int, default=4)
+    parser.add_argument("--lag-candidates",
+                        help="The number of coarse lags which are refined by the coarse-to-fine search.",
+                        type=int, default=3,
+                        dest='n_candidates')
+    parser.add_argument("--lag-search-report",
+                        help=("Instead of extracting features, report how often the coarse-to-fine search finds the "
+                              "same lags as the exhaustive search for the given segments."),
+                        action='store_true')
+    parser.add_argument("--report-sample-size",
+                        help="Only use this many randomly sampled segments for --lag-search-report.",
+                        type=int)
 
     args = parser.parse_args()
 
     channels = None
 
-    extract_features(segment_paths=args.segments,
-                     output_dir=args.csv_directory,
-                     workers=args.workers,
-                     resample_frequency=args.resample_frequency,
-                     normalize_signal=args.normalize_signal,
-                     window_size=args.window_length,
-                     only_missing_files=args.only_missing_files,
-                     # Arguments for calculate_cross_correlations
-                     time_delta_config=args.time_delta_config,
-                     time_delta_begin=args.time_delta_begin,
-                     time_delta_end=args.time_delta_end,
-                     time_delta_step=args.time_delta_step,
-                     segment_start=args.segment_start,
-                     channels=channels,
-                     segment_end=args.segment_end,
-                     all_time_deltas=args.all_time_deltas,
-                     old_csv_format=args.old_csv_format)
+    if args.lag_search_report:
+        time_delta_config = setup_time_delta(args.time_delta_begin, args.time_delta_end, args.time_delta_step,
+                                             args.time_delta_config)
+        report_lag_search_agreement(args.segments, time_delta_config,
+                                    window_size=args.window_length,
+                                    segment_start=args.segment_start,
+                                    segment_end=args.segment_end,
+                                    coarse_factor=args.coarse_factor,
+                                    n_candidates=args.n_candidates,
+                                    normalize_signal=args.normalize_signal,
+                                    resample_frequency=args.resample_frequency,
+                                    sample_size=args.report_sample_size)
+        return
+
+    manifest = extract_features(segment_paths=args.segments,
+                                output_dir=args.csv_directory,
+                                workers=args.workers,
+                                resample_frequency=args.resample_frequency,
+                                normalize_signal=args.normalize_signal,
+                                window_size=args.window_length,
+                                only_missing_files=args.only_missing_files,
+                                cache_dir=args.cache_dir,
+                                cache_max_bytes=args.cache_max_bytes,
+                                shard_output=args.shard_output,
+                                queue_dir=args.queue_dir,
+                                memory_budget=args.memory_budget,
+                                # Arguments for calculate_cross_correlations
+                                time_delta_config=args.time_delta_config,
+                                time_delta_begin=args.time_delta_begin,
+                                time_delta_end=args.time_delta_end,
+                                time_delta_step=args.time_delta_step,
+                                segment_start=args.segment_start,
+                                channels=channels,
+                                segment_end=args.segment_end,
+                                all_time_deltas=args.all_time_deltas,
+                                old_csv_format=args.old_csv_format,
+                                method=args.method,
+                                lag_search=args.lag_search,
+                                coarse_factor=args.coarse_factor,
+                                n_candidates=args.n_candidates,
+                                output_format=args.output_format)
+    sys.exit(feature_extractor.exit_status(manifest))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,266 @@
+"""
+Module for a content-addressed cache of feature files, shared between extraction runs which write to different output
+directories.
+
+A cached feature file is identified by a key computed from the checksum of the segment, the extractor, the extraction
+parameters and the version of the extraction code, see feature_extractor.cache_key. The cache directory holds:
+
+    objects/<first two characters of the key>/<key><feature file extension>
+    objects/<first two characters of the key>/<key>.json
+
+where the JSON file describes the cached file. Cached files are hard linked into the output directories when possible,
+so a feature file shared by several experiments only takes up disk space once. The modification time of the JSON file
+is updated whenever the cached file is used, which is what the least recently used eviction is based on.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import datetime
+import errno
+import json
+import os
+import re
+import shutil
+
+#Suffixes accepted by parse_size
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+class FeatureCache(object):
+    """
+    A directory of feature files addressed by key, with an optional disk budget. When storing a file makes the cache
+    larger than the budget, the least recently used files are evicted. Several processes can use the same cache at
+    once, all changes are done by renaming complete files into place.
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        :param cache_dir: The directory of the cache. Will be created if it doesn't exist.
+        :param max_bytes: The disk budget of the cache in bytes. If None, the cache is unbounded.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def object_dir(self, key):
+        """Returns the directory the files of *key* are stored in."""
+        return os.path.join(self.cache_dir, 'objects', key[:2])
+
+    def metadata_path(self, key):
+        """Returns the path of the JSON file describing the cached file of *key*."""
+        return os.path.join(self.object_dir(key), key + '.json')
+
+    def object_path(self, key, extension):
+        """Returns the path of the cached file of *key*."""
+        return os.path.join(self.object_dir(key), key + extension)
+
+    def fetch(self, key, output_path):
+        """
+        Places the cached file of *key* at *output_path*, if there is one.
+
+        :param key: The cache key.
+        :param output_path: The path the feature file should have. An existing file is replaced.
+        :return: True if the file was in the cache, False otherwise.
+        """
+        extension = os.path.splitext(output_path)[1]
+        object_path = self.object_path(key, extension)
+        try:
+            link_or_copy(object_path, output_path)
+        except EnvironmentError as error:
+            if error.errno == errno.ENOENT:
+                return False
+            raise
+        touch(self.metadata_path(key))
+        return True
+
+    def store(self, key, output_path, metadata=None):
+        """
+        Adds the feature file *output_path* to the cache, and evicts the least recently used files if the cache is over
+        its budget.
+
+        :param key: The cache key.
+        :param output_path: The path of the complete feature file.
+        :param metadata: A dictionary of JSON serializable values describing the file, stored with it.
+        :return: None.
+        """
+        object_dir = self.object_dir(key)
+        if not os.path.exists(object_dir):
+            try:
+                os.makedirs(object_dir)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+        extension = os.path.splitext(output_path)[1]
+        description = dict(metadata if metadata is not None else dict(),
+                           key=key,
+                           extension=extension,
+                           size=os.path.getsize(output_path),
+                           stored=datetime.datetime.now().isoformat())
+        # The object is put in place before its description, so that every description seen by entries has a file
+        link_or_copy(output_path, self.object_path(key, extension))
+        temporary_path = "{}.{}.tmp".format(self.metadata_path(key), os.getpid())
+        with open(temporary_path, 'w') as fp:
+            json.dump(description, fp, sort_keys=True)
+        os.rename(temporary_path, self.metadata_path(key))
+
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def entries(self):
+        """
+        Returns the descriptions of the cached files.
+
+        :return: A list of the description dictionaries given to store, with the additional key 'last_used', the
+                 time the file was last stored or fetched as seconds since the epoch, and 'links', the number of hard
+                 links to the cached file.
+        """
+        objects_dir = os.path.join(self.cache_dir, 'objects')
+        entries = []
+        if not os.path.exists(objects_dir):
+            return entries
+        for dirpath, dirnames, filenames in os.walk(objects_dir):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                metadata_path = os.path.join(dirpath, filename)
+                try:
+                    with open(metadata_path) as fp:
+                        entry = json.load(fp)
+                    entry['last_used'] = os.path.getmtime(metadata_path)
+                    entry['links'] = os.stat(self.object_path(entry['key'], entry['extension'])).st_nlink
+                except (EnvironmentError, ValueError):
+                    # Removed by a concurrent prune, or a description without an object
+                    continue
+                entries.append(entry)
+        return entries
+
+    def remove(self, entry):
+        """Removes a cached file given its description. Hard links in output directories are kept."""
+        for path in (self.metadata_path(entry['key']), self.object_path(entry['key'], entry['extension'])):
+            try:
+                os.remove(path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+
+    def prune(self, max_bytes):
+        """
+        Evicts the least recently used files until the cache takes up at most *max_bytes*.
+
+        :param max_bytes: The size in bytes to prune the cache to.
+        :return: A list of the descriptions of the evicted files.
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry['last_used'])
+        total = sum(entry['size'] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            self.remove(entry)
+            total -= entry['size']
+            evicted.append(entry)
+        return evicted
+
+    def stats(self):
+        """
+        Summarizes the contents of the cache.
+
+        :return: A dictionary with the keys 'files', 'bytes', 'max_bytes', 'linked' (the number of files also linked
+                 from an output directory), 'extractors' (a dictionary of extractor names to file counts),
+                 'oldest_use' and 'newest_use' (ISO dates, None if the cache is empty).
+        """
+        entries = self.entries()
+        extractors = dict()
+        for entry in entries:
+            extractor = entry.get('extractor', 'unknown')
+            extractors[extractor] = extractors.get(extractor, 0) + 1
+        last_used = [entry['last_used'] for entry in entries]
+        return dict(files=len(entries),
+                    bytes=sum(entry['size'] for entry in entries),
+                    max_bytes=self.max_bytes,
+                    linked=sum(1 for entry in entries if entry['links'] > 1),
+                    extractors=extractors,
+                    oldest_use=datetime.datetime.fromtimestamp(min(last_used)).isoformat() if entries else None,
+                    newest_use=datetime.datetime.fromtimestamp(max(last_used)).isoformat() if entries else None)
+
+
+def link_or_copy(source, destination):
+    """
+    Atomically places the file *source* at *destination*, as a hard link if possible and as a copy otherwise, for
+    example if the paths are on different file systems.
+
+    :param source: The path of an existing file.
+    :param destination: The path to place it at. An existing file is replaced.
+    :return: None.
+    """
+    temporary_path = "{}.{}.tmp".format(destination, os.getpid())
+    try:
+        os.link(source, temporary_path)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            raise
+        shutil.copyfile(source, temporary_path)
+    os.rename(temporary_path, destination)
+
+
+def touch(path):
+    """Sets the modification time of *path* to now, if it exists."""
+    try:
+        os.utime(path, None)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+def parse_size(size):
+    """
+    Parses a size in bytes with an optional binary unit suffix.
+
+    :param size: A string like '500', '200M' or '1.5G'. The units K, M, G and T are powers of 1024.
+    :return: The size in bytes as an int.
+    """
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)B?\s*$', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError("Can't parse the size {!r}".format(size))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(n_bytes):
+    """Formats a size in bytes with a binary unit suffix."""
+    for unit in ('', 'K', 'M', 'G'):
+        if n_bytes < 1024:
+            return "{:.1f} {}B".format(n_bytes, unit)
+        n_bytes /= 1024.0
+    return "{:.1f} TB".format(n_bytes)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspects and prunes a shared feature cache.")
+    parser.add_argument("command", help="'stats' summarizes the cache, 'prune' evicts the least recently used files.",
+                        choices=['stats', 'prune'])
+    parser.add_argument("cache_dir", help="The directory of the feature cache.")
+    parser.add_argument("--max-size",
+                        help="The size to prune the cache to, for example 500M or 20G. Required for 'prune'.",
+                        type=parse_size,
+                        dest='max_bytes')
+    args = parser.parse_args()
+
+    cache = FeatureCache(args.cache_dir, args.max_bytes)
+    if args.command == 'prune':
+        if args.max_bytes is None:
+            parser.error("prune requires --max-size")
+        evicted = cache.prune(args.max_bytes)
+        print("Evicted {} files, {}".format(len(evicted), format_size(sum(entry['size'] for entry in evicted))))
+
+    stats = cache.stats()
+    print("Files: {} ({} also linked from output directories)".format(stats['files'], stats['linked']))
+    print("Size: {}".format(format_size(stats['bytes'])))
+    if stats['files']:
+        print("Last used: {} to {}".format(stats['oldest_use'], stats['newest_use']))
+    for extractor, count in sorted(stats['extractors'].items()):
+        print("  {}: {} files".format(extractor, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,60 @@
 from __future__ import absolute_import
 import os.path
 import csv
+import datetime
+import errno
+import hashlib
+import heapq
+import inspect
+import json
 import multiprocessing
+import multiprocessing.pool
 import random
+import sys
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from ..datasets import fileutils
+from ..datasets import feature_io
+from ..datasets import feature_shards
 from ..datasets import segment as sg
+from ..datasets import stage_timing
+from ..datasets import worker_pool
+from . import feature_cache
+from . import work_queue as wq
+
+#Exceptions which are likely to go away if the segment is retried, like running out of memory when too many large
+#segments are processed at once or a network file system hiccup. Other exceptions fail the segment immediately.
+TRANSIENT_ERRORS = (MemoryError, EnvironmentError)
+
+#The number of seconds the worker process of a job must have been gone before the job is considered lost, which gives
+#the pool time to deliver a result the worker sent just before it exited
+LOST_JOB_GRACE_SECONDS = 2.0
+
+#The default name of the extraction ledger in the output directory
+LEDGER_FILE_NAME = 'extraction_ledger.jsonl'
+
+
+class RowStream(object):
+    """
+    Rows of features which are produced while they are written, for extractors whose output is too large to hold in
+    memory. The rows are written by write_features as a csv file with a header.
+    """
+    def __init__(self, fieldnames, rows, delimiter='\t'):
+        """
+        :param fieldnames: The columns of the csv file, all rows must only have keys from these.
+        :param rows: An iterable of row dictionaries. Missing keys are written as empty fields. The iterable is
+                     consumed when the rows are written.
+        :param delimiter: The delimiter of the csv file.
+        """
+        self.fieldnames = fieldnames
+        self.rows = rows
+        self.delimiter = delimiter
 
 
 def extract(feature_folder,
@@ -19,6 +68,21 @@ def extract(feature_folder,
             sample_size=None,
             only_missing_files=False,
             resample_frequency=None,
+            max_attempts=3,
+            retry_delay=10,
+            manifest_file=None,
+            largest_first=True,
+            cost_model_file=None,
+            ledger_file=None,
+            cache_dir=None,
+            cache_max_bytes=None,
+            shard_output=False,
+            queue_dir=None,
+            lease_seconds=wq.DEFAULT_LEASE_SECONDS,
+            memory_budget=None,
+            memory_model_file=None,
+            pool=None,
+            trace_file=None,
             **extractor_kwargs):
     """
     Performs feature extraction of the segment files found in *feature_folder*. The features are written to csv
@@ -37,72 +101,1169 @@ def extract(feature_folder,
                             by the extractor function. If a naming function isn't supplied, a name will be generate
                             based on the name of the extractor function.
     :param sample_size: optionally sample this many samples from the input files.
-    :param only_missing_files: If True, features will only be generated for files which are missing. Useful if you
-                               started a feature extraction job but it failed before performing the extraction on all
-                               files. To determine if the files are present, the naming function will be used.
+    :param only_missing_files: If True, features will only be generated for segments which aren't complete according
+                               to the extraction ledger, see ExtractionLedger. Useful if you started a feature
+                               extraction job but it failed before performing the extraction on all files. Segments
+                               whose contents changed, or which were extracted with other parameters, are extracted
+                               again. If there is no ledger, or its file doesn't exist yet, like for an output
+                               directory written before ledgers were kept, segments whose feature file (or shard
+                               record) exists are skipped.
     :param resample_frequency: If this is not None, the segments will be resampled to this frequency.
+    :param max_attempts: The number of times a segment is tried before it's considered failed. Only segments failing
+                         with one of the TRANSIENT_ERRORS are retried.
+    :param retry_delay: The delay in seconds before the first retry of a segment. The delay is doubled for every
+                        further retry.
+    :param manifest_file: The path of the JSON manifest of the run, see ExtractionScheduler.manifest. Defaults to a
+                          file named after the extractor function in *output_dir*. If *output_dir* is None and no
+                          manifest file is given, no manifest is written.
+    :param largest_first: If True, the segments are processed in order of decreasing estimated cost, so that the
+                          largest segments don't end up last with the other workers idle. If False, they are processed
+                          in path order.
+    :param cost_model_file: The path of the JSON file with the CostModel used for estimating the costs. It's updated
+                            with the runtimes of this run. Defaults to a file named after the extractor function in
+                            *output_dir*.
+    :param ledger_file: The path of the extraction ledger, which records the completed segments. Defaults to
+                        LEDGER_FILE_NAME in *output_dir*. If *output_dir* is None and no ledger file is given, no
+                        ledger is kept.
+    :param cache_dir: The directory of a feature_cache.FeatureCache shared between runs. Segments which have been
+                      extracted with the same extractor, parameters and code before are taken from the cache instead
+                      of being extracted again, and new feature files are added to it. If None, no cache is used.
+    :param cache_max_bytes: The disk budget of the cache in bytes, the least recently used files are evicted when
+                            it's exceeded. If None, the cache is unbounded.
+    :param shard_output: If True, the features of every subject and class are appended to a single feature shard
+                         instead of being written to a feature file per segment, see datasets.feature_shards. The
+                         extractor must return binary features. Can't be combined with a feature cache, which works
+                         on whole feature files.
+    :param queue_dir: The directory of a work_queue.WorkQueue on a file system shared between hosts. If given, the
+                      segments are added to the queue and the jobs are taken from it, so that extraction runs with the
+                      same queue on several hosts share the work. The run ends when the queue is drained. If None, the
+                      segments are only extracted by this run.
+    :param lease_seconds: The number of seconds without a heartbeat after which the jobs of a dead worker of the work
+                          queue are taken over by other workers.
+    :param memory_budget: The number of bytes of memory the running jobs may use together, on top of the memory of
+                          the idle worker processes. Jobs are only started while their estimated peak memory fits in
+                          the budget, see MemoryModel. A job is always started if no other job is running. If None,
+                          the number of jobs is only limited by *workers*.
+    :param memory_model_file: The path of the JSON file with the MemoryModel used for estimating the peak memory of the
+                              jobs. It's updated with the peak memory measured in this run. Defaults to a file named
+                              after the extractor function in *output_dir*.
+    :param pool: A persistent worker_pool.WorkerPool to run the jobs in, instead of a pool created for this run.
+                 Defaults to the pool opened by worker_pool.shared_pool, if any. The pool is only used if *workers* is
+                 larger than 1, and then the number of processes of the pool takes the place of *workers*.
+    :param trace_file: The JSON lines file which every job appends the time of its stages and the bytes it read and
+                       wrote to, see datasets.stage_timing. Defaults to a file named after the extractor function in
+                       *output_dir*. If None and there's no *output_dir*, no trace is written.
     :param extractor_kwargs: Keyword arguments for the extractor function
-    :return: None. The feature csv files are created by this function.
+    :return: The manifest dictionary of the run. The feature csv files are created by this function. Segments which
+             fail don't stop the extraction of the other segments, they are listed under 'failed' in the manifest.
     """
 
+    if shard_output and cache_dir is not None:
+        raise ValueError("Feature shards can't be used together with a feature cache.")
+
     segments = [segment_path
                 for segment_path
                 in sorted(fileutils.expand_paths(feature_folder))
                 if 'mat' in segment_path]
 
-    if only_missing_files:
-        processed_features = set()
-        for dirpath, dirnames, filenames in os.walk(output_dir):
-            processed_features.update([os.path.join(dirpath, filename) for filename in filenames if '.csv' in filename])
-
-        unprocessed_segments = []
-        for segment in segments:
-            if naming_function:
-                segment_feature = naming_function(segment, output_dir, **extractor_kwargs)
-            else:
-                segment_feature = default_naming_function(segment, output_dir, extractor_function)
-            if segment_feature not in processed_features:
-                unprocessed_segments.append(segment)
+    if ledger_file is None and output_dir is not None:
+        ledger_file = os.path.join(output_dir, LEDGER_FILE_NAME)
+    ledger = None
+    if ledger_file is not None:
+        ledger = ExtractionLedger(ledger_file, extractor_function,
+                                  extraction_parameters(extractor_function, extractor_kwargs, old_segment_format,
+                                                        normalize_signal, resample_frequency))
 
-        segments = unprocessed_segments
+    if only_missing_files:
+        if ledger is not None and os.path.exists(ledger.path):
+            segments = [segment for segment in segments if not ledger.is_complete(segment)]
+        else:
+            # Without a ledger file we can only tell whether the feature file or shard record exists. The existing
+            # outputs are recorded in the ledger, so later runs don't take them for missing.
+            shard_segments = dict()
+            missing = []
+            for segment in segments:
+                output = feature_file_name(segment, output_dir or os.path.dirname(segment),
+                                           extractor_function, extractor_kwargs, naming_function)
+                if shard_output:
+                    output = feature_shards.shard_path(output)
+                    if output not in shard_segments:
+                        shard_segments[output] = (set(feature_shards.shard_segments(output))
+                                                  if os.path.exists(output) else set())
+                    exists = fileutils.get_segment_name(segment) in shard_segments[output]
+                else:
+                    exists = os.path.exists(output)
+                if not exists:
+                    missing.append(segment)
+                elif ledger is not None:
+                    ledger.record(segment, output)
+            segments = missing
 
     if sample_size is not None and sample_size < len(segments):
         segments = random.sample(segments, sample_size)
 
-    if workers > 1:
-        pool = multiprocessing.Pool(workers)
+    if manifest_file is None and output_dir is not None:
+        manifest_file = os.path.join(output_dir, "{}_manifest.json".format(extractor_function.__name__))
+    if cost_model_file is None and output_dir is not None:
+        cost_model_file = os.path.join(output_dir, "{}_cost_model.json".format(extractor_function.__name__))
+
+    if memory_model_file is None and output_dir is not None:
+        memory_model_file = os.path.join(output_dir, "{}_memory_model.json".format(extractor_function.__name__))
+    if trace_file is None and output_dir is not None:
+        trace_file = os.path.join(output_dir, "{}_trace.jsonl".format(extractor_function.__name__))
+
+    cost_model = CostModel.load(cost_model_file)
+    memory_model = MemoryModel.load(memory_model_file)
+    if largest_first:
+        segments = sorted(segments, key=cost_model.estimate, reverse=True)
+
+    job_kwargs = dict(extractor_function=extractor_function,
+                      output_dir=output_dir,
+                      old_segment_format=old_segment_format,
+                      normalize_signal=normalize_signal,
+                      extractor_kwargs=extractor_kwargs,
+                      naming_function=naming_function,
+                      resample_frequency=resample_frequency,
+                      shard_output=shard_output,
+                      cache=feature_cache.FeatureCache(cache_dir, cache_max_bytes) if cache_dir is not None else None)
+    scheduler_kwargs = dict(workers=workers,
+                            max_attempts=max_attempts,
+                            retry_delay=retry_delay,
+                            ledger=ledger,
+                            memory_budget=memory_budget,
+                            memory_model=memory_model,
+                            pool=(pool or worker_pool.current_pool()) if workers > 1 else None,
+                            trace_file=trace_file)
+    if queue_dir is not None:
+        scheduler = QueueScheduler(segments, job_kwargs, wq.WorkQueue(queue_dir, lease_seconds=lease_seconds),
+                                   **scheduler_kwargs)
+    else:
+        scheduler = ExtractionScheduler(segments, job_kwargs, **scheduler_kwargs)
+    manifest = scheduler.run()
+    manifest['extractor'] = extractor_function.__name__
+    manifest['trace_file'] = trace_file
+
+    if cache_dir is not None and cache_max_bytes is not None:
+        # Storing new files keeps the cache within its budget, this also covers runs where everything was cached
+        feature_cache.FeatureCache(cache_dir).prune(cache_max_bytes)
+
+    if manifest_file is not None:
+        write_manifest(manifest, manifest_file)
+    if cost_model_file is not None:
+        cost_model.update(manifest['succeeded'])
+        cost_model.save(cost_model_file)
+    if memory_model_file is not None:
+        memory_model.save(memory_model_file)
+
+    print("Extraction done: {} segments succeeded, {} failed".format(len(manifest['succeeded']),
+                                                                      len(manifest['failed'])))
+    for failure in manifest['failed']:
+        print("Segment {} failed after {} attempts: {}: {}".format(failure['segment'], failure['attempts'],
+                                                                   failure['error_type'], failure['error']))
+    return manifest
+
+
+class CostModel(object):
+    """
+    Estimates the processing time of segments from their file sizes. The file size is proportional to the number of
+    channels times the number of samples, while the cost per byte mostly depends on the sampling rate, which is the
+    same for all segments of a subject. The model therefore keeps a cost per byte for every subject, learnt from the
+    runtimes of earlier runs.
+    """
+    #The weight of the earlier observations when the model is updated with a new run
+    DECAY = 0.5
+
+    def __init__(self, subject_costs=None):
+        """
+        :param subject_costs: A dictionary of subject names to dictionaries with the keys 'seconds' and 'bytes', the
+                              total runtime and total file size of the observed segments of the subject.
+        """
+        self.subject_costs = dict(subject_costs) if subject_costs is not None else dict()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a cost model from a JSON file. If the file doesn't exist, an empty model is returned.
+
+        :param path: The path of the JSON file, can be None.
+        :return: A CostModel.
+        """
+        if path is None or not os.path.exists(path):
+            return cls()
+        with open(path) as fp:
+            return cls(json.load(fp))
+
+    def save(self, path):
+        """Saves the cost model as a JSON file at *path*."""
+        model_dir = os.path.dirname(path)
+        if model_dir and not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        with open(path, 'w') as fp:
+            json.dump(self.subject_costs, fp, indent=4, separators=(',', ': '), sort_keys=True)
+
+    @staticmethod
+    def subject(segment_path):
+        """Returns the subject the model uses for the segment."""
+        return fileutils.get_subject(segment_path) or 'unknown'
+
+    def seconds_per_byte(self, subject):
+        """
+        Returns the cost per byte of the subject. Subjects without observations get the cost per byte over all
+        subjects, or 1 if there are no observations at all.
+        """
+        if subject in self.subject_costs:
+            costs = self.subject_costs[subject]
+        else:
+            costs = dict(seconds=sum(costs['seconds'] for costs in self.subject_costs.values()),
+                         bytes=sum(costs['bytes'] for costs in self.subject_costs.values()))
+        if costs['bytes'] > 0:
+            return costs['seconds'] / float(costs['bytes'])
+        return 1.0
+
+    def estimate(self, segment_path):
+        """
+        Estimates the processing time of the segment.
+
+        :param segment_path: The path of the segment file.
+        :return: The estimated processing time in seconds, or in bytes if there are no observations.
+        """
+        return os.path.getsize(segment_path) * self.seconds_per_byte(self.subject(segment_path))
+
+    def update(self, results):
+        """
+        Updates the model with the runtimes of a run. The earlier observations of a subject are down-weighted by DECAY,
+        so that the model follows changes of the extractors.
+
+        :param results: A list of successful job results as returned by run_job. Results taken from the feature cache
+                        are skipped, their runtimes say nothing about the cost of extracting the segments.
+        :return: None.
+        """
+        run_costs = dict()
+        for result in results:
+            if result.get('cached') or not os.path.exists(result['segment']):
+                continue
+            costs = run_costs.setdefault(self.subject(result['segment']), dict(seconds=0.0, bytes=0))
+            costs['seconds'] += result['seconds']
+            costs['bytes'] += os.path.getsize(result['segment'])
+
+        for subject, costs in run_costs.items():
+            previous = self.subject_costs.get(subject, dict(seconds=0.0, bytes=0))
+            self.subject_costs[subject] = dict(seconds=self.DECAY * previous['seconds'] + costs['seconds'],
+                                               bytes=int(self.DECAY * previous['bytes']) + costs['bytes'])
+
+
+class MemoryModel(object):
+    """
+    Estimates the peak memory of extraction jobs from the file sizes of their segments. A job holds the segment as
+    float64 arrays, often in several copies (the DataFrame, MNE RawArrays, filtered bands), so its peak memory is
+    roughly proportional to the number of channels times the number of samples, and therefore to the file size. How
+    many bytes of memory a byte of segment file needs depends on the extractor and on the sampling rate of the subject,
+    so the model keeps a ratio for every subject and is stored per extractor.
+
+    The ratios are learnt from the peak resident set size measured for every job, see run_job. Within a run they are
+    calibrated as soon as jobs finish, taking the largest ratio observed for the subject. Subjects without observations
+    get the largest ratio of any subject, or DEFAULT_BYTES_PER_BYTE if there are no observations at all.
+    """
+    #The peak memory per byte of segment file assumed before anything has been measured. Segment files hold 16 or 32
+    #bit samples which are converted to float64 and copied a few times.
+    DEFAULT_BYTES_PER_BYTE = 8.0
+    #The estimates are the learnt ratios times this margin, since the measured peaks vary between segments
+    SAFETY_MARGIN = 1.25
+
+    def __init__(self, subject_ratios=None):
+        """
+        :param subject_ratios: A dictionary of subject names to the peak memory in bytes per byte of segment file.
+        """
+        self.subject_ratios = dict(subject_ratios) if subject_ratios is not None else dict()
+        # The largest ratios observed in this run, which replace the stored ones
+        self.observed = dict()
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a memory model from a JSON file. If the file doesn't exist, an empty model is returned.
+
+        :param path: The path of the JSON file, can be None.
+        :return: A MemoryModel.
+        """
+        if path is None or not os.path.exists(path):
+            return cls()
+        with open(path) as fp:
+            return cls(json.load(fp))
+
+    def save(self, path):
+        """Saves the memory model with the ratios observed in this run as a JSON file at *path*."""
+        model_dir = os.path.dirname(path)
+        if model_dir and not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        self.subject_ratios.update(self.observed)
+        with open(path, 'w') as fp:
+            json.dump(self.subject_ratios, fp, indent=4, separators=(',', ': '), sort_keys=True)
+
+    def bytes_per_byte(self, subject):
+        """Returns the peak memory per byte of segment file of the subject."""
+        if subject in self.observed:
+            return self.observed[subject]
+        if subject in self.subject_ratios:
+            return self.subject_ratios[subject]
+        known = list(self.observed.values()) + list(self.subject_ratios.values())
+        return max(known) if known else self.DEFAULT_BYTES_PER_BYTE
+
+    def estimate(self, segment_path):
+        """
+        Estimates the peak memory of the job of a segment.
+
+        :param segment_path: The path of the segment file.
+        :return: The estimated peak memory in bytes.
+        """
+        return int(os.path.getsize(segment_path) * self.bytes_per_byte(CostModel.subject(segment_path)) *
+                   self.SAFETY_MARGIN)
+
+    def observe(self, result):
+        """
+        Calibrates the model with the peak memory of a job.
+
+        :param result: A job result as returned by run_job. Results without a measured peak memory and results taken
+                       from the feature cache are ignored.
+        :return: None.
+        """
+        if (result.get('peak_memory') is None or result.get('cached') or result['error'] is not None or
+                not os.path.exists(result['segment'])):
+            return
+        size = os.path.getsize(result['segment'])
+        if size == 0:
+            return
+        subject = CostModel.subject(result['segment'])
+        self.observed[subject] = max(self.observed.get(subject, 0.0), result['peak_memory'] / float(size))
+
+
+class ExtractionLedger(object):
+    """
+    Records which segments have been extracted, so that an interrupted extraction can be resumed without recomputing
+    or rescanning anything. The ledger is a file of JSON lines, one per completed segment, with the segment path, size,
+    modification time and checksum, the extractor, a hash of the extraction parameters and the feature file. A line is
+    only appended after the feature file has been completely written, so a feature file with a ledger line is known to
+    be complete. Later lines take precedence over earlier ones.
+
+    A segment is complete if there is a line for it with the same extractor and parameter hash, its contents haven't
+    changed and the feature file still exists and hasn't been overwritten by a later line. Changing a parameter
+    therefore only invalidates the outputs extracted with the old parameters. The checksum is only recalculated if
+    the size or modification time of the segment changed, so a lookup is a dictionary access and two stat calls.
+    """
+    def __init__(self, path, extractor_function, parameters):
+        """
+        :param path: The path of the ledger file. It's created when the first segment is recorded.
+        :param extractor_function: The extractor function the features are extracted with.
+        :param parameters: A dictionary of all parameters which affect the features, see parameter_hash.
+        """
+        self.path = path
+        self.extractor = extractor_name(extractor_function)
+        self.parameter_hash = parameter_hash(parameters)
+        # (segment path, extractor, parameter hash) to ledger entry
+        self.entries = dict()
+        # (feature file path, segment path) to the key of the entry which wrote it last. The segment is part of the key
+        # since all segments of a feature shard share the same file.
+        self.outputs = dict()
+        # Segment path to the (size, mtime, checksum) last seen for it
+        self.checksums = dict()
+
+        if os.path.exists(path):
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash while it was appended
+                        continue
+                    self.add_entry(entry)
+
+    def add_entry(self, entry):
+        """
+        Adds a ledger entry to the lookup tables. An earlier entry with the same feature file and segment is dropped,
+        since the features have been overwritten.
+        """
+        key = (entry['segment'], entry['extractor'], entry['parameter_hash'])
+        output = (entry['output'], entry['segment'])
+        previous_key = self.outputs.get(output)
+        if previous_key is not None and previous_key != key:
+            self.entries.pop(previous_key, None)
+        self.outputs[output] = key
+        self.entries[key] = entry
+        self.checksums[entry['segment']] = (entry['size'], entry['mtime'], entry['checksum'])
+
+    def segment_checksum(self, segment_path):
+        """
+        Returns the checksum of the segment, which is only calculated if the size or modification time of the
+        segment file differs from what was last seen.
+
+        :param segment_path: The absolute path of the segment.
+        :return: A triple (size, mtime, checksum).
+        """
+        stat = os.stat(segment_path)
+        known = self.checksums.get(segment_path)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime):
+            return known
+        known = (stat.st_size, stat.st_mtime, fileutils.file_checksum(segment_path))
+        self.checksums[segment_path] = known
+        return known
+
+    def is_complete(self, segment_path):
+        """
+        Returns True if the features of the segment have been extracted with the extractor and parameters of the
+        ledger, from the current contents of the segment.
+        """
+        segment_path = os.path.abspath(segment_path)
+        entry = self.entries.get((segment_path, self.extractor, self.parameter_hash))
+        if entry is None or not entry['complete'] or not os.path.exists(entry['output']):
+            return False
+        return self.segment_checksum(segment_path)[2] == entry['checksum']
+
+    def record(self, segment_path, output_path):
+        """
+        Appends a completion line for the segment to the ledger.
+
+        :param segment_path: The path of the extracted segment.
+        :param output_path: The path of the complete feature file.
+        :return: None.
+        """
+        segment_path = os.path.abspath(segment_path)
+        size, mtime, checksum = self.segment_checksum(segment_path)
+        entry = dict(segment=segment_path, size=size, mtime=mtime, checksum=checksum,
+                     extractor=self.extractor, parameter_hash=self.parameter_hash,
+                     output=os.path.abspath(output_path), complete=True,
+                     recorded=datetime.datetime.now().isoformat())
+
+        ledger_dir = os.path.dirname(self.path)
+        if ledger_dir and not os.path.exists(ledger_dir):
+            os.makedirs(ledger_dir)
+        # Every entry is written with a single append, so concurrent runs can share the ledger
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(entry, sort_keys=True) + '\n')
+        self.add_entry(entry)
+
+
+def extractor_name(extractor_function):
+    """Returns a name for the extractor function which is unique across the feature modules."""
+    module_name = extractor_function.__module__
+    if module_name == '__main__':
+        # The same name whether the feature module is run with -m or imported
+        module_name = getattr(getattr(sys.modules['__main__'], '__spec__', None), 'name', module_name)
+    return "{}.{}".format(module_name, extractor_function.__name__)
+
+
+def canonical_parameters(value):
+    """
+    Converts extraction parameters to JSON serializable values which don't depend on the order of dictionaries or the
+    identity of objects, so that equal parameters always give the same JSON.
+
+    :param value: A parameter value. Dictionaries, sequences, numbers, strings, numpy values, functions, classes and
+                  objects with attributes are supported.
+    :return: A JSON serializable value.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, dict):
+        items = [[canonical_parameters(key), canonical_parameters(item)] for key, item in value.items()]
+        return sorted(items, key=lambda item: json.dumps(item[0], sort_keys=True))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [canonical_parameters(item) for item in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort(key=lambda item: json.dumps(item, sort_keys=True))
+        return items
+    if hasattr(value, 'tolist'):
+        # numpy scalars and arrays
+        return canonical_parameters(value.tolist())
+    if callable(value) and hasattr(value, '__name__'):
+        return "{}.{}".format(getattr(value, '__module__', None), value.__name__)
+    if hasattr(value, '__dict__'):
+        return [canonical_parameters(type(value)), canonical_parameters(vars(value))]
+    return repr(value)
+
+
+def extraction_parameters(extractor_function, extractor_kwargs, old_segment_format, normalize_signal,
+                          resample_frequency):
+    """
+    Returns a dictionary of all the parameters of an extraction which affect the features. Like *threads*, the keyword
+    arguments the extractor function lists in its *non_feature_kwargs* attribute, such as files it caches intermediate
+    results in, are left out.
+    """
+    non_feature_kwargs = getattr(extractor_function, 'non_feature_kwargs', ())
+    return dict(((key, value) for key, value in extractor_kwargs.items() if key not in non_feature_kwargs),
+                old_segment_format=old_segment_format,
+                normalize_signal=normalize_signal,
+                resample_frequency=resample_frequency)
+
+
+def parameter_hash(parameters):
+    """
+    Returns a hash of the extraction parameters.
+
+    :param parameters: A dictionary of parameter names to values, see canonical_parameters.
+    :return: The SHA-1 digest of the canonical parameters as a hexadecimal string.
+    """
+    encoded = json.dumps(canonical_parameters(parameters), sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def code_version(extractor_function):
+    """
+    Returns a checksum of the code the features depend on: the module of the extractor function and every module of
+    this package it uses, directly or through other modules, like the transforms, the segment loading, feature_io and
+    this module with write_features. The checksums are cached per module.
+    """
+    if not hasattr(code_version, 'checksums'):
+        code_version.checksums = dict()
+    checksums = []
+    for module in dependency_modules(sys.modules[extractor_function.__module__], sg, sys.modules[__name__]):
+        if module.__name__ not in code_version.checksums:
+            source_file = inspect.getsourcefile(module) or module.__file__
+            code_version.checksums[module.__name__] = fileutils.file_checksum(source_file)
+        checksums.append(code_version.checksums[module.__name__])
+    return hashlib.sha1(''.join(checksums).encode('utf-8')).hexdigest()
+
+
+def dependency_modules(*modules):
+    """
+    Returns the given modules and the modules of this package they use, found through the modules, functions and
+    classes in their namespaces, sorted by name.
+    """
+    package = __name__.split('.')[0]
+    found = dict()
+    pending = list(modules)
+    while pending:
+        module = pending.pop()
+        if module.__name__ in found:
+            continue
+        found[module.__name__] = module
+        for value in list(vars(module).values()):
+            if inspect.ismodule(value):
+                dependency = value
+            elif inspect.isfunction(value) or inspect.isclass(value):
+                dependency = sys.modules.get(value.__module__)
+            else:
+                continue
+            if (dependency is not None and dependency.__name__ not in found and
+                    dependency.__name__.split('.')[0] == package and getattr(dependency, '__file__', None)):
+                pending.append(dependency)
+    return [found[name] for name in sorted(found)]
+
+
+def cache_key(segment_checksum, extractor_function, parameters):
+    """
+    Returns the feature cache key of a segment.
+
+    :param segment_checksum: The checksum of the segment file, see fileutils.file_checksum.
+    :param extractor_function: The extractor function.
+    :param parameters: A dictionary of the extraction parameters, see extraction_parameters.
+    :return: The key as a hexadecimal string.
+    """
+    key = [segment_checksum, extractor_name(extractor_function), parameter_hash(parameters),
+           code_version(extractor_function)]
+    return hashlib.sha1('\0'.join(key).encode('utf-8')).hexdigest()
+
+
+class ExtractionScheduler(object):
+    """
+    Runs the feature extraction jobs of a list of segments and keeps track of how every job went. Jobs are submitted
+    to a process pool as workers become free and their results are handled as they complete. Jobs failing with one of
+    the TRANSIENT_ERRORS are resubmitted after a delay which doubles for every attempt.
+
+    Once fewer jobs than workers remain, the cores of the idle workers are given to the jobs which are still running,
+    which split their segment over several threads if the extractor supports it, see ThreadBudget.
+
+    With a memory budget, a job is only started if the estimated peak memory of the running jobs and the job fits in
+    the budget, otherwise it waits for running jobs to finish. The jobs keep their order, so a large segment isn't
+    overtaken indefinitely by smaller ones.
+    """
+    #The number of jobs per worker which are submitted to the pool at once
+    jobs_per_worker = 2
+
+    def __init__(self, segments, job_kwargs, workers=1, max_attempts=3, retry_delay=10, ledger=None,
+                 memory_budget=None, memory_model=None, pool=None, trace_file=None):
+        """
+        :param segments: The paths of the segments to extract features from.
+        :param job_kwargs: The keyword arguments of worker_function, apart from segment_path.
+        :param workers: The number of processes to use. If 1, the jobs are run in this process.
+        :param max_attempts: The number of times a job is tried before it's considered failed.
+        :param retry_delay: The delay in seconds before the first retry of a job.
+        :param ledger: An ExtractionLedger which the succeeded jobs are recorded in, or None.
+        :param memory_budget: The number of bytes of memory the running jobs may use together, or None.
+        :param memory_model: The MemoryModel used for estimating the memory of the jobs, and calibrated with the
+                             measured peak memory. Defaults to an empty model.
+        :param pool: A worker_pool.WorkerPool to run the jobs in. If given, *workers* is the number of processes of the
+                     pool and the pool is left open. Otherwise a pool is created for the run if *workers* is larger
+                     than 1.
+        :param trace_file: The file the jobs append their stage timings to, see run_job. If None, no trace is written.
+        """
+        self.segments = segments
+        self.job_kwargs = job_kwargs
+        self.pool = pool
+        self.workers = pool.processes if pool is not None else workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.ledger = ledger
+        self.memory_budget = memory_budget
+        self.memory_model = memory_model if memory_model is not None else MemoryModel()
+        self.trace_file = trace_file
+        # Identifies the jobs of this run in the trace file, which is shared by all runs with the same output directory
+        self.run_id = "{}-{}".format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid())
+
+        self.succeeded = []
+        self.failed = []
+        # The jobs which haven't been run yet as (segment path, attempt) pairs, the next job last
+        self.pending = [(segment, 1) for segment in reversed(segments)]
+        # Retries are kept in a heap of (time to run, segment path, attempt)
+        self.retries = []
+
+    def run(self):
+        """
+        Runs the jobs of all the segments.
+
+        :return: The manifest of the run, see manifest.
+        """
+        started = datetime.datetime.now()
+        if self.workers > 1:
+            self.run_parallel()
+        else:
+            self.run_serial()
+        return self.manifest(started, datetime.datetime.now())
+
+    def has_jobs(self):
+        """Returns True if there are jobs which haven't been started, including retries which aren't due yet."""
+        return bool(self.pending or self.retries)
+
+    def next_job(self):
+        """
+        Returns the next job to run as a (segment path, attempt) pair, or None if no job can be started right now.
+        Due retries go first.
+        """
+        if self.retries and self.retries[0][0] <= time.time():
+            _, segment, attempt = heapq.heappop(self.retries)
+            return segment, attempt
+        if self.pending:
+            return self.pending.pop()
+        return None
+
+    def wait_for_job(self):
+        """Waits until next_job may return a job, when only retries which aren't due yet are left."""
+        if self.retries:
+            time.sleep(max(self.retries[0][0] - time.time(), 0))
+
+    def unfinished(self):
+        """Returns the number of jobs which haven't finished."""
+        return len(self.segments) - len(self.succeeded) - len(self.failed)
+
+    def run_serial(self):
+        """Runs all the jobs in this process."""
+        while self.has_jobs():
+            job = self.next_job()
+            if job is None:
+                self.wait_for_job()
+                continue
+            segment, attempt = job
+            result = run_job(segment, attempt, self.job_kwargs, self.trace_file, self.run_id)
+            self.memory_model.observe(result)
+            self.handle_result(result)
+
+    def run_parallel(self):
+        """
+        Runs the jobs in a process pool, in the order of the segment list. At most jobs_per_worker jobs per worker are
+        submitted at once, so that the order is kept and retries don't end up behind all the other segments. With a
+        memory budget only one job per worker is submitted, so that the submitted jobs are the running ones.
+
+        The workers announce which process runs a job when it starts. A job whose process dies, for example when it's
+        killed for running out of memory, never gets a result from the pool, so it's failed with a WorkerLostError and
+        retried, see lost_jobs. The pool still waits for the results of lost jobs, so it's terminated instead of joined.
+        """
+        completed = queue.Queue()
+        in_flight = 0
+        # (segment path, attempt) of the submitted jobs to the pid of the worker running them, None until announced
+        running = dict()
+        # Jobs whose worker has gone, to the time it was first missed
+        missing = dict()
+        lost = 0
+        if self.memory_budget is not None:
+            max_in_flight = self.workers
+        else:
+            max_in_flight = self.jobs_per_worker * self.workers
+        # Segment path to the estimated memory of the submitted jobs, and a job waiting for memory
+        admitted = dict()
+        waiting = None
+        # The number of jobs which haven't finished, read by the workers when a job starts
+        if self.pool is not None:
+            pool = self.pool.pool
+            remaining_jobs = self.pool.remaining_tasks
+            remaining_jobs.value = self.unfinished()
+            started_jobs = self.pool.started_jobs
+        else:
+            remaining_jobs = multiprocessing.Value('i', self.unfinished())
+            started_jobs = multiprocessing.SimpleQueue()
+            pool = multiprocessing.Pool(self.workers, initializer=init_worker,
+                                        initargs=(remaining_jobs, self.workers, started_jobs))
         try:
-            for segment in segments:
-                pool.apply_async(worker_function,
-                                 kwds=dict(segment_path=segment,
-                                           extractor_function=extractor_function,
-                                           output_dir=output_dir,
-                                           old_segment_format=old_segment_format,
-                                           normalize_signal=normalize_signal,
-                                           extractor_kwargs=extractor_kwargs,
-                                           naming_function=naming_function,
-                                           resample_frequency=resample_frequency))
+            while self.has_jobs() or in_flight or waiting is not None:
+                while in_flight < max_in_flight:
+                    job = waiting if waiting is not None else self.next_job()
+                    waiting = None
+                    if job is None:
+                        break
+                    segment, attempt = job
+                    if self.memory_budget is not None:
+                        estimate = self.memory_model.estimate(segment)
+                        if in_flight > 0 and sum(admitted.values()) + estimate > self.memory_budget:
+                            waiting = job
+                            break
+                        admitted[segment] = estimate
+                    pool.apply_async(run_job, (segment, attempt, self.job_kwargs, self.trace_file, self.run_id),
+                                     callback=completed.put,
+                                     error_callback=lambda error, segment=segment, attempt=attempt:
+                                     completed.put(job_error(segment, attempt, error)))
+                    running[(segment, attempt)] = None
+                    in_flight += 1
+
+                if in_flight == 0:
+                    # Only jobs which can't be started yet are left
+                    self.wait_for_job()
+                    continue
+
+                # Wake up regularly so that due retries are submitted even if no job completes
+                try:
+                    result = completed.get(timeout=1)
+                except queue.Empty:
+                    result = None
+                lost_results = self.lost_jobs(started_jobs, running, missing)
+                lost += len(lost_results)
+                results = ([result] if result is not None else []) + lost_results
+                for result in results:
+                    job = (result['segment'], result['attempts'])
+                    if job not in running:
+                        # The result of a job which was already given up as lost
+                        continue
+                    del running[job]
+                    missing.pop(job, None)
+                    in_flight -= 1
+                    admitted.pop(result['segment'], None)
+                    self.memory_model.observe(result)
+                    self.handle_result(result)
+                remaining_jobs.value = self.unfinished()
         finally:
-            pool.close()
-            pool.join()
+            if self.pool is not None:
+                self.pool.lost_tasks += lost
+            elif lost:
+                pool.terminate()
+                pool.join()
+            else:
+                pool.close()
+                pool.join()
 
-    else:
-        for segment in segments:
-            worker_function(segment_path=segment,
-                            extractor_function=extractor_function,
-                            output_dir=output_dir,
-                            old_segment_format=old_segment_format,
-                            normalize_signal=normalize_signal,
-                            extractor_kwargs=extractor_kwargs,
-                            naming_function=naming_function,
-                            resample_frequency=resample_frequency)
+    def lost_jobs(self, started_jobs, running, missing):
+        """
+        Finds the running jobs whose worker process has died.
+
+        :param started_jobs: The queue the workers announce the jobs they start on, see announce_job.
+        :param running: The submitted jobs of run_parallel as a dictionary of (segment path, attempt) to the pid of
+                        the worker running the job, which is updated with the announced jobs.
+        :param missing: A dictionary of jobs whose worker is gone to the time it was first missed, which is updated.
+        :return: A list of failed results for the jobs whose worker has been gone for LOST_JOB_GRACE_SECONDS.
+        """
+        while not started_jobs.empty():
+            run_id, segment, attempt, pid = started_jobs.get()
+            if run_id == self.run_id and (segment, attempt) in running:
+                running[(segment, attempt)] = pid
+
+        now = time.time()
+        lost = []
+        for job, pid in running.items():
+            if pid is None or process_alive(pid):
+                missing.pop(job, None)
+            elif now - missing.setdefault(job, now) >= LOST_JOB_GRACE_SECONDS:
+                segment, attempt = job
+                print("The worker process {} running segment {} died".format(pid, segment))
+                lost.append(job_lost(segment, attempt, pid))
+        return lost
+
+    def handle_result(self, result):
+        """
+        Records the result of a job, and schedules a retry if it failed with a transient error.
+
+        :param result: A result dictionary as returned by run_job.
+        :return: True if the job will be retried, False if it's finished.
+        """
+        if result['error'] is None:
+            self.succeeded.append(result)
+            if self.ledger is not None:
+                self.ledger.record(result['segment'], result['output'])
+        elif result['transient'] and result['attempts'] < self.max_attempts:
+            delay = self.retry_delay * 2 ** (result['attempts'] - 1)
+            print("Segment {} failed with {}, retrying in {} seconds".format(result['segment'], result['error_type'],
+                                                                             delay))
+            heapq.heappush(self.retries, (time.time() + delay, result['segment'], result['attempts'] + 1))
+            return True
+        else:
+            self.failed.append(result)
+        return False
+
+    def manifest(self, started, finished):
+        """
+        Returns a JSON serializable summary of the run.
+
+        :param started: The datetime the run started.
+        :param finished: The datetime the run finished.
+        :return: A dictionary with the keys 'started', 'finished', 'n_segments', 'succeeded' and 'failed'. 'succeeded'
+                 and 'failed' are lists of result dictionaries as returned by run_job, sorted by segment.
+        """
+        return dict(started=started.isoformat(),
+                    finished=finished.isoformat(),
+                    n_segments=len(self.segments),
+                    succeeded=sorted(self.succeeded, key=lambda result: result['segment']),
+                    failed=sorted(self.failed, key=lambda result: result['segment']))
+
+
+class QueueScheduler(ExtractionScheduler):
+    """
+    Runs extraction jobs taken from a work_queue.WorkQueue shared with other hosts, until the queue is drained. The
+    segments of this run are added to the queue first, and jobs added by other runs are worked on as well. Jobs are
+    claimed one at a time as workers become free, so no host sits on jobs which an idle host could run. Retries are
+    put back into the queue, and jobs of workers whose lease expired are taken over.
+
+    The manifest only lists the jobs run by this host, the results of all jobs are in the done/ and failed/
+    directories of the queue.
+    """
+    jobs_per_worker = 1
+
+    def __init__(self, segments, job_kwargs, work_queue, **kwargs):
+        """
+        :param segments: The paths of the segments to add to the queue.
+        :param job_kwargs: The keyword arguments of worker_function, apart from segment_path.
+        :param work_queue: The work_queue.WorkQueue to take jobs from.
+        :param kwargs: Keyword arguments of ExtractionScheduler.
+        """
+        super(QueueScheduler, self).__init__(segments, job_kwargs, **kwargs)
+        self.work_queue = work_queue
+        # Segment path to the (job name, job) claimed for it
+        self.claims = dict()
+        self.last_expiry = 0
+
+    def run(self):
+        """
+        Adds the segments to the queue and runs jobs until the queue is drained.
+
+        :return: The manifest of the run, see manifest. It has the additional key 'queue' with the job counts of the
+                 queue when the run finished, see work_queue.WorkQueue.counts.
+        """
+        self.work_queue.enqueue(self.segments)
+        self.work_queue.start_heartbeat()
+        try:
+            manifest = super(QueueScheduler, self).run()
+        finally:
+            self.work_queue.stop_heartbeat()
+        manifest['queue'] = self.work_queue.counts()
+        return manifest
+
+    def has_jobs(self):
+        """Returns True while any job of the queue is pending or claimed by a worker, on any host."""
+        return self.work_queue.unfinished() > 0
+
+    def next_job(self):
+        """Claims the next job of the queue, after taking over the jobs of workers whose lease has expired."""
+        if time.time() - self.last_expiry > self.work_queue.heartbeat_interval:
+            self.work_queue.expire_leases()
+            self.last_expiry = time.time()
+        claim = self.work_queue.claim()
+        if claim is None:
+            return None
+        name, job = claim
+        self.claims[job['segment']] = claim
+        return job['segment'], job['attempt']
+
+    def wait_for_job(self):
+        """Waits a moment before polling the queue again."""
+        time.sleep(min(self.work_queue.heartbeat_interval, 5))
+
+    def unfinished(self):
+        """Returns the number of jobs of the queue which haven't finished."""
+        return self.work_queue.unfinished()
+
+    def handle_result(self, result):
+        """
+        Records the result of a job in the queue, and puts it back into the queue if it failed with a transient error.
+
+        :param result: A result dictionary as returned by run_job.
+        :return: True if the job will be retried, False if it's finished.
+        """
+        name, job = self.claims.pop(result['segment'])
+        if result['error'] is None:
+            self.succeeded.append(result)
+            if self.ledger is not None:
+                self.ledger.record(result['segment'], result['output'])
+            self.work_queue.complete(name, result)
+        elif result['transient'] and result['attempts'] < self.max_attempts:
+            delay = self.retry_delay * 2 ** (result['attempts'] - 1)
+            print("Segment {} failed with {}, retrying in {} seconds".format(result['segment'], result['error_type'],
+                                                                             delay))
+            self.work_queue.retry(name, job, delay)
+            return True
+        else:
+            self.failed.append(result)
+            self.work_queue.fail(name, result)
+        return False
+
+
+class ThreadBudget(object):
+    """
+    The number of threads a job in a worker process of the scheduler may use. While there are at least as many
+    unfinished jobs as workers every job gets one thread, after that the workers are divided between the remaining
+    jobs. The budget of a running job grows as the other jobs finish, so extractors should check it regularly, see
+    current_threads. This keeps the cores busy when only a few large segments are left at the end of a run.
+    """
+    def __init__(self, remaining_jobs, workers):
+        """
+        :param remaining_jobs: A shared multiprocessing.Value with the number of jobs which haven't finished.
+        :param workers: The number of worker processes.
+        """
+        self.remaining_jobs = remaining_jobs
+        self.maximum = workers
+
+    def current(self):
+        """Returns the number of threads the job may use right now."""
+        return max(1, self.maximum // max(self.remaining_jobs.value, 1))
+
+
+def init_worker(remaining_jobs, workers, started_jobs=None):
+    """
+    Initializes a worker process of ExtractionScheduler.run_parallel.
+
+    :param remaining_jobs: A shared multiprocessing.Value with the number of jobs which haven't finished.
+    :param workers: The number of worker processes.
+    :param started_jobs: A multiprocessing.SimpleQueue the worker announces the jobs it starts on, see announce_job.
+    :return: None.
+    """
+    job_threads.budget = ThreadBudget(remaining_jobs, workers)
+    announce_job.queue = started_jobs
+
+
+def announce_job(run_id, segment_path, attempt):
+    """
+    Tells the scheduler which worker process runs a job, so that it notices when the process dies, see
+    ExtractionScheduler.lost_jobs. Does nothing outside of a worker process.
+    """
+    started_jobs = announce_job.queue
+    if started_jobs is None:
+        state = worker_pool.worker_state()
+        started_jobs = state.started_jobs if state is not None else None
+    if started_jobs is not None:
+        started_jobs.put((run_id, segment_path, attempt, os.getpid()))
+announce_job.queue = None
+
+
+def process_alive(pid):
+    """Returns True if a process with the pid exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+def job_threads():
+    """
+    Returns the ThreadBudget of the worker process, or 1 outside of a worker process of the scheduler. Workers of a
+    worker_pool.WorkerPool get a budget based on the shared counter of the pool.
+    """
+    budget = getattr(job_threads, 'budget', None)
+    if budget is None:
+        state = worker_pool.worker_state()
+        if state is None:
+            return 1
+        budget = job_threads.budget = ThreadBudget(state.remaining_tasks, state.processes)
+    return budget
+
+
+def current_threads(threads):
+    """Returns the number of threads to use now for a *threads* argument, which is an int or a ThreadBudget."""
+    return threads.current() if isinstance(threads, ThreadBudget) else threads
+
+
+def maximum_threads(threads):
+    """Returns the most threads a *threads* argument, which is an int or a ThreadBudget, will ever allow."""
+    return threads.maximum if isinstance(threads, ThreadBudget) else threads
+
+
+def accepts_threads(extractor_function):
+    """Returns True if the extractor function can split a segment over threads, by taking a *threads* argument."""
+    try:
+        parameters = inspect.signature(extractor_function).parameters
+    except AttributeError:
+        # Python 2
+        parameters = inspect.getargspec(extractor_function).args
+    return 'threads' in parameters
+
+
+def thread_map(function, items, threads=1):
+    """
+    Applies *function* to every item, using a pool of *threads* threads. Numpy releases the GIL in FFTs and matrix
+    products, so this gives a real speedup for extractors whose work is dominated by them.
+
+    :param function: A function of one argument.
+    :param items: An iterable of arguments.
+    :param threads: The number of threads. With 1 thread the items are processed in this thread.
+    :return: A list of the results, in the order of the items.
+    """
+    items = list(items)
+    if threads <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    pool = multiprocessing.pool.ThreadPool(min(threads, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_job(segment_path, attempt, job_kwargs, trace_file=None, run_id=None):
+    """
+    Runs worker_function for a segment and reports how it went. Exceptions are caught and reported in the result so
+    that the traceback of the worker process isn't lost. The stages of the job are timed, and appended to
+    *trace_file* as a JSON line, see datasets.stage_timing.
+
+    :param segment_path: The path of the segment to extract features from.
+    :param attempt: The number of the attempt, starting from 1.
+    :param job_kwargs: The other keyword arguments for worker_function.
+    :param trace_file: The trace file of the run, or None.
+    :param run_id: The id of the run, stored in the trace record.
+    :return: A dictionary with the keys 'segment', 'attempts', 'seconds', 'peak_memory', 'output', 'cached', 'error',
+             'error_type', 'traceback' and 'transient'. 'output' is the path of the feature file, the error keys are
+             None if the job succeeded. 'peak_memory' is the peak resident set size of the job in bytes on top of the
+             memory the process used before it, or None if it can't be measured, see job_peak_memory. 'cached' is
+             True if the features were taken from the feature cache instead of being extracted.
+    """
+    announce_job(run_id, segment_path, attempt)
+    start_time = time.time()
+    result = dict(segment=segment_path, attempts=attempt, output=None, peak_memory=None, cached=False,
+                  error=None, error_type=None, traceback=None, transient=False)
+    rss_before = reset_peak_memory()
+    with stage_timing.timed_job() as timer:
+        try:
+            result['output'] = worker_function(segment_path=segment_path, threads=job_threads(), status=result,
+                                               **job_kwargs)
+        except Exception as error:
+            result.update(error=str(error),
+                          error_type=type(error).__name__,
+                          traceback=traceback.format_exc(),
+                          transient=isinstance(error, TRANSIENT_ERRORS))
+    result['seconds'] = time.time() - start_time
+    result['peak_memory'] = job_peak_memory(rss_before)
+    if trace_file is not None:
+        try:
+            stage_timing.append_record(trace_file, stage_timing.job_record(
+                timer, segment_path, start_time, result['seconds'],
+                run=run_id,
+                extractor=job_kwargs['extractor_function'].__name__,
+                attempt=attempt,
+                succeeded=result['error'] is None,
+                peak_memory=result['peak_memory']))
+        except (IOError, OSError) as error:
+            # The trace is only telemetry, it mustn't fail the job
+            print("Couldn't write the trace of segment {}: {}".format(segment_path, error))
+    return result
+
+
+def memory_status(field):
+    """
+    Returns a memory field of /proc/self/status in bytes, like 'VmRSS' for the resident set size or 'VmHWM' for its
+    peak. Returns None if the field isn't available, for example on other systems than Linux.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (EnvironmentError, ValueError, IndexError):
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """
+    Resets the peak resident set size of the process to the current one, which Linux supports since 4.0. On older
+    kernels the peak stays the peak over the life time of the process, which only overestimates the peaks of later
+    jobs.
+
+    :return: The current resident set size in bytes, or None if it can't be read.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except EnvironmentError:
+        pass
+    return memory_status('VmRSS')
+
+
+def job_peak_memory(rss_before):
+    """
+    Returns the peak memory of a job, the peak resident set size since reset_peak_memory minus the resident set size
+    before the job, or None if it can't be measured.
+    """
+    peak = memory_status('VmHWM')
+    if peak is None or rss_before is None:
+        return None
+    return max(peak - rss_before, 0)
+
+
+def job_error(segment_path, attempt, error):
+    """
+    Returns a failed job result for an error which happened outside of run_job, for example if the result couldn't be
+    sent back from the worker process.
+    """
+    return dict(segment=segment_path, attempts=attempt, output=None, seconds=None, peak_memory=None, cached=False,
+                error=str(error), error_type=type(error).__name__, traceback=None,
+                transient=False)
+
+
+class WorkerLostError(Exception):
+    """The worker process running a job died without reporting a result."""
+
+
+def job_lost(segment_path, attempt, pid):
+    """
+    Returns a failed job result for a job whose worker process died, for example because it was killed for running
+    out of memory. The job is retried like a job failing with a transient error.
+    """
+    result = job_error(segment_path, attempt, WorkerLostError("The worker process {} running the job "
+                                                              "died".format(pid)))
+    result['transient'] = True
+    return result
+
+
+def exit_status(manifest):
+    """Returns the exit status for a command line extraction run, 1 if any segment failed and 0 otherwise."""
+    return 1 if manifest['failed'] else 0
+
+
+def write_manifest(manifest, manifest_file):
+    """
+    Writes the extraction manifest as JSON.
+
+    :param manifest: The manifest dictionary as returned by extract.
+    :param manifest_file: The path to write to.
+    :return: None.
+    """
+    manifest_dir = os.path.dirname(manifest_file)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_file, 'w') as fp:
+        json.dump(manifest, fp, indent=4, separators=(',', ': '), sort_keys=True)
 
 
 def worker_function(segment_path, extractor_function, output_dir,
                     old_segment_format=False, normalize_signal=False,
                     extractor_kwargs=None,
                     naming_function=None,
-                    resample_frequency=None):
+                    resample_frequency=None,
+                    shard_output=False,
+                    cache=None,
+                    threads=1,
+                    status=None):
     """
     Worker function for the feature extractor. Reads the segment from *segment_path* and runs uses it as the first
     argument to *extractor_function*.
@@ -119,8 +1280,16 @@ def worker_function(segment_path, extractor_function, output_dir,
     path and output dir as its first arguments. The extractor_kwargs dictionary will also be supplied as key-word
     arguments.
     :param resample_frequency: If this is not None, the segments will be resampled to this frequency.
-    :return: None. The features will be written to the file generated by *naming_function*,
-             or *default_naming_function*.
+    :param shard_output: If True, the features are appended to the feature shard of the subject and class of the
+                         segment instead of being written to a feature file.
+    :param cache: A feature_cache.FeatureCache to take the features from if they are cached, and to add them to
+                  otherwise. If None, the features are always extracted.
+    :param threads: The number of threads the extractor may use for the segment, an int or a ThreadBudget. Only passed
+                    on to extractor functions which accept a *threads* argument, and not part of the extraction
+                    parameters since it doesn't change the features.
+    :param status: An optional dictionary whose key 'cached' is set to True if the features are taken from the cache.
+    :return: The path of the feature file or shard. The features will be written to the file generated by
+             *naming_function*, or *default_naming_function*.
     """
     if extractor_kwargs is None:
         extractor_kwargs = dict()
@@ -128,39 +1297,115 @@ def worker_function(segment_path, extractor_function, output_dir,
     if output_dir is None:
         output_dir = os.path.dirname(segment_path)
 
+    if cache is not None:
+        key = cache_key(fileutils.file_checksum(segment_path), extractor_function,
+                        extraction_parameters(extractor_function, extractor_kwargs, old_segment_format,
+                                              normalize_signal, resample_frequency))
+        feature_file = feature_file_name(segment_path, output_dir, extractor_function, extractor_kwargs,
+                                         naming_function)
+        if not os.path.exists(os.path.dirname(feature_file)):
+            os.makedirs(os.path.dirname(feature_file))
+        with stage_timing.stage('cache'):
+            fetched = cache.fetch(key, feature_file)
+        if fetched:
+            if status is not None:
+                status['cached'] = True
+            stage_timing.count_written(os.path.getsize(feature_file))
+            print("Segment {} taken from the feature cache".format(segment_path))
+            return feature_file
+
     segment = sg.load_segment(segment_path,
                               old_segment_format=old_segment_format,
                               normalize_signal=normalize_signal,
                               resample_frequency=resample_frequency)
+    stage_timing.count_read(os.path.getsize(segment_path))
 
-    features = extractor_function(segment, **extractor_kwargs)
-    write_features(features, segment_path, extractor_function, output_dir, extractor_kwargs, naming_function)
+    with stage_timing.stage('transform'):
+        if maximum_threads(threads) > 1 and accepts_threads(extractor_function):
+            features = extractor_function(segment, threads=threads, **extractor_kwargs)
+        else:
+            features = extractor_function(segment, **extractor_kwargs)
+    feature_file = write_features(features, segment_path, extractor_function, output_dir, extractor_kwargs,
+                                  naming_function, shard_output=shard_output)
+    if cache is not None:
+        cache.store(key, feature_file, dict(segment=os.path.abspath(segment_path),
+                                            extractor=extractor_name(extractor_function)))
     print("Segment {} completed".format(segment_path))
+    return feature_file
 
 
-def write_features(features, segment_path, extractor_function, output_dir, extractor_kwargs, naming_function=None):
+def write_features(features, segment_path, extractor_function, output_dir, extractor_kwargs, naming_function=None,
+                   shard_output=False):
     """
     Creates the csv output files for the feature extraction
 
     :param features: A dict containing the extracted features. Each item in the dict corresponds to one frame in the
-    extraction
+    extraction. Can also be a list of dicts or a RowStream, which are written as the rows of a tab separated csv file,
+    or a feature_io.FeatureArrays or feature_io.StreamedFeatureArrays object, which is written as a binary feature
+    file.
     :param segment_path: A path to the segment file for which the features were extracted.
     :param extractor_function: A function which accepts a segment object as its first positional argument.
     :param output_dir: The directory where the resulting features will be written to.
     :param extractor_kwargs: Keyword arguments for the extractor function
     :param naming_function: A function to use for generating the name of the feature file.
-    :return: None. Creates the output csv files
+    :param shard_output: If True, the features are appended to a feature shard, see datasets.feature_shards. The shard
+                         is named after the feature file.
+    :return: The path of the feature file or shard. Creates the output csv files
     """
-    if naming_function is None:
-        csv_file_path = default_naming_function(segment_path, output_dir, extractor_function)
-    else:
-        csv_file_path = naming_function(segment_path, output_dir, **extractor_kwargs)
+    csv_file_path = feature_file_name(segment_path, output_dir, extractor_function, extractor_kwargs, naming_function)
 
     if not os.path.exists(os.path.dirname(csv_file_path)):
-        os.makedirs(os.path.dirname(csv_file_path))
+        try:
+            os.makedirs(os.path.dirname(csv_file_path))
+        except OSError:
+            # Created by another worker in the meantime
+            if not os.path.isdir(os.path.dirname(csv_file_path)):
+                raise
 
+    if shard_output:
+        shard_file = feature_shards.shard_path(csv_file_path)
+        with stage_timing.stage('serialize'):
+            payload = feature_shards.encode_features(features)
+        with stage_timing.stage('write'):
+            feature_shards.append_record(shard_file, fileutils.get_segment_name(segment_path), payload)
+        stage_timing.count_written(len(payload))
+        return shard_file
+
+    # The features are written to a temporary file which is renamed when it's complete, so that an interrupted
+    # extraction never leaves a partial feature file behind. The features are encoded as they are written, so the
+    # time of encoding them is part of the 'write' stage. Streamed features are only calculated while they are
+    # written, so their writing counts as the 'transform' stage
+    streamed = isinstance(features, (RowStream, feature_io.StreamedFeatureArrays))
+    temporary_path = "{}.{}.tmp".format(csv_file_path, os.getpid())
+    try:
+        with stage_timing.stage('transform' if streamed else 'write'):
+            if isinstance(features, (feature_io.FeatureArrays, feature_io.StreamedFeatureArrays)):
+                features.write(temporary_path)
+            else:
+                write_csv_features(features, temporary_path)
+            os.rename(temporary_path, csv_file_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    stage_timing.count_written(os.path.getsize(csv_file_path))
+    return csv_file_path
+
+
+def write_csv_features(features, csv_file_path):
+    """
+    Writes features as a csv file.
+
+    :param features: A dict of frames, a list of dicts or a RowStream, see write_features.
+    :param csv_file_path: The path of the csv file.
+    :return: None.
+    """
     with open(csv_file_path, 'w') as csv_file:
-        if isinstance(features, dict):
+        if isinstance(features, RowStream):
+            csv_writer = csv.DictWriter(csv_file, fieldnames=features.fieldnames, delimiter=features.delimiter)
+            csv_writer.writeheader()
+            for row in features.rows:
+                csv_writer.writerow(row)
+        elif isinstance(features, dict):
             csv_writer = csv.writer(csv_file)
             for index, feature in sorted(features.items()):
                 csv_writer.writerow(feature)
@@ -170,19 +1415,31 @@ def write_features(features, segment_path, extractor_function, output_dir, extra
             csv_writer.writerows(features)
 
 
-def default_naming_function(segment_path, output_dir, extractor_function):
+def feature_file_name(segment_path, output_dir, extractor_function, extractor_kwargs, naming_function=None):
+    """
+    Returns the path of the feature file of the segment, given by *naming_function* or default_naming_function. The
+    default names get the binary feature file extension if the extractor is called with output_format='binary'.
+    """
+    if naming_function is None:
+        extension = feature_io.FEATURE_FILE_EXTENSION if extractor_kwargs.get('output_format') == 'binary' else '.csv'
+        return default_naming_function(segment_path, output_dir, extractor_function, extension=extension)
+    return naming_function(segment_path, output_dir, **extractor_kwargs)
+
+
+def default_naming_function(segment_path, output_dir, extractor_function, extension='.csv'):
     """
     Creates the default names for the extracted feature csv files
     :param segment_path: The path to the segment being extracted
     :param output_dir: The directory where the resulting features will be written to.
     :param extractor_function: A function which accepts a segment object as its first positional argument.
+    :param extension: The file extension of the feature file.
     :return: A String containing the name of the feature file to be extracted
     """
     if fileutils.get_subject(output_dir) is None:
         subject = fileutils.get_subject(segment_path)
         output_dir = os.path.join(output_dir, subject)
     basename, ext = os.path.splitext(os.path.basename(segment_path))
-    return os.path.join(output_dir, "{}_{}.csv".format(basename, extractor_function.__name__))
+    return os.path.join(output_dir, "{}_{}{}".format(basename, extractor_function.__name__, extension))
 
 
 def test_extractor(segment):
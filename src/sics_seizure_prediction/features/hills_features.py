@@ -6,6 +6,9 @@ mne.set_log_level(verbose='WARNING')
 import sys
 from itertools import chain
 
+from ..datasets import feature_io
+from ..datasets import stage_timing
+from . import feature_cache
 from . import feature_extractor
 from . import wavelets
 
@@ -13,7 +16,8 @@ from .transforms import FFTWithTimeFreqCorrelation as FFT_TF_xcorr
 from .transforms import FilteredFFTWithTFCorrelation as Filtered_TF_xcorr
 
 
-def extract_features_for_segment(segment, transformation=None, feature_length_seconds=60, window_size=5):
+def extract_features_for_segment(segment, transformation=None, feature_length_seconds=60, window_size=5,
+                                 output_format='csv', threads=1):
     """
     Creates a feature dictionary from a Segment object, according to the provided
     transformation function.
@@ -24,6 +28,10 @@ def extract_features_for_segment(segment, transformation=None, feature_length_se
     :param feature_length_seconds: The number of seconds each frame should consist
         of, should be exactly divisible by window_size.
     :param window_size: The length of a window in seconds.
+    :param output_format: Either 'csv' or 'binary'. If 'binary', the frames are returned as a feature_io.FeatureArrays
+        object with a (frames x features) array instead of a dict.
+    :param threads: The number of threads the windows are divided between, an int or a
+                    feature_extractor.ThreadBudget.
     :return: A dict of features, where each keys are the frames indexes in the segment
         and the values are a List of doubles containing all the feature values
         for that frame.
@@ -32,6 +40,9 @@ def extract_features_for_segment(segment, transformation=None, feature_length_se
         number of channels and number of frequency bands we are examining.
     """
 
+    if output_format not in ('csv', 'binary'):
+        raise ValueError("Output format {} is unknown.".format(output_format))
+
     if transformation is None:
         transformation = FFT_TF_xcorr(1, 48, 400, 'usf')
     # TODO: Assert that the function implements apply()
@@ -42,12 +53,12 @@ def extract_features_for_segment(segment, transformation=None, feature_length_se
     iters = int(segment.get_duration() / feature_length_seconds)
 
     # Create Epochs object according to defined window size
-    epochs = wavelets.epochs_from_segment(segment, window_size)
+    with stage_timing.stage('window'):
+        epochs = wavelets.epochs_from_segment(segment, window_size)
 
-    feature_list = []
     # Create a list of features
-    for epoch in epochs:
-        feature_list.append(transformation.apply(epoch).tolist())
+    feature_list = feature_extractor.thread_map(lambda epoch: transformation.apply(epoch).tolist(), epochs,
+                                                feature_extractor.current_threads(threads))
 
     feature_dict = {}
     # Slice the features to frames
@@ -59,6 +70,14 @@ def extract_features_for_segment(segment, transformation=None, feature_length_se
         sys.stderr.write("WARNING: Wrong number of features created, expected"
                          " %d, got %d instead." % (iters, len(feature_dict)))
 
+    if output_format == 'binary':
+        attributes = dict(feature='hills',
+                          layout=['window', 'feature'],
+                          transformation=type(transformation).__name__,
+                          windows_per_frame=windows_in_frame,
+                          window_size=window_size,
+                          feature_length_seconds=feature_length_seconds)
+        return feature_io.FeatureArrays.from_frames(feature_dict, attributes)
     return feature_dict
 
 
@@ -78,7 +97,13 @@ def extract_features(segment_paths,
                      normalize_signal=False,
                      only_missing_files=True,
                      feature_length_seconds=60,
-                     window_size=5):
+                     window_size=5,
+                     output_format='csv',
+                     cache_dir=None,
+                     cache_max_bytes=None,
+                     shard_output=False,
+                     queue_dir=None,
+                     memory_budget=None):
     """
     Performs feature extraction of the segment files found in *segment_paths*. The features are written to csv
     files in *output_dir*. See :py:function`feature_extractor.extract` for more info.
@@ -92,21 +117,33 @@ def extract_features(segment_paths,
     :param only_missing_files:
     :param feature_length_seconds:
     :param window_size:
-    :return:
+    :param output_format:
+    :param cache_dir:
+    :param cache_max_bytes:
+    :param shard_output:
+    :param queue_dir:
+    :param memory_budget:
+    :return: The manifest of the extraction run, see feature_extractor.extract.
     """
-    feature_extractor.extract(segment_paths,
-                              extract_features_for_segment,
-                              # Arguments for feature_extractor.extract
-                              output_dir=output_dir,
-                              workers=workers,
-                              sample_size=sample_size,
-                              old_segment_format=old_segment_format,
-                              resample_frequency=resample_frequency,
-                              normalize_signal=normalize_signal,
-                              only_missing_files=only_missing_files,
-                              # Worker function kwargs:
-                              feature_length_seconds=feature_length_seconds,
-                              window_size=window_size)
+    return feature_extractor.extract(segment_paths,
+                                     extract_features_for_segment,
+                                     # Arguments for feature_extractor.extract
+                                     output_dir=output_dir,
+                                     workers=workers,
+                                     sample_size=sample_size,
+                                     old_segment_format=old_segment_format,
+                                     resample_frequency=resample_frequency,
+                                     normalize_signal=normalize_signal,
+                                     only_missing_files=only_missing_files,
+                                     cache_dir=cache_dir,
+                                     cache_max_bytes=cache_max_bytes,
+                                     shard_output=shard_output,
+                                     queue_dir=queue_dir,
+                                     memory_budget=memory_budget,
+                                     # Worker function kwargs:
+                                     feature_length_seconds=feature_length_seconds,
+                                     window_size=window_size,
+                                     output_format=output_format)
 
 
 if __name__ == '__main__':
@@ -133,12 +170,46 @@ if __name__ == '__main__':
                         default=False,
                         action='store_true',
                         dest='normalize_signal')
+    parser.add_argument("--output-format",
+                        help=("The format of the feature files. 'binary' writes the frames as a (frames x features) "
+                              "array with a header describing them, see datasets.feature_io."),
+                        choices=['csv', 'binary'],
+                        default='csv')
+    parser.add_argument("--feature-cache",
+                        help=("A feature cache directory shared between runs. Segments extracted before with the same "
+                              "parameters are taken from the cache, see feature_cache."),
+                        dest='cache_dir')
+    parser.add_argument("--cache-max-size",
+                        help="The disk budget of the feature cache, for example 20G. Unbounded if omitted.",
+                        type=feature_cache.parse_size,
+                        dest='cache_max_bytes')
+    parser.add_argument("--shard-output",
+                        help=("Append the features of every subject and class to a single feature shard instead of "
+                              "writing a file per segment, see datasets.feature_shards. Requires binary output."),
+                        action='store_true',
+                        dest='shard_output')
+    parser.add_argument("--work-queue",
+                        help=("A work queue directory on a file system shared between hosts. Runs on several hosts "
+                              "with the same queue share the segments between them, see work_queue."),
+                        dest='queue_dir')
+    parser.add_argument("--memory-budget",
+                        help=("The memory the extraction jobs may use together, for example 100G. Jobs are only "
+                              "started while their estimated peak memory fits, see feature_extractor.MemoryModel."),
+                        type=feature_cache.parse_size,
+                        dest='memory_budget')
     args = parser.parse_args()
 
-    extract_features(args.segments,
-                     args.csv_directory,
-                     workers=args.workers,
-                     resample_frequency=args.resample_frequency,
-                     normalize_signal=args.normalize_signal,
-                     feature_length_seconds=args.feature_length,
-                     window_size=args.window_size)
\ No newline at end of file
+    manifest = extract_features(args.segments,
+                                args.csv_directory,
+                                workers=args.workers,
+                                resample_frequency=args.resample_frequency,
+                                normalize_signal=args.normalize_signal,
+                                cache_dir=args.cache_dir,
+                                cache_max_bytes=args.cache_max_bytes,
+                                shard_output=args.shard_output,
+                                queue_dir=args.queue_dir,
+                                memory_budget=args.memory_budget,
+                                feature_length_seconds=args.feature_length,
+                                window_size=args.window_size,
+                                output_format=args.output_format)
+    sys.exit(feature_extractor.exit_status(manifest))
\ No newline at end of file
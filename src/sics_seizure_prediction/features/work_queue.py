@@ -0,0 +1,346 @@
+"""
+Module for a work queue on a shared file system, which lets feature extraction runs on several hosts cooperatively
+work through the same segments without any coordination service.
+
+Every job is a small JSON file, and the state of a job is the directory it's in:
+
+    pending/<rank>-<job id>.json              Waiting to be claimed, claimed in order of rank
+    claimed/<worker id>/<rank>-<job id>.json  Being worked on by a worker
+    done/<rank>-<job id>.json                 Completed, holds the result of the job
+    failed/<rank>-<job id>.json               Failed for good, holds the result of the last attempt
+    heartbeats/<worker id>                    Touched regularly by every live worker
+
+A job is claimed by renaming it from pending/ into the claimed directory of the worker, which only one worker can
+succeed with. The job id is derived from the segment path, so enqueueing the same segments from several hosts doesn't
+create duplicate jobs, and jobs already in the queue in any state aren't enqueued again. A queue directory therefore
+belongs to one extraction, use a new directory to extract the same segments again.
+
+Workers touch their heartbeat file while they're alive. If a worker dies, its heartbeat gets older than the lease and
+any worker may put its claimed jobs back into pending/. Heartbeat ages are measured against the modification time of
+the checking worker's own heartbeat, so they use the clock of the file server and not the clocks of the hosts. A job
+can in rare cases be run twice, for example by a worker which was only paused past its lease, which is harmless since
+feature files are written atomically.
+
+The segment paths must be the same on all hosts, for example by mounting the data share at the same place.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import errno
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+#The number of seconds without a heartbeat after which the jobs of a worker are taken over by other workers
+DEFAULT_LEASE_SECONDS = 300
+
+STATES = ('pending', 'claimed', 'done', 'failed')
+
+
+class WorkQueue(object):
+    """
+    A queue of extraction jobs in a directory shared between hosts, see the module documentation. Every WorkQueue
+    object is a worker with its own id and heartbeat.
+    """
+    def __init__(self, queue_dir, lease_seconds=DEFAULT_LEASE_SECONDS, heartbeat_interval=None):
+        """
+        :param queue_dir: The directory of the queue. Will be created if it doesn't exist.
+        :param lease_seconds: The number of seconds without a heartbeat after which the jobs of a worker are put back
+                              into the queue.
+        :param heartbeat_interval: The number of seconds between heartbeats. Defaults to a fifth of the lease.
+        """
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else lease_seconds / 5.0
+        self.worker_id = "{}-{}-{:08x}".format(socket.gethostname(), os.getpid(), random.getrandbits(32))
+        self.heartbeat_thread = None
+        self.stopped = threading.Event()
+        for directory in (self.state_dir('pending'), self.state_dir('claimed'), self.state_dir('done'),
+                          self.state_dir('failed'), os.path.join(queue_dir, 'heartbeats')):
+            make_dirs(directory)
+
+    def state_dir(self, state):
+        """Returns the directory of the jobs in *state*."""
+        return os.path.join(self.queue_dir, state)
+
+    def claimed_dir(self, worker_id=None):
+        """Returns the directory of the jobs claimed by a worker, by default this one."""
+        return os.path.join(self.state_dir('claimed'), worker_id if worker_id is not None else self.worker_id)
+
+    def heartbeat_path(self, worker_id=None):
+        """Returns the heartbeat file of a worker, by default this one."""
+        return os.path.join(self.queue_dir, 'heartbeats', worker_id if worker_id is not None else self.worker_id)
+
+    def job_names(self, state):
+        """Returns the sorted file names of the jobs in *state*. Claimed jobs of all workers are included."""
+        if state == 'claimed':
+            names = []
+            for worker_id in list_dir(self.state_dir('claimed')):
+                names.extend(list_dir(self.claimed_dir(worker_id)))
+            return sorted(names)
+        return sorted(name for name in list_dir(self.state_dir(state)) if name.endswith('.json'))
+
+    def enqueue(self, segments):
+        """
+        Adds jobs for the segments which aren't in the queue yet.
+
+        :param segments: The segment paths, in the order they should be claimed in.
+        :return: The number of jobs added.
+        """
+        known_ids = set(job_id(name) for state in STATES for name in self.job_names(state))
+        added = 0
+        for rank, segment_path in enumerate(segments):
+            segment_path = os.path.abspath(segment_path)
+            segment_id = hashlib.sha1(segment_path.encode('utf-8')).hexdigest()
+            if segment_id in known_ids:
+                continue
+            name = "{:08d}-{}.json".format(rank, segment_id)
+            if self.write_job(os.path.join(self.state_dir('pending'), name), dict(segment=segment_path, attempt=1),
+                              replace=False):
+                added += 1
+        return added
+
+    def write_job(self, path, job, replace=True):
+        """
+        Atomically writes a job file.
+
+        :param path: The path of the job file.
+        :param job: The job dictionary.
+        :param replace: If False, an existing job file is kept.
+        :return: True if the file was written.
+        """
+        temporary_path = os.path.join(self.queue_dir, "{}.{}.tmp".format(os.path.basename(path), self.worker_id))
+        with open(temporary_path, 'w') as fp:
+            json.dump(job, fp, sort_keys=True)
+        try:
+            if replace:
+                os.rename(temporary_path, path)
+                return True
+            # A hard link fails if the target exists, unlike a rename
+            os.link(temporary_path, path)
+            return True
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+            return False
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def claim(self):
+        """
+        Claims the pending job with the lowest rank which is due.
+
+        :return: A pair (job name, job dictionary), or None if no job could be claimed.
+        """
+        now = time.time()
+        make_dirs(self.claimed_dir())
+        for name in self.job_names('pending'):
+            claimed_path = os.path.join(self.claimed_dir(), name)
+            try:
+                os.rename(os.path.join(self.state_dir('pending'), name), claimed_path)
+            except OSError as error:
+                if error.errno == errno.ENOENT:
+                    # Claimed by another worker
+                    continue
+                raise
+            with open(claimed_path) as fp:
+                job = json.load(fp)
+            if job.get('not_before', 0) > now:
+                # A retry which isn't due yet
+                self.release(name)
+                continue
+            return name, job
+        return None
+
+    def release(self, name):
+        """Puts a job claimed by this worker back into pending/ unchanged."""
+        os.rename(os.path.join(self.claimed_dir(), name), os.path.join(self.state_dir('pending'), name))
+
+    def complete(self, name, result):
+        """
+        Moves a job claimed by this worker to done/.
+
+        :param name: The job name as returned by claim.
+        :param result: A JSON serializable result of the job.
+        :return: None.
+        """
+        self.finish(name, 'done', result)
+
+    def fail(self, name, result):
+        """Moves a job claimed by this worker to failed/, with the result of its last attempt."""
+        self.finish(name, 'failed', result)
+
+    def finish(self, name, state, result):
+        """Writes the result of a job claimed by this worker to *state* and removes the claim."""
+        self.write_job(os.path.join(self.state_dir(state), name), result)
+        remove_file(os.path.join(self.claimed_dir(), name))
+
+    def retry(self, name, job, delay):
+        """
+        Puts a job claimed by this worker back into pending/ for another attempt.
+
+        :param name: The job name as returned by claim.
+        :param job: The job dictionary as returned by claim.
+        :param delay: The number of seconds before the job may be claimed again.
+        :return: None.
+        """
+        self.write_job(os.path.join(self.state_dir('pending'), name),
+                       dict(job, attempt=job['attempt'] + 1, not_before=time.time() + delay))
+        remove_file(os.path.join(self.claimed_dir(), name))
+
+    def heartbeat(self):
+        """Touches the heartbeat file of this worker and returns its modification time."""
+        path = self.heartbeat_path()
+        with open(path, 'a'):
+            os.utime(path, None)
+        return os.path.getmtime(path)
+
+    def start_heartbeat(self):
+        """Starts a thread which keeps the heartbeat of this worker fresh until stop_heartbeat is called."""
+        self.heartbeat()
+        self.stopped.clear()
+
+        def beat():
+            while not self.stopped.wait(self.heartbeat_interval):
+                self.heartbeat()
+
+        self.heartbeat_thread = threading.Thread(target=beat, name='work-queue-heartbeat')
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        """Stops the heartbeat thread and removes the heartbeat and claimed directory of this worker."""
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+        remove_file(self.heartbeat_path())
+        try:
+            os.rmdir(self.claimed_dir())
+        except OSError:
+            # Jobs were left claimed, they are taken over when the lease expires
+            pass
+
+    def expire_leases(self):
+        """
+        Puts the jobs of workers whose heartbeat is older than the lease back into pending/.
+
+        :return: The number of jobs put back.
+        """
+        now = self.heartbeat()
+        requeued = 0
+        for worker_id in list_dir(self.state_dir('claimed')):
+            if worker_id == self.worker_id:
+                continue
+            try:
+                last_beat = os.path.getmtime(self.heartbeat_path(worker_id))
+            except OSError:
+                # A worker which never started its heartbeat, judged by when it claimed its first job
+                try:
+                    last_beat = os.path.getmtime(self.claimed_dir(worker_id))
+                except OSError:
+                    continue
+            if now - last_beat <= self.lease_seconds:
+                continue
+            for name in list_dir(self.claimed_dir(worker_id)):
+                try:
+                    os.rename(os.path.join(self.claimed_dir(worker_id), name),
+                              os.path.join(self.state_dir('pending'), name))
+                    requeued += 1
+                except OSError as error:
+                    if error.errno != errno.ENOENT:
+                        raise
+            try:
+                os.rmdir(self.claimed_dir(worker_id))
+            except OSError:
+                pass
+            remove_file(self.heartbeat_path(worker_id))
+        return requeued
+
+    def counts(self):
+        """Returns a dictionary of the number of jobs in every state."""
+        return dict((state, len(self.job_names(state))) for state in STATES)
+
+    def unfinished(self):
+        """Returns the number of jobs which are pending or claimed."""
+        return len(self.job_names('pending')) + len(self.job_names('claimed'))
+
+    def server_time(self):
+        """Returns the current time of the file server of the queue, by touching a file and reading its mtime."""
+        path = os.path.join(self.queue_dir, "clock.{}.tmp".format(self.worker_id))
+        with open(path, 'a'):
+            os.utime(path, None)
+        try:
+            return os.path.getmtime(path)
+        finally:
+            remove_file(path)
+
+    def workers(self):
+        """Returns a dictionary of the ids of the workers with a heartbeat file to the age of their heartbeat."""
+        now = self.server_time()
+        ages = dict()
+        for worker_id in list_dir(os.path.join(self.queue_dir, 'heartbeats')):
+            try:
+                ages[worker_id] = now - os.path.getmtime(self.heartbeat_path(worker_id))
+            except OSError:
+                continue
+        return ages
+
+
+def job_id(name):
+    """Returns the job id part of a job file name."""
+    return os.path.splitext(name)[0].split('-', 1)[-1]
+
+
+def make_dirs(directory):
+    """Creates *directory* unless it exists, also if another process creates it at the same time."""
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+def list_dir(directory):
+    """Returns the names in *directory*, or an empty list if it doesn't exist."""
+    try:
+        return os.listdir(directory)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return []
+        raise
+
+
+def remove_file(path):
+    """Removes *path* if it exists."""
+    try:
+        os.remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Shows the state of a feature extraction work queue.")
+    parser.add_argument("queue_dir", help="The directory of the work queue.")
+    parser.add_argument("--lease-seconds", help="The lease used to tell dead workers from live ones.",
+                        type=float, default=DEFAULT_LEASE_SECONDS)
+    args = parser.parse_args()
+
+    work_queue = WorkQueue(args.queue_dir, lease_seconds=args.lease_seconds)
+    for state, count in sorted(work_queue.counts().items()):
+        print("{}: {} jobs".format(state, count))
+    for worker_id, age in sorted(work_queue.workers().items()):
+        print("Worker {}: last heartbeat {:.0f} seconds ago{}".format(
+            worker_id, age, " (lease expired)" if age > args.lease_seconds else ""))
+
+
+if __name__ == '__main__':
+    main()
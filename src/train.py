@@ -6,10 +6,12 @@ from __future__ import print_function
 
 import json
 import os.path
+import sys
 import datetime
 
-from sics_seizure_prediction.features import hills_features, wavelets, cross_correlate
+from sics_seizure_prediction.features import hills_features, wavelets, cross_correlate, feature_cache
 from sics_seizure_prediction.classification import classification_pipeline
+from sics_seizure_prediction.datasets import worker_pool
 
 
 def extract_features(settings):
@@ -18,34 +20,63 @@ def extract_features(settings):
     'FEATURE_TYPE' and should be either 'xcorr', 'wavelets' or 'hills'.
 
     :param settings: A dictionary with settings. Usually created from the json file 'SETTINGS.json' in the project root
-                     directory.
-    :return: None. The features will be saved as csv files to the directory given by the key 'FEATURE_PATH' in the
-             settings dictionary.
+                     directory. The optional keys 'FEATURE_CACHE_PATH' and 'FEATURE_CACHE_MAX_SIZE' (like "20G") set up
+                     a feature cache shared with other feature folders, and 'FEATURE_OUTPUT_FORMAT' can be
+                     'binary' to write binary feature files instead of csv files. If 'FEATURE_SHARDS' is true, the
+                     binary features are appended to one feature shard per subject and class. 'EXTRACTION_MEMORY_BUDGET'
+                     (like "100G") limits the memory the extraction jobs may use together.
+    :return: The manifest of the extraction run, see feature_extractor.extract. The features will be saved as csv
+             files to the directory given by the key 'FEATURE_PATH' in the settings dictionary.
     """
     output_dir = settings['FEATURE_PATH']
     workers = settings['WORKERS']
     window_size = settings['FEATURE_SETTINGS']['WINDOW_LENGTH']
     frame_length = settings['FEATURE_SETTINGS']['FEATURE_WINDOWS']
     segment_paths = settings['TRAIN_DATA_PATH']
+    # An optional feature cache shared between experiments, see feature_cache
+    cache_dir = settings.get('FEATURE_CACHE_PATH')
+    cache_max_bytes = settings.get('FEATURE_CACHE_MAX_SIZE')
+    if cache_max_bytes is not None:
+        cache_max_bytes = feature_cache.parse_size(cache_max_bytes)
+    output_format = settings.get('FEATURE_OUTPUT_FORMAT', 'csv')
+    shard_output = settings.get('FEATURE_SHARDS', False)
+    memory_budget = settings.get('EXTRACTION_MEMORY_BUDGET')
+    if memory_budget is not None:
+        memory_budget = feature_cache.parse_size(memory_budget)
     if settings['FEATURE_TYPE'] == 'hills':
-        hills_features.extract_features(segment_paths=segment_paths,
-                                        output_dir=output_dir,
-                                        workers=workers,
-                                        window_size=settings['FEATURE_SETTINGS']['WINDOW_LENGTH'],
-                                        feature_length_seconds=window_size*frame_length)
+        return hills_features.extract_features(segment_paths=segment_paths,
+                                               output_dir=output_dir,
+                                               workers=workers,
+                                               cache_dir=cache_dir,
+                                               cache_max_bytes=cache_max_bytes,
+                                               output_format=output_format,
+                                               shard_output=shard_output,
+                                               memory_budget=memory_budget,
+                                               window_size=settings['FEATURE_SETTINGS']['WINDOW_LENGTH'],
+                                               feature_length_seconds=window_size*frame_length)
 
     elif settings['FEATURE_TYPE'] == 'xcorr':
-        cross_correlate.extract_features(segment_paths=segment_paths,
-                                         output_dir=output_dir,
-                                         workers=workers,
-                                         window_size=settings['FEATURE_SETTINGS']['WINDOW_LENGTH'])
+        return cross_correlate.extract_features(segment_paths=segment_paths,
+                                                output_dir=output_dir,
+                                                workers=workers,
+                                                cache_dir=cache_dir,
+                                                cache_max_bytes=cache_max_bytes,
+                                                output_format=output_format,
+                                                shard_output=shard_output,
+                                                memory_budget=memory_budget,
+                                                window_size=settings['FEATURE_SETTINGS']['WINDOW_LENGTH'])
 
     elif settings['FEATURE_TYPE'] == 'wavelets':
-        wavelets.extract_features(segment_paths=segment_paths,
-                                  output_dir=output_dir,
-                                  workers=workers,
-                                  window_size=settings['FEATURE_SETTINGS']['WINDOW_LENGTH'],
-                                  feature_length_seconds=window_size*frame_length)
+        return wavelets.extract_features(segment_paths=segment_paths,
+                                         output_dir=output_dir,
+                                         workers=workers,
+                                         cache_dir=cache_dir,
+                                         cache_max_bytes=cache_max_bytes,
+                                         output_format=output_format,
+                                         shard_output=shard_output,
+                                         memory_budget=memory_budget,
+                                         window_size=settings['FEATURE_SETTINGS']['WINDOW_LENGTH'],
+                                         feature_length_seconds=window_size*frame_length)
 
 
 def train_model(settings):
@@ -115,10 +146,18 @@ def main():
 
     args = parser.parse_args()
     settings = get_settings(args.settings)
-    print("Extracting Features")
-    extract_features(settings)
-    print("Training model")
-    train_model(settings)
+    # The same worker processes are used for extracting and loading the features. The optional setting
+    # 'WORKER_MAX_TASKS' replaces a worker after that many tasks.
+    with worker_pool.shared_pool(settings['WORKERS'], maxtasksperchild=settings.get('WORKER_MAX_TASKS')):
+        print("Extracting Features")
+        manifest = extract_features(settings)
+        if manifest is not None and manifest['failed']:
+            # Training on an incomplete feature set would silently give a worse model
+            print("Feature extraction failed for {} segments, not training the model".format(
+                len(manifest['failed'])))
+            sys.exit(1)
+        print("Training model")
+        train_model(settings)
 
 
 if __name__ == '__main__':